@@ -1,6 +1,72 @@
+from django import forms
+from django import shortcuts
+from django import template
+from django.conf.urls import defaults as urlconf
 from django.contrib import admin
+from django.contrib import messages
+from django.utils.translation import ugettext_lazy as _
 
+from lyra import importer
 from lyra import models
 
-admin.site.register(models.Reservation)
+class ImportForm(forms.Form):
+    namespace = forms.ChoiceField(label=_(u"Calendar"), choices=())
+    file = forms.FileField(label=_(u"File"),
+                           help_text=_(u"CSV with a header line, or iCalendar"))
+    format = forms.ChoiceField(label=_(u"Format"),
+                               choices=(("csv", "CSV"), 
+                                        ("ics", "iCalendar")))
+    exclusive = forms.BooleanField(
+        label=_(u"No overlap"),
+        required=False,
+        help_text=_(u"Leave out rows overlapping other reservations"))
 
+    def __init__(self, *args, **kwargs):
+        super(ImportForm, self).__init__(*args, **kwargs)
+        self.fields["namespace"].choices = (
+            models.Reservation._meta.get_field("namespace").choices)
+
+class ReservationAdmin(admin.ModelAdmin):
+    change_list_template = "admin/lyra/reservation/change_list.html"
+
+    def get_urls(self):
+        return urlconf.patterns('',
+            urlconf.url(r'^import/$', 
+                        self.admin_site.admin_view(self.import_view),
+                        name="lyra_reservation_import"),
+            ) + super(ReservationAdmin, self).get_urls()
+
+    def import_view(self, request):
+        """imports reservations from an uploaded file, rows without a
+        person made by the uploader"""
+        if not self.has_add_permission(request):
+            return shortcuts.redirect("..")
+
+        form = ImportForm(request.POST or None, request.FILES or None)
+        if form.is_valid():
+            run = importer.Importer(self.model,
+                                    form.cleaned_data["namespace"],
+                                    person=request.user,
+                                    exclusive=form.cleaned_data["exclusive"])
+            run.run(importer.READERS[form.cleaned_data["format"]](
+                    form.cleaned_data["file"]))
+
+            messages.info(request, _(u"%(imported)s reservations imported, "
+                                     u"%(skipped)s rows skipped") % {
+                    "imported": run.imported, 
+                    "skipped": len(run.errors)})
+            for line_no, message in sorted(run.errors)[:20]:
+                messages.warning(request, _(u"Line %(line)s: %(message)s") % {
+                        "line": line_no, 
+                        "message": message})
+            return shortcuts.redirect("..")
+
+        return shortcuts.render_to_response(
+            "admin/lyra/reservation/import.html",
+            {"form": form,
+             "opts": self.model._meta,
+             "title": _(u"Import reservations")},
+            context_instance=template.RequestContext(request))
+
+admin.site.register(models.Reservation, ReservationAdmin)
+admin.site.register(models.Recurrence)
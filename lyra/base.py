@@ -1,15 +1,89 @@
+import datetime
 import functools
+import hashlib
 import itertools
+import re
+import time
 
+from django.core import urlresolvers
 from django.db import models
+from django.utils.encoding import force_unicode
+from django.utils.encoding import iri_to_uri
 from django.views.generic import base as views_base
 from django.template import loader
 from django import template as template_module
 from django import http
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.serializers import json as serializers_json
+from django.utils import http as http_utils
+from django.utils import simplejson
+from django.utils import translation
+from django.utils.translation import ugettext as _
+
+from lyra import pagecache
 
 _namespace_registry = {}
 
+def _find_route(resolver, viewname, kwarg_names, current_app):
+    # follows urlresolvers.reverse down the namespaces to the
+    # resolver holding the view
+    parts = viewname.split(":")
+    view = parts.pop()
+    prefix = u""
+    for ns in parts:
+        app_list = resolver.app_dict.get(ns)
+        if app_list:
+            if current_app and current_app in app_list:
+                ns = current_app
+            elif ns not in app_list:
+                ns = app_list[0]
+        try:
+            extra, resolver = resolver.namespace_dict[ns]
+        except KeyError:
+            return None
+        prefix += extra
+
+    for possibility, pattern in resolver.reverse_dict.getlist(view):
+        for result, params in possibility:
+            if set(params) == set(kwarg_names):
+                return (prefix, result, 
+                        re.compile(u"^%s" % pattern, re.UNICODE))
+    return None
+
+def reverse(viewname, kwargs=None, current_app=None):
+    """urlresolvers.reverse with keyword arguments, resolving each
+    route once into a format string that is then filled in
+
+    the routes are cached on the resolver, so they go away with the
+    rest of the URL caches"""
+    kwargs = kwargs or {}
+    resolver = urlresolvers.get_resolver(urlresolvers.get_urlconf())
+    try:
+        routes = resolver._lyra_routes
+    except AttributeError:
+        routes = resolver._lyra_routes = {}
+
+    key = (viewname, current_app, tuple(sorted(kwargs)))
+    try:
+        route = routes[key]
+    except KeyError:
+        route = routes[key] = _find_route(resolver, viewname, key[2], 
+                                          current_app)
+
+    if route is not None:
+        prefix, result, pattern = route
+        candidate = result % dict((k, force_unicode(v)) 
+                                  for k, v in kwargs.iteritems())
+        if pattern.search(candidate):
+            return iri_to_uri(u"%s%s%s" % (urlresolvers.get_script_prefix(),
+                                           prefix, 
+                                           candidate))
+
+    # let django find another route or raise NoReverseMatch
+    return urlresolvers.reverse(viewname, kwargs=kwargs, 
+                                current_app=current_app)
+
 class TemplatePrefixMeta(type):
     def __new__(meta, classname, bases, attrs):
         if attrs.get("app_name") and not attrs.get("template_prefix"):
@@ -40,6 +114,8 @@ class App(HasUrls):
 
     app_name = None
     extra_context = {}
+    # seconds to cache rendered browse pages for, None to not cache
+    page_cache_timeout = None
     app_dict = {}
     template_prefix = None
 
@@ -61,9 +137,10 @@ class App(HasUrls):
         self.__class__.app_dict.setdefault(self.app_name, []).append(self)
         _namespace_registry[self.namespace] = self
         self.parent = parent
+        self._template_cache = {}
 
     @staticmethod
-    def get_by_namespace(self, namespace):
+    def get_by_namespace(namespace):
         return _namespace_registry.get(namespace)
 
     def get_template_names(self, template_select, 
@@ -105,6 +182,117 @@ class App(HasUrls):
         return candidates
         
 
+    def get_permission_profile(self, request):
+        """what the pages shown to `request` depend on besides the
+        reservations: by default, who is asking"""
+        if request.user.is_authenticated():
+            return request.user.pk
+        return None
+
+    def get_page_variant(self, request):
+        """what else than the page and the reservations the response
+        to `request` depends on"""
+        return (request.is_ajax(),
+                request.GET.urlencode(),
+                self.get_permission_profile(request),
+                translation.get_language(),
+                datetime.date.today())
+
+    def get_page_state(self, span, namespaces=None):
+        """(last modified, tag) of the reservations shown on a page
+        spanning `span`, the whole namespace if None; None when it
+        cannot be told cheaply
+
+        `namespaces` are those shown when not just this one"""
+        return None
+
+    def page_response(self, request, page, render, span=None,
+                      namespaces=None):
+        """the response of `render()` for `page`, or 304 Not Modified
+        if the client has it already
+
+        pages showing other `namespaces` than this one name them all"""
+        state = None
+        if request.method == "GET":
+            state = self.get_page_state(span, namespaces)
+        if state is None:
+            return self.cached_response(request, page, render, namespaces)
+
+        last_modified, tag = state
+        etag = hashlib.md5(repr(
+                (page, tag, self.get_page_variant(request)))).hexdigest()
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+        if if_none_match and (
+            etag in http_utils.parse_etags(if_none_match) 
+            or if_none_match == "*"):
+            response = http.HttpResponseNotModified()
+            response["ETag"] = http_utils.quote_etag(etag)
+            return response
+
+        response = self.cached_response(request, page, render, namespaces)
+        if response.status_code == 200:
+            response["ETag"] = http_utils.quote_etag(etag)
+            if last_modified is not None:
+                response["Last-Modified"] = http_utils.http_date(
+                    time.mktime(last_modified.timetuple()))
+        return response
+
+    def cached_response(self, request, page, render, namespaces=None):
+        """the response of `render()` for `page`, cached for
+        page_cache_timeout seconds until the namespace, or one of
+        `namespaces` if given, next changes"""
+        if not self.page_cache_timeout or request.method != "GET":
+            return render()
+
+        key = pagecache.page_key(
+            self.namespace, (page, self.get_page_variant(request)),
+            namespaces or ())
+        cache = pagecache.get_page_cache()
+
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            return http.HttpResponse(content, content_type=content_type)
+
+        response = render()
+        if response.status_code == 200:
+            cache.set(key, (response.content, response["Content-Type"]),
+                      self.page_cache_timeout)
+        return response
+
+    def cache_templates(self):
+        return getattr(settings, "LYRA_CACHE_TEMPLATES", not settings.DEBUG)
+
+    def select_template(self, template_select, denominator=None):
+        """the first of get_template_names() that loads; remembered
+        per app unless LYRA_CACHE_TEMPLATES (default: not DEBUG) is
+        off"""
+        if not self.cache_templates():
+            return loader.select_template(
+                self.get_template_names(template_select, denominator))
+
+        key = (tuple(template_select), denominator)
+        try:
+            return self._template_cache[key]
+        except KeyError:
+            tpl = self._template_cache[key] = loader.select_template(
+                self.get_template_names(template_select, denominator))
+            return tpl
+
+    def load_template(self, template_names):
+        """the first of the full `template_names` that loads, remembered
+        like select_template()"""
+        if not self.cache_templates():
+            return loader.select_template(template_names)
+
+        key = tuple(template_names)
+        try:
+            return self._template_cache[key]
+        except KeyError:
+            tpl = self._template_cache[key] = loader.select_template(
+                template_names)
+            return tpl
+
     def get_response(self, request, context={}, template=None,
                      denominator=None, extend_template=None,
                      template_select=None):
@@ -124,14 +312,12 @@ class App(HasUrls):
             raise ValueError("provide one of template or "
                              "template_select, not both or neither")
         
-        tpl = loader.select_template(
-            self.get_template_names(template_select, denominator))
+        tpl = self.select_template(template_select, denominator)
 
         base_context = dict(
             self.extra_context,
             **{
-                "base": loader.select_template(
-                    self.get_template_names(extend_templates, denominator))}
+                "base": self.select_template(extend_templates, denominator)}
             )
         context = dict(base_context, **context)
         ctx = template_module.RequestContext(request, context)
@@ -139,10 +325,17 @@ class App(HasUrls):
 
         return http.HttpResponse(tpl.render(ctx))
 
+    def json_response(self, data):
+        """`data` as compact JSON, with DjangoJSONEncoder writing
+        dates as YYYY-MM-DD and datetimes as YYYY-MM-DD HH:MM:SS"""
+        return http.HttpResponse(
+            simplejson.dumps(data, cls=serializers_json.DjangoJSONEncoder,
+                             separators=(",", ":")),
+            content_type="application/json")
+
     def reverse(self, view_name, kwargs={}):
-        return self.urlresolvers.reverse(
+        return reverse(
             "%s:%s" % (self.namespace, view_name),
-            args=(),
             kwargs=kwargs,
             current_app=self.namespace)
 
@@ -165,10 +358,14 @@ class AppAwareTemplate(views_base.TemplateResponseMixin):
     base_template_names = ["base"]
 
     @requires_app
-    def render_to_response(self, *args, **kwargs):
+    def render_to_response(self, context, **kwargs):
         kwargs["current_app"] = self.app.namespace
 
-        return super(AppAwareTemplate, self).render_to_response(*args, **kwargs)
+        return self.response_class(
+            request=self.request,
+            template=self.app.load_template(self.get_template_names()),
+            context=context,
+            **kwargs)
 
     def get_context_data(self, **kwargs):
         data = super(AppAwareTemplate, self).get_context_data(**kwargs)
@@ -180,9 +377,9 @@ class AppAwareTemplate(views_base.TemplateResponseMixin):
             base_template_names.insert(0, "ajax_base")
 
         data.update({
-                "base": loader.select_template(self.app.get_template_names(
+                "base": self.app.select_template(
                     base_template_names,
-                    denominator=self.get_denominator())),
+                    denominator=self.get_denominator()),
                 })
         return data
 
@@ -213,7 +410,11 @@ class AppAwareQuerysetMixin(object):
         # Use a custom queryset if provided; this is required for subclasses
         # like DateDetailView
         if queryset is None:
-            queryset = self.get_queryset()
+            # the security check has already fetched it
+            if getattr(self, "_object", None) is not None:
+                return self._object
+            self._object = self.get_object(self.get_queryset())
+            return self._object
 
         # Next, try looking up by primary key.
         pk = self.kwargs.get('pk', None)
@@ -235,7 +436,7 @@ class AppAwareQuerysetMixin(object):
         try:
             obj = queryset.get()
         except ObjectDoesNotExist:
-            raise Http404(_(u"No %(verbose_name)s found matching the query") %
+            raise http.Http404(_(u"No %(verbose_name)s found matching the query") %
                           {'verbose_name': queryset.model._meta.verbose_name})
         return obj
 
@@ -283,6 +484,9 @@ class QuerySetManager(models.Manager):
         return self.queryset_class(self.model)
 
     def __getattr__(self, attr, *args):
+        if attr.startswith("__"):
+            # copying the manager must not evaluate a queryset
+            raise AttributeError(attr)
         try:
             return getattr(self.__class__, attr, *args)
         except AttributeError:
@@ -6,6 +6,8 @@ class Browse(base.SubApp):
     import datetime
     import calendar as calendar_mod
 
+    from django import http
+
     from django.conf.urls import defaults as urlconf
     
     from lyra import dayplanner  
@@ -13,8 +15,16 @@ class Browse(base.SubApp):
 
     week_display = dayplanner.WeekBrowse
     day_display = dayplanner.DayBrowse
+    grid_week_display = dayplanner.GridWeekBrowse
+    grid_day_display = dayplanner.GridDayBrowse
     day_class = day.Day
     
+    # hours of the day searched for free slots, None for all
+    free_slot_hours = range(8, 17)
+    # most days and slots searched for in one request
+    MAX_FREE_SLOT_DAYS = 366
+    MAX_FREE_SLOTS = 100
+
     def __init__(self, *args, **kwargs):
         super(Browse, self).__init__(*args, **kwargs)
         self.calendar = self.calendar_mod.Calendar()
@@ -29,10 +39,46 @@ class Browse(base.SubApp):
                     '^(?P<year>\d{4})/%s(?P<week>\d{1,2})/$' % (_(u"week")),
                     self.week_display.as_view(app=self.app),
                     name="browse_week"),
+            self.urlconf.url(
+                    '^(?P<year>\d{4})/%s(?P<week>\d{1,2})/json/$' % (
+                    _(u"week")),
+                    self.week_display.as_view(app=self.app, output="json"),
+                    name="browse_week_json"),
             self.urlconf.url(
                     '^(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})/$',
                     self.day_display.as_view(app=self.app),
                     name="browse_day"),
+            self.urlconf.url(
+                    '^(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})/json/$',
+                    self.day_display.as_view(app=self.app, output="json"),
+                    name="browse_day_json"),
+            self.urlconf.url(
+                    '^%s/(?P<year>\d{4})/%s(?P<week>\d{1,2})/$' % (
+                    _(u"grid"), _(u"week")),
+                    self.grid_week_display.as_view(app=self.app),
+                    name="browse_grid_week"),
+            self.urlconf.url(
+                    '^%s/(?P<year>\d{4})/%s(?P<week>\d{1,2})/json/$' % (
+                    _(u"grid"), _(u"week")),
+                    self.grid_week_display.as_view(app=self.app, 
+                                                   output="json"),
+                    name="browse_grid_week_json"),
+            self.urlconf.url(
+                    '^%s/(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})/$' % (
+                    _(u"grid")),
+                    self.grid_day_display.as_view(app=self.app),
+                    name="browse_grid_day"),
+            self.urlconf.url(
+                    '^%s/$' % _(u"free"),
+                    self.free_slots, name="free_slots"),
+            self.urlconf.url(
+                    '^%s/json/$' % _(u"free"),
+                    self.free_slots, {"output": "json"},
+                    name="free_slots_json"),
+            self.urlconf.url(
+                    '^(?P<year>\d{4})/(?P<month>\d{1,2})/json/$',
+                    self.browse_month, {"output": "json"},
+                    name="browse_month_json"),
             self.urlconf.url(
                     '^(?P<year>\d{4})/(?P<month>\d{1,2})/',
                     self.browse_month, name="browse_month"),])
@@ -42,31 +88,69 @@ class Browse(base.SubApp):
         if is_forbidden:
             return is_forbidden
 
+        return self.app.page_response(
+            request, ("index",), lambda: self.render_index(request))
+
+    def render_index(self, request):
         this_year = self.datetime.date.today().year
-        next_year_date = self.datetime.datetime(this_year+1, 1, 1)
-        all_years = list(self.app.queryset.get_years())
-        if next_year_date not in all_years:
-            all_years.append(next_year_date)
-            all_years.sort()
+        year_counts = self.get_year_counts()
+        all_years = sorted(set(year_counts) | set([this_year+1]))
 
         return self.app.get_response(
             request,
             template="index", 
             context={
                 "years": [
-                    {"year": year,
+                    {"year": self.datetime.date(year, 1, 1),
                      "link": self.app.reverse("browse_year", {
-                                "year": year.year}),
-                     "reservation_count": self.app.queryset.year(year.year).count()}
+                                "year": year}),
+                     "reservation_count": year_counts.get(year, 0)}
                     for year in all_years],
                 "app_name": self.app.get_app_desc(), 
                 },)
 
+    def get_year_counts(self):
+        """maps years with reservations to reservation counts"""
+        if self.app.count_model is not None:
+            return self.app.count_model.objects.years(self.app.namespace)
+
+        # on the fly, the occurrences of series up to next year included
+        queryset = self.app.queryset
+        rows = queryset
+        if queryset.has_series():
+            rows = queryset.filter(recurrence__isnull=True)
+        counts = dict((d.year, rows.year(d.year).count())
+                      for d in rows.get_years())
+
+        next_years = self.datetime.date.today().year + 2
+        for (year, month), count in queryset.series_counts(
+            None, self.datetime.datetime(next_years, 1, 1)).iteritems():
+            if month == 0:
+                counts[year] = counts.get(year, 0) + count
+        return counts
+
+    def get_month_counts(self, year):
+        """reservation counts for each month of `year`"""
+        if self.app.count_model is not None:
+            return self.app.count_model.objects.months(self.app.namespace,
+                                                       year)
+
+        return self.app.queryset.month_counts(year)
+
     def browse_year(self, request, year):
         is_forbidden = self.app.check_forbidden(request, ["view"])
         if is_forbidden:
             return is_forbidden
         year = int(year)
+
+        return self.app.page_response(
+            request, ("year", year), 
+            lambda: self.render_year(request, year),
+            span=(self.datetime.date(year, 1, 1),
+                  self.datetime.date(year + 1, 1, 1)))
+
+    def render_year(self, request, year):
+        month_counts = self.get_month_counts(year)
         
         return self.app.get_response(
             request,
@@ -80,43 +164,53 @@ class Browse(base.SubApp):
                      "link": self.app.reverse("browse_month", {
                                 "month": m, 
                                 "year": year}),
-                     "reservation_count": self.app.queryset.month(year, m).count()}
+                     "reservation_count": month_counts[m-1]}
                     for m 
                     in range(1, 13)],
                 "app_name": self.app.get_app_desc(),  
                 "index_link": self.app.reverse("browse_index"),
              },)
 
-    def browse_month(self, request, year, month):
+    def get_month_weeks(self, year, month):
+        """builds the month grid, off-month days included, with the
+        events of every day fetched in a single query"""
+        month_weeks = self.calendar.monthdatescalendar(year, month)
+        events_by_date = self.app.queryset.for_listing(brief=True).by_date(
+            d for week in month_weeks for d in week)
+
+        today = self.datetime.date.today()
+        weeks = []
+        for week in month_weeks:
+            week_year, week_no, weekday = week[0].isocalendar()
+            weeks.append({
+                    "week": week_no,
+                    "days": [self.day_class({
+                                "date": d, 
+                                "events": events_by_date[d],
+                                "is_today": d == today,
+                                "is_offmonth": d.month != month})
+                             for d in week],
+                    "link": self.app.reverse("browse_week", {
+                            "year": week_year,
+                            "week": week_no})})
+        return weeks
+
+    def browse_month(self, request, year, month, output="html"):
         is_forbidden = self.app.check_forbidden(request, ["view"])
         if is_forbidden:
             return is_forbidden
 
-        def getweek(week):
-            date = week[0]
-            year, week, weekday = date.isocalendar()
-            return week
-
-        def getyear(week):
-            date = week[0]
-            year, week, weekday = date.isocalendar()
-            return year
-
         year, month = int(year), int(month)
 
-        today = self.datetime.date.today()
-        weeks = [{"week": getweek(week),
-                  "days": [self.day_class({
-                        "date": d, 
-                        "events": self.app.queryset.get_for_date(date=d),
-                        "is_today": d == today,
-                        "is_offmonth": d.month != month})
-                           for d in week],
-                  "link": self.app.reverse("browse_week", {
-                        "year": getyear(week),
-                        "week": getweek(week)})} 
-                 
-                 for week in self.calendar.monthdatescalendar(year, month)]
+        month_weeks = self.calendar.monthdatescalendar(year, month)
+        return self.app.page_response(
+            request, ("month", output, year, month), 
+            lambda: self.render_month(request, year, month, output),
+            span=(month_weeks[0][0],
+                  month_weeks[-1][-1] + self.datetime.timedelta(days=1)))
+
+    def render_month(self, request, year, month, output="html"):
+        weeks = self.get_month_weeks(year, month)
 
         next_month = month + 1
         next_year = year
@@ -130,24 +224,117 @@ class Browse(base.SubApp):
             prev_month = 12
             prev_year = year - 1 
 
+        context = {
+            "year": year,
+            "month": self.datetime.date(year, month, 1),
+            "prev_month_link": self.app.reverse("browse_month", {
+                    "month": prev_month,
+                    "year": prev_year}),
+            "prev_year": prev_year,
+            "prev_month": prev_month,
+            "next_month_link": self.app.reverse("browse_month", {
+                    "month": next_month,
+                    "year": next_year}),
+            "next_year": next_year,
+            "next_month": next_month,
+            "reserve_link": self.app.reverse("reserve"),
+            "year_link": self.app.reverse("browse_year", {"year": year}),
+            }
+
+        if output == "json":
+            context["weeks"] = self.get_month_data(weeks)
+            return self.app.json_response(context)
+
+        context.update({
+                "weeks": weeks,
+                "app_name": self.app.get_app_desc()})
         return self.app.get_response(
             request,
             template="browse_month",
+            context=context)
+
+    def get_month_data(self, weeks):
+        """the month grid as plain data for client side rendering"""
+        return [{"week": week["week"],
+                 "link": week["link"],
+                 "days": [{"date": day["date"],
+                           "is_today": day["is_today"],
+                           "is_offmonth": day["is_offmonth"],
+                           "events": [{"pk": e.pk,
+                                       "description": e.description,
+                                       "style": e.style,
+                                       "start": e.start,
+                                       "stop": e.stop,
+                                       "link": e.get_absolute_url()}
+                                      for e in day["events"]]}
+                          for day in week["days"]]}
+                for week in weeks]                
+
+    def get_free_slot_query(self, request):
+        """(start, stop, duration, limit, hours) from the query string,
+        raises ValueError"""
+        now = self.datetime.datetime.now()
+        start = now
+        if request.GET.get("start"):
+            start = max(now, self.datetime.datetime.strptime(
+                    request.GET["start"], "%Y-%m-%d"))
+        days = min(int(request.GET.get("days", 7)), self.MAX_FREE_SLOT_DAYS)
+        duration_hours = float(request.GET.get("hours", 1))
+        limit = min(int(request.GET.get("limit", 10)), self.MAX_FREE_SLOTS)
+        # also false for nan, and inf is too long
+        if (days < 1 or limit < 1 
+            or not 0 < duration_hours <= days * 24):
+            raise ValueError("nothing to search")
+        if start.date() > (self.datetime.date.max 
+                           - self.datetime.timedelta(days)):
+            raise ValueError("search ends past the last date")
+        duration = self.datetime.timedelta(hours=duration_hours)
+
+        hours = self.free_slot_hours
+        within = request.GET.get("within")
+        if within == "all":
+            hours = None
+        elif within:
+            first, last = [int(h) for h in within.split("-")]
+            if not 0 <= first < last <= 24:
+                raise ValueError("hours out of the day")
+            hours = range(first, last)
+
+        stop = self.datetime.datetime.combine(
+            start.date() + self.datetime.timedelta(days), 
+            self.datetime.time())
+        return start, stop, duration, limit, hours
+
+    def free_slots(self, request, output="html"):
+        is_forbidden = self.app.check_forbidden(request, ["view"])
+        if is_forbidden:
+            return is_forbidden
+
+        try:
+            start, stop, duration, limit, hours = self.get_free_slot_query(
+                request)
+        except ValueError:
+            return self.http.HttpResponseBadRequest()
+
+        reserve_link = self.app.reverse("reserve")
+        slots = [{"start": slot_start, 
+                  "stop": slot_stop,
+                  "reserve_link": "%s?day=%s" % (reserve_link, 
+                                                 slot_start.date())}
+                 for slot_start, slot_stop 
+                 in self.app.queryset.free_slots(start, stop, duration, 
+                                                 limit, within_hours=hours)]
+
+        if output == "json":
+            return self.app.json_response({"slots": slots})
+
+        return self.app.get_response(
+            request,
+            template="free_slots",
             context={
-                "weeks": weeks,
-                "year": year,
-                "month": self.datetime.date(year, month, 1),
-                "prev_month_link": self.app.reverse("browse_month", {
-                        "month": prev_month,
-                        "year": prev_year}),
-                "prev_year": prev_year,
-                "prev_month": prev_month,
-                "next_month_link": self.app.reverse("browse_month", {
-                        "month": next_month,
-                        "year": next_year}),
-                "next_year": next_year,
-                "next_month": next_month,
-                "reserve_link": self.app.reverse("reserve"),
-                "year_link": self.app.reverse("browse_year", {"year": year}),
+                "slots": slots,
+                "start": start,
+                "stop": stop,
+                "query": request.GET,
                 "app_name": self.app.get_app_desc(),
-                },)                
+                })
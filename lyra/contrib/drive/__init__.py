@@ -5,7 +5,7 @@ from lyra import views
 class DriveApp(views.Lyra):
     app_name = "drive"
 
-    class crud_app(views.ScheduleApp.crud_app):
+    class crud_class(views.Lyra.crud_class):
         from lyra import forms
 
         reservation_form = forms.ReservationExclusiveDisable
@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+
 from django.utils.translation import ugettext as _
 from django import forms
+from django.db import transaction
 
 from lyra.contrib import drive 
+from lyra import models as lyra_models
+from lyra import pagecache
 from lyra.contrib.duty import models
 
 def date_range(begin, end):
@@ -37,6 +42,11 @@ class DutyReservation(forms.Form):
     period_time_stop = forms.TimeField(
         label=_(u"Päivystystunnit jaksolla kunnes"))
 
+    exclusive = forms.BooleanField(
+        label=_(u"Ei päällekkäisyyksiä"),
+        required=False,
+        help_text=_(u"Tarkista, ettei jaksolla ole muita varauksia"))
+
     person = forms.ModelChoiceField(
         queryset=models.DutyPerson.objects.all(),
         label=_(u"Takapäivystäjä"),
@@ -64,24 +74,48 @@ class DutyReservation(forms.Form):
                 (self._errors
                      .setdefault("period_time_start", self.error_class())
                      .append(_("Varauksen tulee alkaa ennen kuin se loppuu.")))
-                
+            if cleaned_data.get("exclusive") and not self._errors:
+                period = self.get_period(cleaned_data)
+                conflicts = [start.date() for (start, stop), overlap 
+                             in zip(period, self.queryset.overlaps(period))
+                             if overlap]
+                if conflicts:
+                    (self._errors
+                         .setdefault("period_start_date", self.error_class())
+                         .append(_(u"Jaksolla on muita varauksia: %s") % 
+                                 u", ".join(d.strftime("%d.%m.%Y") 
+                                            for d in conflicts)))
 
         return cleaned_data        
 
+    def get_period(self, data):
+        """(start, stop) of the reservation of each day of the period"""
+        return [(datetime.datetime.combine(date, data["period_time_start"]),
+                 datetime.datetime.combine(date, data["period_time_stop"]))
+                for date in date_range(data["period_start_date"],
+                                       data["period_stop_date"])]
+
     def save(self):
-        if not self.is_valid:
+        if not self.is_valid():
             raise ValueError
         
         data = self.cleaned_data
-
-        for date in date_range(data["period_start_date"],
-                               data["period_stop_date"]):
-            models.Reservation.objects.create(
-                namespace=self.namespace,
-                person=self.person,
-                start=datetime.datetime.combine(date, data["period_time_start"]),
-                stop=datetime.datetime.combine(date, data["period_time_stop"]),
-                description=u"%s puh. tfn. %s" % (data["person"].user.get_full_name(), data["person"].phone))
+        description = u"%s puh. tfn. %s" % (
+            data["person"].user.get_full_name(), data["person"].phone)
+
+        # one daily series for the whole period
+        with transaction.commit_on_success():
+            recurrence = lyra_models.Recurrence.objects.create(
+                frequency=lyra_models.Recurrence.DAILY,
+                until=data["period_stop_date"])
+            start, stop = self.get_period(data)[0]
+            self.queryset.model.objects.create(namespace=self.namespace,
+                                               person=self.person,
+                                               start=start,
+                                               stop=stop,
+                                               description=description,
+                                               recurrence=recurrence)
+        pagecache.bump_committed()
         
         return WeekFacade(self.namespace, data["period_start_date"])
 
@@ -102,13 +136,13 @@ class DutyApp(drive.DriveApp):
     def user_can_delete(self, request, reservation):
         return request.user.has_perm("lyra.delete_reservation")
 
-    class crud_app(drive.DriveApp.crud_app):
+    class crud_class(drive.DriveApp.crud_class):
         import datetime
 
         reservation_form_create = DutyReservation
 
         def _get_urls(self):
-            patterns = super(DutyApp.crud_app, self)._get_urls()
+            patterns = super(DutyApp.crud_class, self)._get_urls()
             patterns += self.urlconf.patterns('', *[
                     self.urlconf.url('^%s/(?P<year>\d{4})/(?P<month>\d+)/$' % _("tyoaika"), 
                                      self.month_report, 
@@ -122,13 +156,14 @@ class DutyApp(drive.DriveApp):
                 return is_forbidden
 
             year, month = int(year), int(month)
-            start = self.datetime.date(year, month, 1)
+            start = self.datetime.datetime(year, month, 1)
             if month < 12:
-                stop = self.datetime.date(year, month+1, 1)
+                stop = self.datetime.datetime(year, month+1, 1)
             else:
-                stop = self.datetime.date(year+1, 1, 1)
+                stop = self.datetime.datetime(year+1, 1, 1)
 
-            reservations = self.app.queryset.date_range(start, stop)
+            reservations = (self.app.queryset.for_listing(brief=True)
+                            .expanded(start, stop))
                 
             return self.app.get_response(
                 request,
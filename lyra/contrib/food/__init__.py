@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
+import bisect
+import datetime
+
 from django.utils.translation import ugettext as _
 from django import forms
+from django.db import transaction
 
 from lyra import views
 from lyra import dayplanner
@@ -17,7 +21,8 @@ class FridayForm(forms.Form):
 
     def __init__(self, *args, **kwargs):
         self.date = kwargs.pop("date")
-        self.queryset = kwargs.pop("queryset")
+        # the week's reservations by start time, shared by the forms
+        self.reservations = kwargs.pop("reservations")
         self.new_object = kwargs.pop("new_object")
         
         kwargs["initial"] = self.get_initial()
@@ -30,21 +35,37 @@ class FridayForm(forms.Form):
             "lunch_main": lunch.description,
             "lunch_other": lunch.long_description}
 
+    def get_reservation(self, start, stop):
+        try:
+            return self.reservations[start]
+        except KeyError:
+            res = self.reservations[start] = self.new_object(start=start, 
+                                                             stop=stop)
+            return res
+
     def get_lunch_reservation(self):
         start = datetime.datetime.combine(self.date, datetime.time(11, 15))
+        return self.get_reservation(start, start.replace(hour=12, minute=0))
 
-        try:
-            return self.queryset.get(start=start)
-        except django_exceptions.ObjectDoesNotExist:
-            return self.new_object(start=start, stop=start.replace(hour=12, minute=0))
+    def set_courses(self, res, main, other):
+        """updates `res`, returning it if it is new or changed"""
+        if (res.pk is not None 
+            and (res.description, res.long_description) == (main, other)):
+            return None
+        res.description = main
+        res.long_description = other
+        return res
 
     def save(self, commit=True):
-        res = self.get_lunch_reservation()
-        res.description = self.cleaned_data["lunch_main"]
-        res.long_description = self.cleaned_data["lunch_other"]
+        """the new and changed reservations, saved if `commit`"""
+        reservations = [self.set_courses(self.get_lunch_reservation(),
+                                         self.cleaned_data["lunch_main"],
+                                         self.cleaned_data["lunch_other"])]
+        reservations = [res for res in reservations if res is not None]
         if commit:
-            res.save()
-        return [res]
+            for res in reservations:
+                res.save()
+        return reservations
 
 class DayForm(FridayForm):
     dinner_main = forms.CharField(
@@ -64,26 +85,19 @@ class DayForm(FridayForm):
 
     def get_lunch_reservation(self):
         start = datetime.datetime.combine(self.date, datetime.time(11, 0))
-
-        try:
-            return self.queryset.get(start=start)
-        except django_exceptions.ObjectDoesNotExist:
-            return self.new_object(start=start, stop=start.replace(hour=12, minute=45))
+        return self.get_reservation(start, start.replace(hour=12, minute=45))
 
     def get_dinner_reservation(self):
         start = datetime.datetime.combine(self.date, datetime.time(16, 0))
-
-        try:
-            return self.queryset.get(start=start)
-        except django_exceptions.ObjectDoesNotExist:
-            return self.new_object(start=start, stop=start.replace(hour=17))
+        return self.get_reservation(start, start.replace(hour=17))
 
     def save(self, commit=True):
         reservations = super(DayForm, self).save(commit=False)
-        res = self.get_dinner_reservation()
-        res.description = self.cleaned_data["dinner_main"]
-        res.long_description = self.cleaned_data["dinner_other"]
-        reservations.append(res)
+        res = self.set_courses(self.get_dinner_reservation(),
+                               self.cleaned_data["dinner_main"],
+                               self.cleaned_data["dinner_other"])
+        if res is not None:
+            reservations.append(res)
         if commit:
             for res in reservations:
                 res.save()
@@ -95,7 +109,7 @@ class Menu(views.Lyra):
     def get_app_name(self):
         return _(u"Menu")
 
-    class crud_app(views.Lyra.crud_app):
+    class crud_class(views.Lyra.crud_class):
         from django import http
 
         from lyra import models
@@ -105,7 +119,7 @@ class Menu(views.Lyra):
         reservation_model = models.Reservation
 
         def _get_urls(self):
-            patterns = super(Menu.crud_app, self)._get_urls()
+            patterns = super(Menu.crud_class, self)._get_urls()
             patterns += self.urlconf.patterns('', *[
                     self.urlconf.url('^%s/(?P<year>\d{4})/%s(?P<week>\d+)/$' % (_("viikon-varaus"), _("viikko")), 
                                      self.reserve_week,
@@ -114,6 +128,16 @@ class Menu(views.Lyra):
             return patterns
 
         
+        @transaction.commit_on_success
+        def save_week(self, reservations):
+            """saves the new `reservations` in a batch and the changed
+            ones one by one, all in one transaction"""
+            for res in reservations:
+                if res.pk is not None:
+                    res.save(force_update=True)
+            self.reservation_model.objects.bulk_insert(
+                res for res in reservations if res.pk is None)
+
         def reserve_week(self, request, year, week):
             is_forbidden = self.app.check_forbidden(
                 request, ["view", "create"])
@@ -131,40 +155,33 @@ class Menu(views.Lyra):
                                              "namespace": self.app.namespace})
                 return self.reservation_model(**our_kwargs)
 
+            reservations = dict(
+                (res.start, res) for res in self.app.queryset.date_range(
+                    weekdays[0], weekdays[-1] + datetime.timedelta(1)))
+            data = None
             if request.method == "POST":
-                forms = []
-                for i, date in enumerate(monthu):
-                    forms.append(self.day_form(request.POST, 
-                                               date=date, 
-                                               prefix=i, 
-                                               queryset=self.app.queryset,
-                                               new_object=new_object))
-                forms.append(self.friday_form(request.POST, 
-                                              date=fri, 
-                                              prefix=i+1,
-                                              queryset=self.app.queryset,
-                                              new_object=new_object))
-
-                if all(f.is_valid() for f in forms):
-                    for form in forms:
-                        form.save()
-                    return self.http.HttpResponseRedirect(
-                        self.app.reverse("browse_week", {
-                                "year": year, 
-                                "week": week}))
-            else:
-                forms = []
-                for i, date in enumerate(monthu):
-                    forms.append(self.day_form(
-                            date=date, 
-                            prefix=i, 
-                            queryset=self.app.queryset, 
-                            new_object=new_object))
-                forms.append(self.friday_form(
-                        date=fri,
-                        prefix=i+1, 
-                        queryset=self.app.queryset, 
-                        new_object=new_object))
+                data = request.POST
+
+            forms = []
+            for i, date in enumerate(monthu):
+                forms.append(self.day_form(data,
+                                           date=date, 
+                                           prefix=str(i), 
+                                           reservations=reservations,
+                                           new_object=new_object))
+            forms.append(self.friday_form(data,
+                                          date=fri, 
+                                          prefix=str(i+1),
+                                          reservations=reservations,
+                                          new_object=new_object))
+
+            if data is not None and all(f.is_valid() for f in forms):
+                self.save_week([res for form in forms 
+                                for res in form.save(commit=False)])
+                return self.http.HttpResponseRedirect(
+                    self.app.reverse("browse_week", {
+                            "year": year, 
+                            "week": week}))
 
             return self.app.get_response(
                 request,
@@ -173,8 +190,8 @@ class Menu(views.Lyra):
                          "app_name": self.app.get_app_name()})
 
 
-    class browser_app(views.Lyra.browse_app):
-        class week_display(views.Lyra.browse_app.week_display):
+    class browse_class(views.Lyra.browse_class):
+        class week_display(views.Lyra.browse_class.week_display):
             import datetime
 
             DISPLAY_WEEKENDS = False
@@ -195,7 +212,7 @@ class Menu(views.Lyra):
                 }
             
             def process_day_events(self, date, queryset):
-                events = (super(FoodSchedule.browser_app.week_display, 
+                events = (super(Menu.browse_class.week_display, 
                                 self)
                           .process_day_events(date, queryset))
 
@@ -220,42 +237,90 @@ class Menu(views.Lyra):
                 (datetime.time(16, 0), datetime.time(17, 0), u"Päivällinen")
                 ]
 
+            # weeks printed at most in one request
+            MAX_PRINT_WEEKS = 52
+
             def week_table_rows(self, year, week):
-                columns = [[None] + [
-                    dict(zip(self.ROW_LABEL_NAMES, labels)) 
-                    for labels in self.ROW_LABELS]]
-                weekdays = dayplanner.get_weekdays(int(year), int(week))[:5]
-
-                for weekday in weekdays:
-                    col = [{"date": weekday}]
-                    events = self.process_day_events(
-                        weekday, 
-                        self.app.queryset.get_for_date(weekday))
-
-                    for start, stop, label in self.ROW_LABELS: 
-                        es = [e for e in events 
-                             if e["start"].time() >= start
-                             and e["stop"].time() <= stop]
-                        if es:
-                            col.append(es[0])
-                        else:
-                            col.append(None)
-                            
-                    if all(not cell for cell in col[1:]):
-                        col[2] = {
-                            "description": _(u"(Päivä jätetty tyhjäksi)")
-                            }
-
-                    columns.append(col)
-
-                return zip(*columns)
+                return self.weeks_table_rows([(int(year), int(week))])[0]
+
+            def weeks_table_rows(self, weeks):
+                """the print table of each of (year, week) of `weeks`,
+                with the events of all of them fetched in one query"""
+                weeks_days = [dayplanner.get_weekdays(year, week)[:5]
+                              for year, week in weeks]
+                events_by_date = self.app.queryset.by_date(
+                    d for weekdays in weeks_days for d in weekdays)
+                row_starts = [start for start, stop, label 
+                              in self.ROW_LABELS]
+
+                tables = []
+                for weekdays in weeks_days:
+                    columns = [[None] + [
+                        dict(zip(self.ROW_LABEL_NAMES, labels)) 
+                        for labels in self.ROW_LABELS]]
+
+                    for weekday in weekdays:
+                        col = [{"date": weekday}] + [None] * len(
+                            self.ROW_LABELS)
+                        events = self.process_day_events(
+                            weekday, events_by_date[weekday])
+
+                        for e in events:
+                            # the last row beginning before the event
+                            row = bisect.bisect_right(
+                                row_starts, e["start"].time()) - 1
+                            if (row >= 0 and col[row+1] is None
+                                and e["stop"].time() 
+                                <= self.ROW_LABELS[row][1]):
+                                col[row+1] = e
+
+                        if all(not cell for cell in col[1:]):
+                            col[2] = {
+                                "description": _(u"(Päivä jätetty tyhjäksi)")
+                                }
+
+                        columns.append(col)
+                    tables.append(zip(*columns))
+
+                return tables
+
+            def get_print_weeks(self, year, week):
+                try:
+                    count = int(self.request.GET.get("weeks", 1))
+                except ValueError:
+                    count = 1
+                count = max(1, min(count, self.MAX_PRINT_WEEKS))
+
+                monday = dayplanner.get_weekdays(year, week)[0]
+                return [(monday + self.datetime.timedelta(weeks=i))
+                        .isocalendar()[:2]
+                        for i in range(count)]
+
+            def render_print(self, year, week):
+                weeks = self.get_print_weeks(int(year), int(week))
+                first_day = dayplanner.get_weekdays(*weeks[0])[0]
+                last_day = dayplanner.get_weekdays(*weeks[-1])[4]
+
+                return self.app.page_response(
+                    self.request,
+                    ("week_print", weeks[0], len(weeks)),
+                    lambda: self.app.get_response(
+                        self.request,
+                        template="week_print",
+                        context={
+                            "tables": [
+                                {"week": w, "table_rows": rows}
+                                for (y, w), rows 
+                                in zip(weeks, self.weeks_table_rows(weeks))],
+                            }),
+                    span=(first_day, last_day + self.datetime.timedelta(1)))
 
             def get(self, request, year, week, *args, **kwargs):
                 if "print" in request.GET:
-                    kwargs["template_name"] = "week_print"
-                    kwargs["extra_context"] = {
-                        "table_rows": self.week_table_rows(year, week)
-                        }
+                    is_forbidden = self.app.check_forbidden(request, ["view"])
+                    if is_forbidden:
+                        return is_forbidden
+                    return self.render_print(year, week)
 
-                return super(Lyra.browse_app.week_display, self).get(
+                return super(Menu.browse_class.week_display, self).get(
                     request, year, week, *args, **kwargs)
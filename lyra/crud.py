@@ -13,6 +13,8 @@ class CommonContext(object):
 class FormArgumentsMixin(object):
     import datetime
 
+    from lyra import models
+
     def get_initial(self):
         initial = super(FormArgumentsMixin, self).get_initial()
         try:
@@ -29,6 +31,13 @@ class FormArgumentsMixin(object):
 
         return initial
             
+    def form_valid(self, form):
+        try:
+            return super(FormArgumentsMixin, self).form_valid(form)
+        except self.models.ReservationConflict:
+            # booked in the meantime, the form has the error
+            return self.form_invalid(form)
+
     def get_form_kwargs(self):
         args = super(FormArgumentsMixin, self).get_form_kwargs()
         args.update({
@@ -60,11 +69,35 @@ class ReservationDeletion(base.AppAwareTemplate,
                           detail.SingleObjectMixin,
                           CommonContext,
                           edit.FormView):
+    import datetime
+
     permissions = ["view", "delete"]
     template_name = "remove"
     
+    def get_occurrence(self):
+        """the date of the single occurrence of a recurring reservation
+        to remove, given as the `occurrence` parameter, or None to
+        remove the whole reservation"""
+        if getattr(self.object, "recurrence_id", None) is None:
+            return None
+        try:
+            return self.datetime.datetime.strptime(
+                self.request.GET.get("occurrence", u""), "%Y-%m-%d").date()
+        except ValueError:
+            return None
+
     def get_success_url(self):
-        return self.object.get_week_link()
+        occurrence = self.get_occurrence()
+        if occurrence is None:
+            return self.object.get_week_link()
+        year, week, weekday = occurrence.isocalendar()
+        return self.app.reverse("browse_week", {"year": year, "week": week})
+
+    def get_context_data(self, **kwargs):
+        data = super(ReservationDeletion, self).get_context_data(**kwargs)
+        data.update({"occurrence": self.get_occurrence(),
+                     "series_remove_link": self.request.path})
+        return data
 
     def get(self, *args, **kwargs):
         self.object = self.get_object()
@@ -72,7 +105,11 @@ class ReservationDeletion(base.AppAwareTemplate,
 
     def form_valid(self, form):
         self.object = self.get_object()
-        self.object.delete()
+        occurrence = self.get_occurrence()
+        if occurrence is None:
+            self.object.delete()
+        else:
+            self.object.recurrence.leave_out(occurrence)
         return super(ReservationDeletion, self).form_valid(form)
 
     def form_invalid(self, form):
@@ -85,6 +122,9 @@ class ReservationDetail(base.AppAwareTemplate,
                         detail.BaseDetailView):
     template_name = "details"
 
+    def get_queryset(self):
+        return self.app.queryset.for_listing()
+
 class Crud(base.SubApp):
     import datetime
 
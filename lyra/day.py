@@ -19,3 +19,76 @@ class Day(dict):
     
     def is_weekend(self):
         return self["date"].weekday() in [5,6]
+
+class EventView(object):
+    """a planner day's view of a reservation, clipped to the day
+
+    reads through to the reservation, and works out links and
+    permissions only when they are read. supports item access, as
+    the layout code and templates use events like dicts."""
+
+    __slots__ = ("planner", "instance", "start", "stop",
+                 "column", "span", "width", "height", "top", "quarts",
+                 "is_vacant")
+
+    def __init__(self, planner, instance, start, stop):
+        self.planner = planner
+        self.instance = instance
+        self.start = start
+        self.stop = stop
+
+    def __getattr__(self, name):
+        # only called for names not found on the view itself
+        if name in self.__slots__:
+            raise AttributeError(name)
+        return getattr(self.instance, name)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def update(self, values):
+        for key, value in values.iteritems():
+            setattr(self, key, value)
+
+    @property
+    def link(self):
+        return self.instance.get_absolute_url()
+
+    @property
+    def update_link(self):
+        return self.planner.app.reverse("reserve", 
+                                        kwargs={"pk": self.instance.pk})
+
+    @property
+    def remove_link(self):
+        link = self.planner.app.reverse("remove", 
+                                        kwargs={"pk": self.instance.pk})
+        if getattr(self.instance, "occurrence_of", None) is not None:
+            # just this occurrence of the series
+            link += "?occurrence=%s" % self.instance.start.date().isoformat()
+        return link
+
+    @property
+    def can_update(self):
+        return self.planner.permissions.allows("edit", self.instance)
+
+    @property
+    def can_remove(self):
+        return self.planner.permissions.allows("delete", self.instance)
+
+    @property
+    def creator_name(self):
+        return self.instance.get_creator_name()
+
+    @property
+    def one_day(self):
+        return self.instance.one_day()
@@ -1,3 +1,6 @@
+import bisect
+import heapq
+
 from django.views.generic import base as views_base
 
 def quarts(time):
@@ -14,6 +17,85 @@ def get_weekdays(year, week):
         weeks=week)
     return [monday+datetime.timedelta(days=i) for i in range(7)]
 
+def layout_events(events, min_quart, max_quart, quarter_height, 
+                  column_width=None):
+    """lays out a day's `events` into columns in one sweep over their
+    start times, keeping a heap of the columns still in use
+
+    each event is annotated with its column, the number of columns it
+    can span to the right without overlapping anything, and its
+    position, height and, given `column_width`, width. the free time
+    between events in a column becomes vacancy blocks. returns the list
+    of columns, each with its events and vacancies in time order; there
+    is always at least one column."""
+    columns = [[]]
+    in_use = []
+    free = [0]
+
+    for event in sorted(events, key=lambda e: (e["start"], e["stop"])):
+        while in_use and in_use[0][0] <= event["start"]:
+            stop, column = heapq.heappop(in_use)
+            heapq.heappush(free, column)
+        if free:
+            column = heapq.heappop(free)
+        else:
+            column = len(columns)
+            columns.append([])
+        columns[column].append(event)
+        event["column"] = column
+        heapq.heappush(in_use, (event["stop"], column))
+
+    # events in a column do not overlap, so their stops are in order too
+    column_stops = [[e["stop"] for e in column] for column in columns]
+
+    def overlaps_in(column, event):
+        i = bisect.bisect_right(column_stops[column], event["start"])
+        return (i < len(columns[column]) 
+                and columns[column][i]["start"] < event["stop"])
+
+    laid_out = []
+    for column in columns:
+        blocks = []
+        current_quart = min_quart
+        for event in column:
+            span = 1
+            while (event["column"] + span < len(columns)
+                   and not overlaps_in(event["column"] + span, event)):
+                span += 1
+
+            start_quart = quarts(event["start"])
+            event_quarts = quarts(event["stop"]) - start_quart
+            if start_quart > current_quart:
+                blocks.append(vacancy(current_quart, start_quart, 
+                                      min_quart, quarter_height))
+            event.update({
+                    "is_vacant": False,
+                    "span": span,
+                    "height": event_quarts * quarter_height,
+                    "top": (start_quart - min_quart) * quarter_height,
+                    "quarts": event_quarts,
+                    })
+            if column_width is not None:
+                event["width"] = span * column_width
+            blocks.append(event)
+            current_quart = max(current_quart, start_quart + event_quarts)
+
+        if current_quart < max_quart:
+            blocks.append(vacancy(current_quart, max_quart,
+                                  min_quart, quarter_height))
+        laid_out.append(blocks)
+
+    return laid_out
+
+def vacancy(start_quart, stop_quart, min_quart, quarter_height):
+    return {"is_vacant": True,
+            "span": 1,
+            "start_quart": start_quart,
+            "stop_quart": stop_quart,
+            "height": (stop_quart - start_quart) * quarter_height,
+            "top": (start_quart - min_quart) * quarter_height,
+            "quarts": stop_quart - start_quart}
+
 class DayPlanner(views_base.View):
     import datetime
 
@@ -22,11 +104,22 @@ class DayPlanner(views_base.View):
     app = None
 
     QUARTER_HEIGHT = 15 #px
+    # .event_column of lyra.css, margins included
+    COLUMN_WIDTH = 138 #px
     DISPLAY_WEEKENDS = True
     
     day_class = day.Day
+    event_class = day.EventView
 
     template_name = "browse_week"
+    # "html" for the page, "json" for the bare layout
+    output = "html"
+    # view names of the pages linked to, see reverse_page()
+    page_names = {"week": "browse_week", "day": "browse_day"}
+
+    @property
+    def permissions(self):
+        return self.app.permissions(self.request)
 
     def render(self, weekdays, extra_context=None, template_name=None):
         if extra_context is None:
@@ -36,21 +129,70 @@ class DayPlanner(views_base.View):
         if is_forbidden:
             return is_forbidden
 
+        return self.app.page_response(
+            self.request,
+            (template_name or self.template_name, 
+             self.output,
+             weekdays[0], 
+             len(weekdays)),
+            lambda: self.render_page(weekdays, extra_context, template_name),
+            span=(min(weekdays), 
+                  max(weekdays) + self.datetime.timedelta(days=1)))
+
+    def render_page(self, weekdays, extra_context, template_name=None):
+        self.layout(weekdays)
+
+        if self.output == "json":
+            return self.app.json_response(dict(
+                    self.get_data(), **extra_context))
+
+        return self.app.get_response(
+            self.request,
+            template=template_name or self.template_name,
+            context=dict(self.get_context(), **extra_context))
+
+    def get_context(self):
+        return {
+            "days": self.days_columns,
+            "months_mentioned": self.months_mentioned,
+            "years_mentioned": self.years_mentioned,
+            "business_hours": self.business_hours,
+            "hour_height": self.QUARTER_HEIGHT * 4,
+            "table_max_height": (self.QUARTER_HEIGHT * 4 
+                                 * (len(self.business_hours))),
+            "reserve_link": (self.permissions.allows("create") 
+                             and self.app.reverse("reserve")),
+            "app_name": self.app.get_app_desc(),}
+
+    def reverse_page(self, page, kwargs):
+        """the link to the "week" or "day" page of `kwargs`"""
+        return self.app.reverse(self.page_names[page], kwargs)
+
+    def layout(self, weekdays):
         (self.months_mentioned, 
          self.years_mentioned) = self.collect_months_and_years(weekdays)
         
         today = self.datetime.date.today()
+        events_by_date = self.app.queryset.for_listing().by_date(weekdays)
+
+        # process_day_events reads the remembered answers
+        self.permissions.evaluate(
+            ["edit", "delete"],
+            dict((e.pk, e) 
+                 for events in events_by_date.values() 
+                 for e in events).values())
         days = [self.day_class({
                     "date": d, 
                     "events": self.process_day_events(
                         d,
-                        self.app.queryset.get_for_date(date=d)),
-                    "link": self.app.reverse("browse_day", {
+                        events_by_date[d]),
+                    "link": self.reverse_page("day", {
                             "year": d.year,
                             "month": d.month,
                             "day": d.day}),
                     "is_today": d == today})
                 for d in weekdays]
+        self.days = days
         
         self.min_quart, self.max_quart = self.get_quart_bounds(days)
         self.business_hours = self.get_business_hours()
@@ -60,39 +202,41 @@ class DayPlanner(views_base.View):
         else:
             self.days_columns = []
 
-        return self.app.get_response(
-            self.request,
-            template=template_name or self.template_name,
-            context=dict({
-                "days": self.days_columns,
-                "months_mentioned": self.months_mentioned,
-                "years_mentioned": self.years_mentioned,
-                "business_hours": self.business_hours,
-                "hour_height": self.QUARTER_HEIGHT * 4,
-                "table_max_height": (self.QUARTER_HEIGHT * 4 
-                                     * (len(self.business_hours))),
-                "reserve_link": (self.app.user_can_create(self.request) 
-                                 and self.app.reverse("reserve")),
-                "app_name": self.app.get_app_desc(),}, 
-                         **extra_context))
-
-    def annotate_vacancies(self, column):
-        new_column = []
-        current_quart = self.min_quart
+    def get_data(self):
+        """the laid out days as plain data for client side rendering"""
+        return {
+            "days": [{"date": day["date"],
+                      "link": day["link"],
+                      "is_today": day["is_today"],
+                      "columns": [[self.get_block_data(block)
+                                   for block in column]
+                                  for column 
+                                  in day.get("event_columns", [])]}
+                     for day in self.days],
+            "business_hours": self.business_hours,
+            "hour_height": self.QUARTER_HEIGHT * 4,
+            "reserve_link": (self.permissions.allows("create") 
+                             and self.app.reverse("reserve")),
+            }
 
-        for event in column:
-            event_quarts = quarts(event["stop"]) - quarts(event["start"])
-            event.update({
-                    "is_vacant": False,
-                    "height": event_quarts * self.QUARTER_HEIGHT,
-                    "top": ((quarts(event["start"]) - self.min_quart) 
-                            * self.QUARTER_HEIGHT),
-                    "quarts": event_quarts,
-                    })
-            new_column.append(event)
+    def get_block_data(self, block):
+        data = {"top": block["top"], 
+                "height": block["height"]}
+        if block["is_vacant"]:
+            data["is_vacant"] = True
+            return data
+
+        # apps may add plain dicts to the events of a day, so the
+        # keys a reservation has are optional
+        data.update((key, block.get(key)) for key in (
+                "pk", "description", "style", "start", "stop", "span",
+                "link", "creator_name"))
+        if block.get("can_update"):
+            data["update_link"] = block["update_link"]
+        if block.get("can_remove"):
+            data["remove_link"] = block["remove_link"]
+        return data
 
-        return new_column
-    
     def collect_months_and_years(self, weekdays):
         months_mentioned = []
         years_mentioned = []
@@ -116,10 +260,9 @@ class DayPlanner(views_base.View):
         max_quart = 0
 
         for day in days:
-            min_quart = min([min_quart] + [
-                    quarts(e["start"]) for e in day["events"]])
-            max_quart = max([max_quart] + [
-                    quarts(e["stop"]) for e in day["events"]])
+            for e in day["events"]:
+                min_quart = min(min_quart, quarts(e["start"]))
+                max_quart = max(max_quart, quarts(e["stop"]))
     
         min_quart -= min_quart % 4
         max_quart -= max_quart % 4 - 8
@@ -135,66 +278,26 @@ class DayPlanner(views_base.View):
                                                     self.max_quart//4)]
         return business_hours
 
-    def conflicts(self, start1, start2, end1, end2):
-        if start1 < start2 < end1:
-            return True
-        if start1 < end2 < end1:
-            return True
-        return False
-
-    def fits(self, list_, event):
-        return not any(self.conflicts(event["start"], event["stop"], 
-                                      e["start"], e["stop"])
-                       for e in list_)
-
-    def split_columns(self, events):
-        # list of single empty list to ensure every day 
-        # has at least one column
-        columns = [[]]
-        for event in events:
-            for column in columns:
-                if self.fits(column, event):
-                    column.append(event)
-                    break
-            else:
-                columns.append([event])
-                
-        return columns        
-
-    def process_day_events(self, date, queryset):
-        return [dict(vars(e), **{
-                    # multi day events show up multiple times, for each day
-                    "start": max([
-                            e.start, 
-                            self.datetime.datetime.combine(
-                                date, 
-                                self.datetime.time(hour=0, minute=0, second=0))]),
-                    "stop": min([
-                            e.stop,
-                            self.datetime.datetime.combine(
-                                date, 
-                                self.datetime.time(hour=23, minute=59, second=59))]),
-                    "creator_name": e.get_creator_name(),
-                    "update_link": self.app.reverse(
-                        "reserve", 
-                        kwargs={"pk": e.pk}),
-                    "remove_link": self.app.reverse(
-                        "remove", 
-                        kwargs={"pk": e.pk}),
-                    "can_update": self.app.user_can_edit(self.request, e),
-                    "can_remove": self.app.user_can_delete(self.request, e),
-                    "link": e.get_absolute_url(),
-                    "one_day": e.one_day(),
-                    "instance": e,
-                })
+    def process_day_events(self, date, queryset, planner=None):
+        # multi day events show up multiple times, for each day
+        day_start = self.datetime.datetime.combine(
+            date, self.datetime.time(hour=0, minute=0, second=0))
+        day_stop = self.datetime.datetime.combine(
+            date, self.datetime.time(hour=23, minute=59, second=59))
+
+        return [self.event_class(planner or self, e, 
+                                 max(e.start, day_start), 
+                                 min(e.stop, day_stop))
                 for e 
                 in queryset]
 
+    def layout_day(self, events):
+        return layout_events(events, self.min_quart, self.max_quart,
+                             self.QUARTER_HEIGHT, self.COLUMN_WIDTH)
+
     def generate_columns(self, days):
         for day in days:
-            day["event_columns"] = [
-                self.annotate_vacancies(column) 
-                for column in self.split_columns(day["events"])]
+            day["event_columns"] = self.layout_day(day["events"])
         return days
 
 class WeekBrowse(DayPlanner):
@@ -218,11 +321,11 @@ class WeekBrowse(DayPlanner):
             extra_context=dict({
                 "week": week,
                 "year": year,
-                "prev_week_link": self.app.reverse("browse_week", {
+                "prev_week_link": self.reverse_page("week", {
                         "week": prev_week,
                  "year": prev_year,}),
                 "prev_week": prev_week,
-                "next_week_link": self.app.reverse("browse_week", {
+                "next_week_link": self.reverse_page("week", {
                         "week": next_week,
                         "year": next_year}),
                 "next_week": next_week,
@@ -241,14 +344,158 @@ class DayBrowse(DayPlanner):
         return self.render([date], extra_context={
                 "date": date,
                 "next_day": tomorrow,
-                "next_day_link": self.app.reverse(
-                    "browse_day", {"year": tomorrow.year, 
+                "next_day_link": self.reverse_page(
+                    "day", {"year": tomorrow.year, 
                                    "month": tomorrow.month,
                                    "day": tomorrow.day}),
                 "prev_day": yesterday,
-                "prev_day_link": self.app.reverse(
-                    "browse_day", {"year": yesterday.year,
+                "prev_day_link": self.reverse_page(
+                    "day", {"year": yesterday.year,
                                    "month": yesterday.month,
                                    "day": yesterday.day}),
                 })
 
+
+class Resource(object):
+    """a namespace shown as one row of a ResourceGrid; stands in for
+    the planner of its events"""
+
+    def __init__(self, app, request):
+        self.app = app
+        self.namespace = app.namespace
+        self.name = app.get_app_desc()
+        self.permissions = app.permissions(request)
+        self.days = []
+
+class ResourceGrid(DayPlanner):
+    """the days of several namespaces side by side, one row each,
+    fetched with one query and laid out on shared hours
+
+    the namespaces are the `resource` query parameters, by default
+    those registered under the app's app_name. those of other models
+    and those the user may not view are left out."""
+    from lyra import base
+
+    template_name = "browse_grid"
+    page_names = {"week": "browse_grid_week", "day": "browse_grid_day"}
+    resource_class = Resource
+    MAX_RESOURCES = 50
+
+    def reverse_page(self, page, kwargs):
+        link = super(ResourceGrid, self).reverse_page(page, kwargs)
+        query = self.request.GET.urlencode()
+        return query and u"%s?%s" % (link, query) or link
+
+    def get_resources(self):
+        namespaces = (self.request.GET.getlist("resource")
+                      or sorted(self.base.ALL_NAMESPACES.get(
+                    self.app.app_name, {})))
+        resources = []
+        for namespace in namespaces:
+            app = self.base.App.get_by_namespace(namespace)
+            if (app is None 
+                or getattr(app, "model", None) is not self.app.model
+                or namespace in [r.namespace for r in resources]):
+                continue
+            resource = self.resource_class(app, self.request)
+            try:
+                if not resource.permissions.has("view"):
+                    continue
+            except app.perm_error:
+                continue
+            resources.append(resource)
+        return resources[:self.MAX_RESOURCES]
+
+    def render(self, weekdays, extra_context=None, template_name=None):
+        is_forbidden = self.app.check_forbidden(self.request, ["view"])
+        if is_forbidden:
+            return is_forbidden
+
+        self.resources = self.get_resources()
+        namespaces = [r.namespace for r in self.resources]
+        return self.app.page_response(
+            self.request,
+            (template_name or self.template_name, 
+             self.output,
+             weekdays[0], 
+             len(weekdays),
+             namespaces),
+            lambda: self.render_page(weekdays, extra_context or {}, 
+                                     template_name),
+            span=(min(weekdays), 
+                  max(weekdays) + self.datetime.timedelta(days=1)),
+            namespaces=namespaces)
+
+    def layout(self, weekdays):
+        (self.months_mentioned, 
+         self.years_mentioned) = self.collect_months_and_years(weekdays)
+
+        today = self.datetime.date.today()
+        by_namespace = (self.app.model.objects.for_listing()
+                        .by_namespace_and_date(
+                [r.namespace for r in self.resources], weekdays))
+
+        for resource in self.resources:
+            events_by_date = by_namespace[resource.namespace]
+            resource.permissions.evaluate(
+                ["edit", "delete"],
+                dict((e.pk, e) 
+                     for events in events_by_date.values() 
+                     for e in events).values())
+            resource.link = resource.app.reverse("browse_week", dict(zip(
+                        ("year", "week"), weekdays[0].isocalendar()[:2])))
+            resource.days = [self.day_class({
+                        "date": d, 
+                        "events": self.process_day_events(
+                            d, events_by_date[d], planner=resource),
+                        "link": resource.app.reverse("browse_day", {
+                                "year": d.year,
+                                "month": d.month,
+                                "day": d.day}),
+                        "is_today": d == today})
+                             for d in weekdays]
+
+        self.days = [self.day_class({
+                    "date": d,
+                    "link": self.reverse_page("day", {
+                            "year": d.year,
+                            "month": d.month,
+                            "day": d.day}),
+                    "is_today": d == today})
+                     for d in weekdays]
+
+        # the same hours on every row
+        self.min_quart, self.max_quart = self.get_quart_bounds(
+            [day for r in self.resources for day in r.days])
+        self.business_hours = self.get_business_hours()
+
+        for resource in self.resources:
+            if self.business_hours:
+                self.generate_columns(resource.days)
+        self.days_columns = self.days
+
+    def get_context(self):
+        return dict(super(ResourceGrid, self).get_context(),
+                    resources=self.resources)
+
+    def get_data(self):
+        data = super(ResourceGrid, self).get_data()
+        data["resources"] = [
+            {"namespace": r.namespace,
+             "name": r.name,
+             "link": r.link,
+             "days": [{"date": day["date"],
+                       "link": day["link"],
+                       "columns": [[self.get_block_data(block)
+                                    for block in column]
+                                   for column 
+                                   in day.get("event_columns", [])]}
+                      for day in r.days]}
+            for r in self.resources]
+        return data
+
+class GridWeekBrowse(ResourceGrid, WeekBrowse):
+    pass
+
+class GridDayBrowse(ResourceGrid, DayBrowse):
+    pass
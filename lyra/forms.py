@@ -4,18 +4,54 @@ import datetime
 
 from django import forms
 from django.db.models import Q
+from django.utils import dates
 from django.utils.translation import ugettext_lazy as _
 from django.core import exceptions as django_exceptions
 
 from lyra import models
 
 class Reservation(forms.ModelForm):
+    # refuse times at which the person has reservations in other
+    # namespaces
+    check_double_booking = False
+
+    repeat = forms.ChoiceField(
+        label=_(u"Repeats"),
+        required=False,
+        choices=((u"", _(u"Does not repeat")),) 
+                + models.Recurrence.FREQUENCY_CHOICES)
+    repeat_interval = forms.IntegerField(
+        label=_(u"Every"),
+        required=False,
+        min_value=1,
+        initial=1,
+        help_text=_(u"Days or weeks between the occurrences"))
+    repeat_weekdays = forms.TypedMultipleChoiceField(
+        label=_(u"On weekdays"),
+        required=False,
+        coerce=int,
+        choices=sorted(dates.WEEKDAYS.items()),
+        widget=forms.CheckboxSelectMultiple,
+        help_text=_(u"Weekly only, the weekday of the beginning if none"))
+    repeat_until = forms.DateField(
+        label=_(u"Repeats until"),
+        required=False,
+        help_text=_(u"Repeats for good if empty"))
+
     def __init__(self, *args, **kwargs):
         self.person = kwargs.pop("person")
         self.namespace = kwargs.pop("namespace")
         self.queryset = kwargs.pop("queryset")
         super(Reservation, self).__init__(*args, **kwargs)
 
+        recurrence = self.instance.recurrence
+        if recurrence is not None:
+            self.initial.update({
+                    "repeat": recurrence.frequency,
+                    "repeat_interval": recurrence.interval,
+                    "repeat_weekdays": recurrence.get_weekdays(),
+                    "repeat_until": recurrence.until})
+
     def clean(self):
         cleaned_data = super(Reservation, self).clean()
 
@@ -27,9 +63,57 @@ class Reservation(forms.ModelForm):
                      .setdefault("start", self.error_class())
                      .append(_("The reservation should begin before it ends")))
 
+            if self.check_double_booking and start <= stop:
+                self.clean_double_booking(start, stop)
+
+            until = cleaned_data.get("repeat_until")
+            if cleaned_data.get("repeat") and until and until < start.date():
+                (self._errors
+                     .setdefault("repeat_until", self.error_class())
+                     .append(_(u"The repetition should end after the "
+                               u"reservation begins")))
+
         return cleaned_data
 
+    def get_candidate(self, start, stop):
+        """an unsaved reservation with the times and the recurrence
+        asked for"""
+        candidate = self.queryset.model(pk=self.instance.pk,
+                                        namespace=self.namespace,
+                                        start=start,
+                                        stop=stop)
+        self.save_recurrence(candidate, commit=False)
+        return candidate
+
+    def clean_double_booking(self, start, stop):
+        """checks each occurrence the reservation would take, as
+        find_conflicts does"""
+        if self.instance.pk:
+            person_id = self.instance.person_id
+        else:
+            person_id = self.person.pk
+        manager = self.queryset.model._default_manager
+        ranges = manager.get_booked_ranges(self.get_candidate(start, stop))
+        if not ranges:
+            return
+        others = [r for r in manager.person_overlaps(
+                person_id, ranges[0][0], max(r[1] for r in ranges),
+                exclude_pk=self.instance.pk, ranges=ranges)
+                  if r.namespace != self.namespace]
+        if others:
+            names = dict(self.queryset.model._meta
+                         .get_field("namespace").choices)
+            (self._errors
+                 .setdefault("start", self.error_class())
+                 .append(_(u"The person already has a reservation at "
+                           u"this time in: %(namespaces)s") % {
+                        "namespaces": u", ".join(sorted(set(
+                                unicode(names.get(r.namespace, r.namespace))
+                                for r in others)))}))
+
     def save(self, commit=True, **kwargs):
+        """with `commit` False, call save_recurrence(obj) before saving
+        the reservation"""
         obj = super(Reservation, self).save(commit=False, **kwargs)
         
         if not obj.pk:
@@ -37,12 +121,32 @@ class Reservation(forms.ModelForm):
             obj.namespace = self.namespace
 
         if commit:
+            self.save_recurrence(obj)
             obj.save()
         return obj            
 
+    def save_recurrence(self, obj, commit=True):
+        """saves the recurrence asked for and attaches it to `obj`;
+        without `commit` it is attached unsaved"""
+        frequency = self.cleaned_data.get("repeat")
+        if not frequency:
+            obj.recurrence = None
+            return
+
+        recurrence = obj.recurrence or models.Recurrence()
+        recurrence.frequency = frequency
+        recurrence.interval = self.cleaned_data.get("repeat_interval") or 1
+        recurrence.weekdays = u",".join(
+            unicode(d) for d in self.cleaned_data.get("repeat_weekdays", []))
+        recurrence.until = self.cleaned_data.get("repeat_until")
+        if commit:
+            recurrence.save()
+        obj.recurrence = recurrence
+
     class Meta:
         model = models.Reservation
-        exclude = ("namespace", "person", "long_description_markup")
+        exclude = ("namespace", "person", "long_description_markup",
+                   "recurrence")
         widgets = {
             "style": forms.Select(attrs={"class": "schedule_style"}),
             }
@@ -61,19 +165,45 @@ class ReservationExclusive(Reservation):
         start_date = cleaned_data.get("start")
         stop_date = cleaned_data.get("stop")
         if start_date and stop_date and self.toggle_enabled(cleaned_data):
-            would_conflict = self.queryset.date_range(
-                start_date, stop_date)
-            if self.instance.pk: 
-                would_conflict = would_conflict.exclude(pk=self.instance.pk)
-            if would_conflict.count():
-                (self._errors
-                     .setdefault("start", self.error_class())
-                     .append(_(u"The reservation would conflict with %(conflict_count)s "
-                               u"other reservations.") % {
-                            "conflict_count": would_conflict}))
+            # save() checks again under the day locks
+            candidate = self.get_candidate(start_date, stop_date)
+            conflict_count = None
+            if candidate.recurrence is None:
+                conflict_count = self.queryset.would_conflict(
+                    start_date, stop_date, exclude_pk=self.instance.pk,
+                    index_only=True)
+            # the index may still hold rows of a rolled back
+            # transaction, so only a clear answer is taken from it
+            if conflict_count is None or conflict_count > 0:
+                conflict_count = len(self.queryset.find_conflicts(candidate))
+            if conflict_count:
+                self.add_conflict_error(conflict_count)
 
         return cleaned_data        
 
+    def add_conflict_error(self, conflict_count):
+        (self._errors
+             .setdefault("start", self.error_class())
+             .append(_(u"The reservation would conflict with %(conflict_count)s "
+                       u"other reservations.") % {
+                    "conflict_count": conflict_count}))
+
+    def save(self, commit=True, **kwargs):
+        """books exclusively if asked to, raising ReservationConflict
+        after adding it to the errors"""
+        if not (commit and self.toggle_enabled(self.cleaned_data)):
+            return super(ReservationExclusive, self).save(commit, **kwargs)
+
+        obj = super(ReservationExclusive, self).save(commit=False, **kwargs)
+        # reserve_exclusive saves the recurrence once no conflict is found
+        self.save_recurrence(obj, commit=False)
+        try:
+            self.queryset.reserve_exclusive(obj)
+        except models.ReservationConflict, exc:
+            self.add_conflict_error(len(exc.conflicts))
+            raise
+        return obj
+
 class ReservationExclusiveEnable(ReservationExclusive):
     exclusive = forms.BooleanField(
         label=_(u"No overlap"),
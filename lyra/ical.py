@@ -0,0 +1,109 @@
+"""iCalendar (RFC 5545) output of reservations, produced one event at
+a time from any iterable of them."""
+
+import datetime
+import time
+
+# octets per line before folding, the line break not included
+LINE_LENGTH = 75
+
+def escape(text):
+    return (text.replace("\\", "\\\\")
+            .replace(";", "\\;")
+            .replace(",", "\\,")
+            .replace("\r\n", "\\n")
+            .replace("\n", "\\n"))
+
+def fold(line):
+    """`line` encoded as UTF-8 and ended with CRLF, folded so no line
+    exceeds LINE_LENGTH octets and no character is split"""
+    data = line.encode("utf-8")
+    parts = []
+    limit = LINE_LENGTH
+    while len(data) > limit:
+        cut = limit
+        while ord(data[cut]) & 0xC0 == 0x80:
+            # continuation byte, back off to the character's start
+            cut -= 1
+        parts.append(data[:cut])
+        data = data[cut:]
+        # folded lines begin with a space
+        limit = LINE_LENGTH - 1
+    parts.append(data)
+    return "\r\n ".join(parts) + "\r\n"
+
+def format_datetime(value):
+    """local "floating" time, as the database keeps it"""
+    return value.strftime("%Y%m%dT%H%M%S")
+
+def format_utc(value):
+    """the server's local time `value` in UTC, as DTSTAMP and
+    LAST-MODIFIED must be"""
+    utc = datetime.datetime.utcfromtimestamp(time.mktime(value.timetuple()))
+    return utc.strftime("%Y%m%dT%H%M%SZ")
+
+# RFC 5545 weekdays, Monday first like date.weekday()
+WEEKDAYS = ("MO", "TU", "WE", "TH", "FR", "SA", "SU")
+
+def recurrence_lines(reservation):
+    """RRULE and EXDATE of a recurring reservation, nothing for others"""
+    recurrence = getattr(reservation, "recurrence", None)
+    if recurrence is None:
+        return
+
+    rule = [u"FREQ=%s" % recurrence.frequency.upper(),
+            u"INTERVAL=%d" % recurrence.interval]
+    if recurrence.frequency == recurrence.WEEKLY:
+        rule.append(u"BYDAY=%s" % u",".join(
+                WEEKDAYS[d] for d in recurrence.get_weekdays(
+                    reservation.start.date())))
+    if recurrence.until is not None:
+        rule.append(u"UNTIL=%s" % format_datetime(
+                datetime.datetime.combine(recurrence.until, 
+                                          datetime.time(23, 59, 59))))
+    yield u"RRULE:%s" % u";".join(rule)
+
+    for day in sorted(recurrence.get_exceptions()):
+        yield u"EXDATE:%s" % format_datetime(
+            datetime.datetime.combine(day, reservation.start.time()))
+
+def event_lines(reservation, uid, stamp, url=None):
+    yield u"BEGIN:VEVENT"
+    yield u"UID:%s" % uid
+    yield u"DTSTAMP:%s" % stamp
+    yield u"DTSTART:%s" % format_datetime(reservation.start)
+    yield u"DTEND:%s" % format_datetime(reservation.stop)
+    for line in recurrence_lines(reservation):
+        yield line
+    yield u"SUMMARY:%s" % escape(reservation.description)
+    if reservation.long_description:
+        yield u"DESCRIPTION:%s" % escape(reservation.long_description)
+    if url:
+        yield u"URL:%s" % url
+    modified = getattr(reservation, "modified", None)
+    if modified is not None:
+        yield u"LAST-MODIFIED:%s" % format_utc(modified)
+    yield u"END:VEVENT"
+
+def calendar(reservations, name, get_uid, get_url=None):
+    """the iCalendar document of `reservations`, one chunk per event
+
+    `get_uid` and `get_url` map a reservation to its globally unique
+    id and its absolute URL"""
+    stamp = format_utc(datetime.datetime.now())
+    yield "".join(fold(line) for line in (
+            u"BEGIN:VCALENDAR",
+            u"VERSION:2.0",
+            u"PRODID:-//Lyra//Reservations//EN",
+            u"CALSCALE:GREGORIAN",
+            u"X-WR-CALNAME:%s" % escape(name)))
+
+    for reservation in reservations:
+        yield "".join(
+            fold(line) for line in event_lines(
+                reservation,
+                get_uid(reservation),
+                stamp,
+                get_url and get_url(reservation)))
+
+    yield fold(u"END:VCALENDAR")
@@ -0,0 +1,196 @@
+"""Bulk import of reservations from CSV and iCalendar files.
+
+Readers yield (line number, row dict) pairs one at a time, so input of
+any size is never held in memory whole. The Importer validates the
+rows and inserts them in batches, each in its own transaction.
+"""
+
+import calendar
+import csv
+import datetime
+import re
+
+from django import forms
+from django.contrib.auth.models import User
+from django.core import exceptions as django_exceptions
+from django.utils.translation import ugettext as _
+
+CSV_COLUMNS = ("start", "stop", "description", "long_description",
+               "person", "person_behalf", "style")
+
+def read_csv(fileobj):
+    """rows of a UTF-8 CSV file with a header line naming some of
+    CSV_COLUMNS"""
+    reader = csv.DictReader(fileobj)
+    for row in reader:
+        yield reader.line_num, dict(
+            (key, value.decode("utf-8"))
+            for key, value in row.iteritems()
+            if key in CSV_COLUMNS and value is not None)
+
+def _unfolded(fileobj):
+    pending = None
+    for line_no, line in enumerate(fileobj, 1):
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t") and pending is not None:
+            pending = (pending[0], pending[1] + line[1:])
+            continue
+        if pending is not None:
+            yield pending
+        pending = (line_no, line)
+    if pending is not None:
+        yield pending
+
+_escaped = re.compile(r"\\(.)")
+
+def _unescape(text):
+    return _escaped.sub(
+        lambda m: "\n" if m.group(1) in "nN" else m.group(1), text)
+
+def _ical_datetime(params, value):
+    if "VALUE=DATE" in params or len(value) == 8:
+        return datetime.datetime.strptime(value, "%Y%m%d")
+    if value.endswith("Z"):
+        utc = datetime.datetime.strptime(value, "%Y%m%dT%H%M%SZ")
+        return datetime.datetime.fromtimestamp(
+            calendar.timegm(utc.timetuple()))
+    # floating or TZID local time, taken as server local time
+    return datetime.datetime.strptime(value, "%Y%m%dT%H%M%S")
+
+def read_ical(fileobj):
+    """rows of the VEVENTs of a UTF-8 iCalendar file"""
+    row = None
+    for line_no, line in _unfolded(fileobj):
+        name, sep, value = line.decode("utf-8").partition(u":")
+        name, sep, params = name.partition(u";")
+        name = name.upper()
+
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            row, row_line = {}, line_no
+        elif row is None:
+            continue
+        elif name == "END" and value.upper() == "VEVENT":
+            yield row_line, row
+            row = None
+        elif name in ("DTSTART", "DTEND"):
+            try:
+                row[name == "DTSTART" and "start" or "stop"] = (
+                    _ical_datetime(params.upper(), value))
+            except ValueError:
+                row["error"] = _(u"Invalid date %s") % value
+        elif name == "SUMMARY":
+            row["description"] = _unescape(value)
+        elif name == "DESCRIPTION":
+            row["long_description"] = _unescape(value)
+
+READERS = {"csv": read_csv, "ics": read_ical}
+
+class Importer(object):
+    """validates rows and inserts them as reservations of `namespace`
+
+    rows without a person are made by `person`. with `exclusive`, rows
+    overlapping an existing reservation or an earlier row are left out
+    as conflicts. after run(), `imported` counts the reservations
+    inserted and `errors` lists (line number, message) pairs of the
+    rows that were not."""
+
+    batch_size = 500
+
+    def __init__(self, model, namespace, person=None, exclusive=False,
+                 batch_size=None):
+        self.model = model
+        self.namespace = namespace
+        self.person = person
+        self.exclusive = exclusive
+        if batch_size:
+            self.batch_size = batch_size
+
+        self.queryset = model.objects.in_namespace(namespace)
+        self.datetime_field = forms.DateTimeField()
+        self._people = {}
+        self.imported = 0
+        self.errors = []
+
+    def get_person(self, username):
+        if not username:
+            if self.person is None:
+                raise django_exceptions.ValidationError(
+                    _(u"No person given"))
+            return self.person
+
+        if username not in self._people:
+            try:
+                self._people[username] = User.objects.get(username=username)
+            except User.DoesNotExist:
+                self._people[username] = None
+
+        person = self._people[username]
+        if person is None:
+            raise django_exceptions.ValidationError(
+                _(u"No such person: %s") % username)
+        return person
+
+    def build(self, row):
+        """the unsaved reservation of `row`, raises ValidationError"""
+        if "error" in row:
+            raise django_exceptions.ValidationError(row["error"])
+
+        values = dict((key, row[key]) for key in (
+                "description", "long_description", "person_behalf",
+                "style")
+                      if row.get(key))
+        for key in ("start", "stop"):
+            values[key] = self.datetime_field.clean(row.get(key))
+        if values["start"] > values["stop"]:
+            raise django_exceptions.ValidationError(
+                _(u"The reservation should begin before it ends"))
+
+        reservation = self.model(namespace=self.namespace,
+                                 person=self.get_person(row.get("person")),
+                                 **values)
+        # the person is checked above, without a query per row
+        reservation.full_clean(exclude=["person"])
+        return reservation
+
+    def run(self, rows):
+        batch = []
+        for line_no, row in rows:
+            try:
+                batch.append((line_no, self.build(row)))
+            except django_exceptions.ValidationError, exc:
+                self.errors.append((line_no, u" ".join(exc.messages)))
+                continue
+
+            if len(batch) >= self.batch_size:
+                self.insert(batch)
+                batch = []
+        if batch:
+            self.insert(batch)
+        return self
+
+    def insert(self, batch):
+        if self.exclusive:
+            batch = self.without_conflicts(batch)
+        self.model.objects.bulk_insert(
+            reservation for line_no, reservation in batch)
+        self.imported += len(batch)
+
+    def without_conflicts(self, batch):
+        """the rows of `batch` overlapping neither a reservation in the
+        database nor an earlier row"""
+        batch = sorted(batch, key=lambda item: (item[1].start, item[1].stop))
+        overlaps = self.queryset.overlaps(
+            (r.start, r.stop) for line_no, r in batch)
+
+        accepted = []
+        # greatest stop among the rows accepted so far
+        reach = None
+        for (line_no, reservation), overlap in zip(batch, overlaps):
+            if overlap or (reach is not None and reach > reservation.start):
+                self.errors.append(
+                    (line_no, _(u"Overlaps another reservation")))
+                continue
+            accepted.append((line_no, reservation))
+            if reach is None or reservation.stop > reach:
+                reach = reservation.stop
+        return accepted
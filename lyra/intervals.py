@@ -0,0 +1,231 @@
+"""In-process interval indexes of reservation (start, stop, pk) triples.
+
+An index is kept per model and namespace once enabled. It is loaded
+lazily on first use and kept current by the model's post_save and
+post_delete signals. Only writes made by this process are seen, so it
+suits deployments where a single process writes a namespace, or where
+the database check at save time has the final word.
+
+Namespaces with recurring reservations get no index, as those overlap
+over and over again.
+"""
+
+import random
+import threading
+
+from django.db.models import signals
+
+from lyra import signals as lyra_signals
+
+class _Node(object):
+    __slots__ = ("key", "priority", "max_stop", "left", "right")
+
+    def __init__(self, key):
+        self.key = key
+        self.priority = random.random()
+        self.max_stop = key[1]
+        self.left = None
+        self.right = None
+
+def _update(node):
+    node.max_stop = node.key[1]
+    for child in (node.left, node.right):
+        if child is not None and child.max_stop > node.max_stop:
+            node.max_stop = child.max_stop
+
+def _rotate_right(node):
+    top = node.left
+    node.left = top.right
+    top.right = node
+    _update(node)
+    _update(top)
+    return top
+
+def _rotate_left(node):
+    top = node.right
+    node.right = top.left
+    top.left = node
+    _update(node)
+    _update(top)
+    return top
+
+def _insert(node, new):
+    if node is None:
+        return new
+    if new.key < node.key:
+        node.left = _insert(node.left, new)
+        if node.left.priority > node.priority:
+            return _rotate_right(node)
+    else:
+        node.right = _insert(node.right, new)
+        if node.right.priority > node.priority:
+            return _rotate_left(node)
+    _update(node)
+    return node
+
+def _remove(node, key):
+    if node is None:
+        raise KeyError(key)
+    if key < node.key:
+        node.left = _remove(node.left, key)
+    elif key > node.key:
+        node.right = _remove(node.right, key)
+    else:
+        if node.left is None:
+            return node.right
+        if node.right is None:
+            return node.left
+        if node.left.priority > node.right.priority:
+            node = _rotate_right(node)
+            node.right = _remove(node.right, key)
+        else:
+            node = _rotate_left(node)
+            node.left = _remove(node.left, key)
+    _update(node)
+    return node
+
+def _overlapping(node, start, stop, found):
+    while node is not None and node.max_stop > start:
+        _overlapping(node.left, start, stop, found)
+        if node.key[0] >= stop:
+            # everything to the right begins later still
+            return
+        if node.key[1] > start:
+            found.append(node.key[2])
+        node = node.right
+
+class IntervalTree(object):
+    """treap of (start, stop, pk) ordered by start, each node
+    augmented with the greatest stop of its subtree
+
+    inserts and removals take O(log n), overlap queries O(log n + k)
+    on average"""
+
+    def __init__(self, intervals=()):
+        self.root = None
+        self.intervals = {}
+        for pk, start, stop in intervals:
+            self.insert(pk, start, stop)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def insert(self, pk, start, stop):
+        if pk in self.intervals:
+            self.discard(pk)
+        self.intervals[pk] = (start, stop)
+        self.root = _insert(self.root, _Node((start, stop, pk)))
+
+    def discard(self, pk):
+        if pk not in self.intervals:
+            return
+        start, stop = self.intervals.pop(pk)
+        self.root = _remove(self.root, (start, stop, pk))
+
+    def overlapping(self, start, stop):
+        """pks of the intervals overlapping the half-open range from
+        `start` up to `stop`, ordered by start"""
+        found = []
+        _overlapping(self.root, start, stop, found)
+        return found
+
+# marks namespaces with too many reservations to keep in memory, or
+# with recurring ones
+UNUSABLE = object()
+
+_lock = threading.RLock()
+_limits = {}
+_indexes = {}
+
+def enable(model, namespace, max_size):
+    """keeps an index of at most `max_size` reservations of
+    `namespace`"""
+    _limits[(model, namespace)] = max_size
+    signals.post_save.connect(_saved, sender=model,
+                              dispatch_uid="lyra_intervals_save")
+    signals.post_delete.connect(_deleted, sender=model,
+                                dispatch_uid="lyra_intervals_delete")
+    lyra_signals.bulk_inserted.connect(_bulk_inserted, sender=model,
+                                       dispatch_uid="lyra_intervals_bulk")
+
+def disable(model, namespace):
+    """stops keeping the index of `namespace`"""
+    with _lock:
+        _limits.pop((model, namespace), None)
+        _indexes.pop((model, namespace), None)
+
+def reset():
+    """forgets all loaded indexes, they are reloaded on next use"""
+    with _lock:
+        _indexes.clear()
+
+def forget(model, namespace):
+    """forgets the loaded index of `namespace`, e.g. after a rollback
+    of writes already applied to it"""
+    with _lock:
+        _indexes.pop((model, namespace), None)
+
+def _recurs(instance):
+    return getattr(instance, "recurrence_id", None) is not None
+
+def _load(model, namespace, max_size):
+    qs = model._default_manager.filter(namespace=namespace)
+    if (qs.has_series() 
+        and qs.filter(recurrence__isnull=False).exists()):
+        return UNUSABLE
+    rows = list(qs.values_list("pk", "start", "stop")[:max_size+1])
+    if len(rows) > max_size:
+        return UNUSABLE
+    return IntervalTree(rows)
+
+def overlapping(model, namespace, start, stop):
+    """pks of the reservations of `namespace` overlapping start-stop,
+    or None if the namespace has no usable index"""
+    key = (model, namespace)
+    if key not in _limits:
+        return None
+
+    with _lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = _load(model, namespace, _limits[key])
+        if index is UNUSABLE:
+            return None
+        return index.overlapping(start, stop)
+
+def _saved(sender, instance, **kwargs):
+    with _lock:
+        for (model, namespace), index in _indexes.items():
+            if model is sender and index is not UNUSABLE:
+                index.discard(instance.pk)
+
+        key = (sender, instance.namespace)
+        index = _indexes.get(key)
+        if index is not None and index is not UNUSABLE:
+            index.insert(instance.pk, instance.start, instance.stop)
+            if len(index) > _limits[key] or _recurs(instance):
+                _indexes[key] = UNUSABLE
+
+def _deleted(sender, instance, **kwargs):
+    with _lock:
+        for (model, namespace), index in _indexes.items():
+            if model is sender and index is not UNUSABLE:
+                index.discard(instance.pk)
+        if _recurs(instance):
+            # may have been the last series, reloaded on next use
+            _indexes.pop((sender, instance.namespace), None)
+
+def _bulk_inserted(sender, instances, **kwargs):
+    with _lock:
+        for instance in instances:
+            key = (sender, instance.namespace)
+            index = _indexes.get(key)
+            if index is None or index is UNUSABLE:
+                continue
+            if instance.pk is None or _recurs(instance):
+                # reloaded on next use
+                del _indexes[key]
+                continue
+            index.insert(instance.pk, instance.start, instance.stop)
+            if len(index) > _limits[key]:
+                _indexes[key] = UNUSABLE
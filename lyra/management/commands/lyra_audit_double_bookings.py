@@ -0,0 +1,46 @@
+import datetime
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management import base
+
+from lyra import models
+
+class Command(base.BaseCommand):
+    args = "start stop"
+    help = ("Lists the reservations of the same person in different "
+            "namespaces that overlap between the start and stop dates "
+            "(YYYY-MM-DD)")
+    option_list = base.BaseCommand.option_list + (
+        make_option("--namespace", action="append",
+                    help="only these namespaces, may be repeated"),
+        )
+
+    def handle(self, start=None, stop=None, **options):
+        if stop is None:
+            raise base.CommandError("give the start and stop dates")
+        try:
+            start, stop = [datetime.datetime.strptime(value, "%Y-%m-%d")
+                           for value in (start, stop)]
+        except ValueError:
+            raise base.CommandError("dates are written as YYYY-MM-DD")
+
+        reservations = models.Reservation.objects.all()
+        if options.get("namespace"):
+            reservations = reservations.filter(
+                namespace__in=options["namespace"])
+        pairs = reservations.double_bookings(start, stop)
+
+        people = User.objects.in_bulk(
+            set(first.person_id for first, second in pairs))
+        for first, second in pairs:
+            self.stdout.write((u"%s: %s\n" % (
+                        people[first.person_id].username,
+                        u" / ".join(u"%s %s-%s %s" % (
+                                r.namespace, 
+                                r.start.strftime("%Y-%m-%d %H:%M"),
+                                r.stop.strftime("%Y-%m-%d %H:%M"),
+                                r.description)
+                                   for r in (first, second))))
+                              .encode("utf-8"))
+        self.stdout.write("%s double bookings\n" % len(pairs))
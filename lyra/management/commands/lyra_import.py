@@ -0,0 +1,60 @@
+import os
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core import urlresolvers
+from django.core.management import base
+
+from lyra import importer
+from lyra import models
+
+class Command(base.BaseCommand):
+    args = "namespace file"
+    help = ("Imports reservations to a namespace from a CSV or an "
+            "iCalendar (.ics) file")
+    option_list = base.BaseCommand.option_list + (
+        make_option("--format", choices=sorted(importer.READERS),
+                    help="csv or ics, by default from the file name"),
+        make_option("--user",
+                    help="username of the person for rows naming none"),
+        make_option("--exclusive", action="store_true", default=False,
+                    help="leave out rows overlapping other reservations"),
+        make_option("--batch-size", type="int", dest="batch_size",
+                    help="rows to insert per transaction"),
+        )
+
+    def handle(self, namespace=None, path=None, **options):
+        if path is None:
+            raise base.CommandError("give a namespace and a file")
+
+        # the namespaces are registered as the URLconf is loaded
+        urlresolvers.get_resolver(None).url_patterns
+        if namespace not in dict(
+            models.Reservation._meta.get_field("namespace").choices):
+            raise base.CommandError("unknown namespace %s" % namespace)
+
+        format = (options.get("format") 
+                  or os.path.splitext(path)[1][1:].lower())
+        if format not in importer.READERS:
+            raise base.CommandError("unknown format %s" % format)
+
+        person = None
+        username = options.get("user")
+        if username:
+            try:
+                person = User.objects.get(username=username)
+            except User.DoesNotExist:
+                raise base.CommandError("no user %s" % username)
+
+        run = importer.Importer(models.Reservation, namespace, 
+                                person=person, 
+                                exclusive=options.get("exclusive"),
+                                batch_size=options.get("batch_size"))
+        with open(path, "rb") as fileobj:
+            run.run(importer.READERS[format](fileobj))
+
+        for line_no, message in sorted(run.errors):
+            self.stderr.write((u"line %s: %s\n" % (line_no, message))
+                              .encode("utf-8"))
+        self.stdout.write("%s reservations imported, %s rows skipped\n" % (
+                run.imported, len(run.errors)))
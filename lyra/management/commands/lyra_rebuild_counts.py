@@ -0,0 +1,19 @@
+from django.core.management import base
+from django.db import transaction
+
+from lyra import models
+
+class Command(base.BaseCommand):
+    args = "[namespace ...]"
+    help = ("Recomputes the materialized per-month reservation counts, "
+            "for the given namespaces or all of them")
+
+    @transaction.commit_on_success
+    def handle(self, *namespaces, **options):
+        reservations = models.Reservation.objects.all()
+        if namespaces:
+            reservations = reservations.filter(namespace__in=namespaces)
+        else:
+            namespaces = None
+
+        models.ReservationCount.objects.rebuild(reservations, namespaces)
@@ -1,13 +1,25 @@
 # -*- encoding: utf-8 -*-
 
+import bisect
+import copy
 import datetime
+import heapq
 
-
+from django.core import exceptions as django_exceptions
+from django.db import connections
 from django.db import models
+from django.db import transaction
+from django.db import IntegrityError
+from django.db.models import F
 from django.db.models import Q
+from django.db.models import signals
+from django.utils import dates
 from django.utils.translation import ugettext_lazy as _
 
 from lyra import base
+from lyra import intervals
+from lyra import pagecache
+from lyra import signals as lyra_signals
 
 STYLE_CHOICES = (
     ("yellow", _(u"Yellow")),
@@ -16,53 +28,735 @@ STYLE_CHOICES = (
     ("red", _(u"Red")),
 )
 
+# series_stop of the series that never end
+SERIES_OPEN_END = datetime.datetime(9999, 12, 31)
+
+def months_spanned(start, stop):
+    """(year, month) pairs of the months overlapped by start-stop"""
+    if stop > start and stop.day == 1 and stop.time() == datetime.time():
+        # ends at midnight, does not overlap that month
+        stop -= datetime.timedelta(1)
+
+    year, month = start.year, start.month
+    while (year, month) <= (stop.year, stop.month):
+        yield year, month
+        month += 1
+        if month > 12:
+            month = 1
+            year += 1
+
+def day_range(date):
+    """the (start, stop) datetimes of `date`"""
+    start = datetime.datetime.combine(date, datetime.time())
+    return start, start + datetime.timedelta(1)
+
+def month_range(year, month):
+    """the (start, stop) datetimes of the month"""
+    if month == 12:
+        return (datetime.datetime(year, month, 1), 
+                datetime.datetime(year+1, 1, 1))
+    return (datetime.datetime(year, month, 1), 
+            datetime.datetime(year, month+1, 1))
+
+def days_spanned(start, stop):
+    """the dates overlapped by start-stop"""
+    last_day = stop.date()
+    if stop > start and stop.time() == datetime.time():
+        # ends at midnight, does not overlap that day
+        last_day -= datetime.timedelta(1)
+
+    day = start.date()
+    while day <= last_day:
+        yield day
+        day += datetime.timedelta(1)
+
+def free_ranges(start, stop, busy):
+    """the gaps between start and stop left by the (start, stop)
+    ranges of `busy`, which are sorted by start"""
+    cursor = start
+    for busy_start, busy_stop in busy:
+        if busy_start > cursor:
+            yield cursor, min(busy_start, stop)
+        cursor = max(cursor, busy_stop)
+        if cursor >= stop:
+            return
+    if cursor < stop:
+        yield cursor, stop
+
+def hour_windows(start, stop, hours):
+    """the ranges between start and stop covered by `hours` of each
+    day, an iterable of hours like DayPlanner.get_business_hours"""
+    runs = []
+    for hour in sorted(set(hours)):
+        if runs and runs[-1][1] == hour:
+            runs[-1][1] = hour + 1
+        else:
+            runs.append([hour, hour + 1])
+
+    day = datetime.datetime.combine(start.date(), datetime.time())
+    while day < stop:
+        for first, last in runs:
+            window_start = max(start, day + datetime.timedelta(hours=first))
+            window_stop = min(stop, day + datetime.timedelta(hours=last))
+            if window_start < window_stop:
+                yield window_start, window_stop
+        day += datetime.timedelta(1)
+
+def intersect_ranges(ranges, other_ranges):
+    """the overlaps of two sorted sequences of disjoint ranges"""
+    ranges = iter(ranges)
+    other_ranges = iter(other_ranges)
+    try:
+        a_start, a_stop = ranges.next()
+        b_start, b_stop = other_ranges.next()
+        while True:
+            if max(a_start, b_start) < min(a_stop, b_stop):
+                yield max(a_start, b_start), min(a_stop, b_stop)
+            if a_stop < b_stop:
+                a_start, a_stop = ranges.next()
+            else:
+                b_start, b_stop = other_ranges.next()
+    except StopIteration:
+        return
+
+def dates_range(dates):
+    """the half-open datetime range covering the sorted `dates`"""
+    return (datetime.datetime.combine(dates[0], datetime.time()),
+            datetime.datetime.combine(dates[-1] + datetime.timedelta(1),
+                                      datetime.time()))
+
+def bucket_by_date(reservations, dates):
+    """maps each of the sorted `dates` to a list of `reservations`
+    overlapping it"""
+    buckets = dict((d, []) for d in dates)
+    one_day = datetime.timedelta(1)
+    for reservation in reservations:
+        day = max(reservation.start.date(), dates[0])
+        last_day = reservation.stop.date()
+        if (reservation.stop.time() == datetime.time()
+            and reservation.stop > reservation.start):
+            # ends at midnight, does not show up on that day
+            last_day -= one_day
+        last_day = min(last_day, dates[-1])
+
+        while day <= last_day:
+            if day in buckets:
+                buckets[day].append(reservation)
+            day += one_day
+    return buckets
+
+def overlap_flags(ranges, others):
+    """whether each of the (start, stop) `ranges` overlaps one of
+    `others`, which are sorted by start, found with a sweep over the
+    start times"""
+    starts = [start for start, stop in others]
+    # greatest stop among the others beginning so far
+    reach = []
+    for start, stop in others:
+        reach.append(reach and max(reach[-1], stop) or stop)
+
+    found = []
+    for start, stop in ranges:
+        # the others beginning before this range ends
+        i = bisect.bisect_left(starts, stop)
+        found.append(bool(i) and reach[i-1] > start)
+    return found
+
+class ReservationConflict(Exception):
+    """a reservation would overlap `conflicts`"""
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        super(ReservationConflict, self).__init__(
+            "overlaps %s reservations" % len(conflicts))
 
 class ReservationQuerySet(base.QuerySet):
+    # set by in_namespace() until filtered further, which lets lookups
+    # answer from the namespace's interval index
+    interval_namespace = None
+
+    def _clone(self, *args, **kwargs):
+        clone = super(ReservationQuerySet, self)._clone(*args, **kwargs)
+        clone.interval_namespace = self.interval_namespace
+        return clone
+
+    def _filter_or_exclude(self, *args, **kwargs):
+        clone = super(ReservationQuerySet, self)._filter_or_exclude(
+            *args, **kwargs)
+        clone.interval_namespace = None
+        return clone
+
+    def complex_filter(self, *args, **kwargs):
+        clone = super(ReservationQuerySet, self).complex_filter(
+            *args, **kwargs)
+        clone.interval_namespace = None
+        return clone
+
+    def extra(self, *args, **kwargs):
+        clone = super(ReservationQuerySet, self).extra(*args, **kwargs)
+        clone.interval_namespace = None
+        return clone
+
+    def in_namespace(self, namespace):
+        clone = self.filter(namespace=namespace)
+        clone.interval_namespace = namespace
+        return clone
+
+    # how far ahead the occurrences of a recurring reservation are
+    # checked when booking it exclusively
+    series_horizon = datetime.timedelta(366)
+
+    def has_series(self):
+        """whether the model can have recurring reservations"""
+        return "recurrence" in [f.name for f in self.model._meta.fields]
+
+    def for_listing(self, brief=False):
+        """loads the creators and recurrences along with the
+        reservations; `brief` also leaves out the long descriptions"""
+        if self.has_series():
+            qs = self.select_related("person", "recurrence")
+        else:
+            qs = self.select_related("person")
+        if brief:
+            qs = qs.defer("long_description")
+        return qs
+
     def get_for_date(self, date):
-        return self.filter(
-            Q(start__year=date.year,
-                start__month=date.month, 
-                start__day=date.day)
-            | Q(stop__year=date.year,
-                stop__month=date.month,
-                stop__day=date.day))
+        """the reservations overlapping `date` as in_window() matches
+        them; occurrences_for_date() gives the occurrences"""
+        return self.in_window(*day_range(date))
+
+    def occurrences_for_date(self, date):
+        """the reservations overlapping `date` as expanded() gives them"""
+        return self.expanded(*day_range(date))
     
     def get_years(self):
         return self.dates("start", "year")
 
     def get_months(self, year):
-        return self.filter(start__year=year).dates("start", "month")
+        return self.filter(
+            start__gte=datetime.datetime(year, 1, 1),
+            start__lt=datetime.datetime(year+1, 1, 1)).dates("start", "month")
     
     def date_range(self, start_date, stop_date):
-        return self.filter(
-                # contained entirely
-                Q(start__gte=start_date,
-                    stop__lte=stop_date)
-                # begins before and ends after begin
-                | Q(start__lt=start_date,
-                    stop__gt=start_date)
-                # begins before end and ends after end
-                | Q(start__lt=stop_date,
-                    stop__gt=stop_date))
-
-    def would_conflict(self, start_date, stop_date):
-        return self.date_range(start_date, stop_date).count()
+        """reservations overlapping the half-open range from
+        `start_date` up to `stop_date`
 
-    def month(self, year, month):
-        month_start = datetime.date(year, month, 1)
-        next_month = month + 1
-        if next_month > 12:
-            next_month = 1
-            next_year = year + 1
+        matches the stored rows, so a recurring reservation only by its
+        first occurrence; see in_window() and expanded()"""
+        return self.filter(start__lt=stop_date, 
+                           stop__gt=start_date)
+
+    def in_window(self, start_date, stop_date):
+        """like date_range(), but a recurring reservation counts as
+        lasting from its first occurrence to the end of its series,
+        so every series with occurrences in the range is included"""
+        if not self.has_series():
+            return self.date_range(start_date, stop_date)
+        return self.filter(Q(recurrence__isnull=True, stop__gt=start_date)
+                           | Q(recurrence__isnull=False, 
+                               series_stop__gt=start_date),
+                           start__lt=stop_date)
+
+    def _occurring(self, start_date, stop_date):
+        # (start, stop, reservation) of each occurrence overlapping
+        # the range, sorted by start
+        rows = list(self.in_window(start_date, stop_date))
+        if not self.has_series():
+            return [(r.start, r.stop, r) for r in rows]
+
+        cache_name = self.model._meta.get_field("recurrence").get_cache_name()
+        missing = set(r.recurrence_id for r in rows
+                      if r.recurrence_id is not None
+                      and not hasattr(r, cache_name))
+        if missing:
+            recurrences = Recurrence.objects.using(self.db).in_bulk(missing)
+            for r in rows:
+                if r.recurrence_id in missing:
+                    r.recurrence = recurrences[r.recurrence_id]
+
+        found = []
+        for r in rows:
+            for start, stop in r.get_occurrence_ranges(start_date, stop_date):
+                found.append((start, stop, r))
+        found.sort(key=lambda item: (item[0], item[1]))
+        return found
+
+    def expanded(self, start_date, stop_date):
+        """the reservations overlapping the range sorted by start, each
+        recurring one replaced by its occurrences in the range, from
+        one query (two when the recurrences were not selected along)"""
+        return [r if getattr(r, "recurrence_id", None) is None 
+                else r.as_occurrence(start, stop)
+                for start, stop, r in self._occurring(start_date, stop_date)]
+
+    def by_date(self, dates):
+        """maps each of `dates` to a list of the reservations overlapping
+        it, fetched with a single range query
+
+        reservations spanning several days are listed on each day,
+        recurring ones as their occurrences"""
+        dates = sorted(dates)
+        if not dates:
+            return {}
+        return bucket_by_date(self.expanded(*dates_range(dates)), dates)
+
+    def by_namespace_and_date(self, namespaces, dates):
+        """maps each of `namespaces` to what by_date() would give for
+        it, all fetched with a single range query"""
+        dates = sorted(dates)
+        found = dict((namespace, []) for namespace in namespaces)
+        if dates and found:
+            for reservation in (self.filter(namespace__in=found.keys())
+                                .expanded(*dates_range(dates))):
+                found[reservation.namespace].append(reservation)
+        return dict((namespace, bucket_by_date(reservations, dates))
+                    for namespace, reservations in found.iteritems())
+
+    def bulk_insert(self, objs):
+        """inserts the unsaved reservations `objs` in one transaction,
+        the caller's if it manages one, sending signals.bulk_inserted
+        instead of post_save for each"""
+        objs = list(objs)
+        if not objs:
+            return objs
+
+        if transaction.is_managed(using=self.db):
+            self._bulk_insert(objs)
+        else:
+            try:
+                with transaction.commit_on_success(using=self.db):
+                    self._bulk_insert(objs)
+            except Exception:
+                # rolled back, the indexes may hold the rows
+                for namespace in set(obj.namespace for obj in objs):
+                    intervals.forget(self.model, namespace)
+                raise
+            pagecache.bump_committed()
+        return objs
+
+    def _bulk_insert(self, objs):
+        if self.has_series():
+            # save() is skipped
+            for obj in objs:
+                obj.series_stop = obj.get_series_stop()
+        if hasattr(self, "bulk_create"):
+            self.bulk_create(objs)
+        else:
+            self._insert_rows(objs)
+        lyra_signals.bulk_inserted.send(sender=self.model, instances=objs)
+
+    def _insert_rows(self, objs):
+        # bulk_create for Djangos without it; leaves the pks unset
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        fields = [f for f in self.model._meta.local_fields 
+                  if not isinstance(f, models.AutoField)]
+        sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+            quote(self.model._meta.db_table),
+            ", ".join(quote(f.column) for f in fields),
+            ", ".join(["%s"] * len(fields)))
+
+        connection.cursor().executemany(sql, [
+                [f.get_db_prep_save(f.pre_save(obj, True), 
+                                    connection=connection)
+                 for f in fields]
+                for obj in objs])
+
+    def overlapping_pks(self, start_date, stop_date, index_only=False):
+        """pks of the reservations overlapping start-stop, from the
+        interval index when there is one; None if there is none and
+        `index_only`"""
+        if self.interval_namespace is not None:
+            pks = intervals.overlapping(self.model, self.interval_namespace,
+                                        start_date, stop_date)
+            if pks is not None:
+                return pks
+        if index_only:
+            return None
+
+        pks, seen = [], set()
+        for start, stop, r in self._occurring(start_date, stop_date):
+            if r.pk not in seen:
+                seen.add(r.pk)
+                pks.append(r.pk)
+        return pks
+
+    def overlaps(self, intervals):
+        """whether each of the (start, stop) `intervals` overlaps a
+        reservation or an occurrence of one, from one range query and
+        a sweep over start times"""
+        intervals = list(intervals)
+        if not intervals:
+            return []
+
+        existing = self._occurring(min(i[0] for i in intervals),
+                                   max(i[1] for i in intervals))
+        return overlap_flags(intervals, 
+                             [(start, stop) for start, stop, r in existing])
+
+    def would_conflict(self, start_date, stop_date, exclude_pk=None,
+                       index_only=False):
+        pks = self.overlapping_pks(start_date, stop_date, index_only)
+        if pks is None:
+            return None
+        return len([pk for pk in pks if pk != exclude_pk])
+
+    def free_slots(self, start, stop, duration, limit=None, 
+                   within_hours=None):
+        """the free ranges of at least `duration` between `start` and
+        `stop`, at most `limit` of them, found with one range query
+
+        with `within_hours`, an iterable of hours of the day as
+        DayPlanner.get_business_hours gives, only those hours count"""
+        busy = [(busy_start, busy_stop) 
+                for busy_start, busy_stop, r in self._occurring(start, stop)]
+        free = free_ranges(start, stop, busy)
+        if within_hours is not None:
+            free = intersect_ranges(
+                free, hour_windows(start, stop, within_hours))
+
+        slots = []
+        for slot_start, slot_stop in free:
+            if slot_stop - slot_start >= duration:
+                slots.append((slot_start, slot_stop))
+                if limit and len(slots) >= limit:
+                    break
+        return slots
+
+    def reserve_exclusive(self, reservation):
+        """saves `reservation` unless it overlaps another reservation
+        of its namespace, in which case ReservationConflict is raised
+        listing them
+
+        concurrent calls are serialized only when their reservations
+        share a day, by locking the ReservationLock rows of the days
+        for the rest of the transaction"""
+        if transaction.is_managed(using=self.db):
+            return self._reserve_exclusive(reservation)
+        try:
+            with transaction.commit_on_success(using=self.db):
+                return self._reserve_exclusive(reservation)
+        except Exception:
+            # rolled back, the index may hold the reservation
+            intervals.forget(self.model, reservation.namespace)
+            raise
+        finally:
+            pagecache.bump_committed()
+
+    def _reserve_exclusive(self, reservation):
+        ranges = self.get_booked_ranges(reservation)
+        if ranges:
+            days = set()
+            for start, stop in ranges:
+                days.update(days_spanned(start, stop))
+            ReservationLock.objects.using(self.db).acquire(
+                reservation.namespace, sorted(days))
+
+            conflicts = self.find_conflicts(reservation, ranges)
+            if conflicts:
+                raise ReservationConflict(conflicts)
+
+        recurrence = getattr(reservation, "recurrence", None)
+        if recurrence is not None:
+            # saved only now, so that a conflict leaves no series behind
+            recurrence.save(using=self.db)
+            reservation.recurrence = recurrence
+        reservation.save(using=self.db)
+        return reservation
+
+    def find_conflicts(self, reservation, ranges=None):
+        """the other reservations of the namespace of `reservation`
+        overlapping the `ranges` it would take, by default those of
+        get_booked_ranges(); its recurrence may be unsaved"""
+        if ranges is None:
+            ranges = self.get_booked_ranges(reservation)
+        if not ranges:
+            return []
+
+        others = (self.model._default_manager.using(self.db)
+                  .filter(namespace=reservation.namespace)
+                  .exclude(pk=reservation.pk)
+                  ._occurring(ranges[0][0], max(r[1] for r in ranges)))
+        conflicts, seen = [], set()
+        for (start, stop, other), overlap in zip(
+            others, overlap_flags([r[:2] for r in others], ranges)):
+            if overlap and other.pk not in seen:
+                seen.add(other.pk)
+                conflicts.append(other)
+        return conflicts
+
+    def get_booked_ranges(self, reservation):
+        """the (start, stop) ranges `reservation` would take, those of
+        its occurrences within series_horizon if it recurs"""
+        if getattr(reservation, "recurrence", None) is None:
+            return [(reservation.start, reservation.stop)]
+        return reservation.get_occurrence_ranges(
+            reservation.start, 
+            min(reservation.get_series_stop(), 
+                reservation.start + self.series_horizon))
+
+    def person_overlaps(self, person, start_date, stop_date, 
+                        exclude_pk=None, ranges=None):
+        """the reservations of `person` overlapping the range, through
+        the (person, start) index; with `ranges`, (start, stop) pairs
+        within it sorted by start, only those overlapping one of them"""
+        occurring = (self.filter(person=person)
+                     .exclude(pk=exclude_pk)
+                     ._occurring(start_date, stop_date))
+        if ranges is None:
+            flags = [True] * len(occurring)
         else:
-            next_year = year
-        month_stop = datetime.date(next_year, next_month, 1) - datetime.timedelta(1)
-        return self.date_range(month_start, month_stop)
+            flags = overlap_flags([o[:2] for o in occurring], ranges)
+        found, seen = [], set()
+        for (start, stop, r), overlap in zip(occurring, flags):
+            if overlap and r.pk not in seen:
+                seen.add(r.pk)
+                found.append(r)
+        return found
+
+    def double_bookings(self, start_date, stop_date):
+        """(earlier, later) pairs of reservations of the same person
+        in different namespaces that overlap within the range, with
+        recurring ones as their occurrences
+
+        found with a sweep over the start times, keeping a heap of the
+        reservations still going on per person. the sweep runs over
+        plain values; only the series and the reservations found are
+        loaded as models, with a query each"""
+        rows = self.in_window(start_date, stop_date)
+        series = {}
+        if self.has_series():
+            series = dict((r.pk, r) for r in (rows
+                                              .filter(recurrence__isnull=False)
+                                              .select_related("recurrence")))
+            rows = rows.filter(recurrence__isnull=True)
+
+        # (start, stop, pk, namespace, person)
+        ranges = [(start, stop, pk, namespace, person_id)
+                  for pk, namespace, person_id, start, stop 
+                  in rows.values_list("pk", "namespace", "person", 
+                                      "start", "stop").order_by()]
+        for r in series.values():
+            ranges.extend((start, stop, r.pk, r.namespace, r.person_id)
+                          for start, stop 
+                          in r.get_occurrence_ranges(start_date, stop_date))
+        ranges.sort()
+
+        going_on = {}
+        found = []
+        for item in ranges:
+            heap = going_on.setdefault(item[4], [])
+            while heap and heap[0][0] <= item[0]:
+                heapq.heappop(heap)
+            for other_stop, other in sorted(heap, key=lambda i: i[1]):
+                if other[3] != item[3]:
+                    found.append((other, item))
+            heapq.heappush(heap, (item[1], item))
+
+        loaded = self.model._default_manager.using(self.db).in_bulk(
+            set(item[2] for pair in found for item in pair) - set(series))
+        loaded.update(series)
+        def instance(item):
+            if item[2] in series:
+                return series[item[2]].as_occurrence(item[0], item[1])
+            return loaded[item[2]]
+        return [(instance(a), instance(b)) for a, b in found]
+
+    def month(self, year, month):
+        """the reservations overlapping the month as in_window()
+        matches them; occurrences_in_month() gives the occurrences"""
+        return self.in_window(*month_range(year, month))
+
+    def occurrences_in_month(self, year, month):
+        """the reservations overlapping the month as expanded() gives
+        them"""
+        return self.expanded(*month_range(year, month))
+
+    def month_counts(self, year):
+        """counts of reservations overlapping each month of `year`,
+        from a single query
+
+        reservations spanning several months count in each of them,
+        recurring ones once for each occurrence"""
+        counts = [0] * 12
+        year_start = datetime.datetime(year, 1, 1)
+        year_stop = datetime.datetime(year+1, 1, 1)
+
+        for start, stop, r in self._occurring(year_start, year_stop):
+            for y, m in months_spanned(max(start, year_start),
+                                       min(stop, year_stop)):
+                counts[m-1] += 1
+
+        return counts
 
     def year(self, year):
-        year_start = datetime.date(year, 1, 1)
-        year_stop = datetime.date(year+1, 1, 1) - datetime.timedelta(1)
-        return self.date_range(year_start, year_stop)
+        """the reservations overlapping the year as in_window() matches
+        them; occurrences_in_year() gives the occurrences"""
+        return self.in_window(datetime.datetime(year, 1, 1),
+                              datetime.datetime(year+1, 1, 1))
+
+    def occurrences_in_year(self, year):
+        """the reservations overlapping the year as expanded() gives
+        them"""
+        return self.expanded(datetime.datetime(year, 1, 1),
+                             datetime.datetime(year+1, 1, 1))
+
+    def series_counts(self, start_date, stop_date):
+        """counts of the occurrences of the recurring reservations
+        overlapping the range, keyed by (year, month) with month 0 for
+        the year totals like ReservationCount, computed on the fly;
+        with `start_date` None from the first occurrences on"""
+        if not self.has_series():
+            return {}
+        series = (self.filter(recurrence__isnull=False)
+                  .select_related("recurrence"))
+        if start_date is None:
+            series = series.filter(start__lt=stop_date)
+        else:
+            series = series.in_window(start_date, stop_date)
+
+        values = []
+        for r in series:
+            lower = r.start if start_date is None else start_date
+            values.extend((None, max(start, lower), min(stop, stop_date))
+                          for start, stop 
+                          in r.get_occurrence_ranges(lower, stop_date))
+        return dict(((year, month), count) for (namespace, year, month), count
+                    in ReservationCount.objects._tally(values).iteritems())
+
+class Recurrence(models.Model):
+    """repeats the reservations pointing to it from their first
+    occurrence on; the occurrences are expanded when read, never
+    stored"""
+    DAILY = "daily"
+    WEEKLY = "weekly"
+    FREQUENCY_CHOICES = (
+        (DAILY, _(u"Daily")),
+        (WEEKLY, _(u"Weekly")),
+    )
+
+    frequency = models.CharField(
+        max_length=16,
+        choices=FREQUENCY_CHOICES,
+        verbose_name=_(u"Repeats"))
+    interval = models.PositiveIntegerField(
+        default=1,
+        verbose_name=_(u"Every"),
+        help_text=_(u"Days or weeks between the occurrences"))
+    weekdays = models.CharField(
+        max_length=32,
+        blank=True,
+        verbose_name=_(u"On weekdays"),
+        help_text=_(u"Weekly only: weekday numbers separated by commas, "
+                    u"Monday being 0. The weekday of the first occurrence "
+                    u"if empty"))
+    until = models.DateField(
+        null=True,
+        blank=True,
+        verbose_name=_(u"Repeats until"),
+        help_text=_(u"Repeats for good if empty"))
+    exceptions = models.TextField(
+        blank=True,
+        verbose_name=_(u"Left out"),
+        help_text=_(u"Dates of the occurrences left out, as YYYY-MM-DD, "
+                    u"one per line"))
+
+    def __unicode__(self):
+        text = self.get_frequency_display()
+        if self.frequency == self.WEEKLY and self.weekdays:
+            text = u"%s (%s)" % (text, u", ".join(
+                    unicode(dates.WEEKDAYS_ABBR[d]) 
+                    for d in self.get_weekdays()))
+        if self.until is not None:
+            text = _(u"%(frequency)s until %(until)s") % {
+                "frequency": text, "until": self.until}
+        return text
+
+    def get_weekdays(self, first=None):
+        """the weekday numbers of a weekly series, which without any
+        given is the weekday of `first`"""
+        weekdays = sorted(set(int(d) for d in self.weekdays.split(",")
+                              if d.strip()))
+        if not weekdays and first is not None:
+            weekdays = [first.weekday()]
+        return weekdays
+
+    def get_exceptions(self):
+        return set(datetime.datetime.strptime(d, "%Y-%m-%d").date()
+                   for d in self.exceptions.split())
+
+    def leave_out(self, date):
+        """adds `date` to the dates left out and saves"""
+        self.exceptions = u"\n".join(sorted(
+                d.isoformat() for d in self.get_exceptions() | set([date])))
+        self.save()
+
+    def clean(self):
+        try:
+            if [d for d in self.get_weekdays() if not 0 <= d <= 6]:
+                raise ValueError
+        except ValueError:
+            raise django_exceptions.ValidationError(
+                _(u"Weekdays should be numbers from 0 to 6"))
+        try:
+            self.get_exceptions()
+        except ValueError:
+            raise django_exceptions.ValidationError(
+                _(u"Dates left out should be written as YYYY-MM-DD"))
+
+    def dates(self, first, from_date, to_date):
+        """the dates of the occurrences from `from_date` up to and
+        including `to_date`, of a series beginning on `first`
+
+        `first` always occurs, as DTSTART does in iCalendar, even when
+        a weekly series is not on its weekday"""
+        from_date = max(from_date, first)
+        if self.until is not None:
+            to_date = min(to_date, self.until)
+        skipped = self.get_exceptions()
+
+        if (from_date == first <= to_date and first not in skipped
+            and self.frequency == self.WEEKLY
+            and first.weekday() not in self.get_weekdays(first)):
+            yield first
+
+        if self.frequency == self.WEEKLY:
+            period = 7 * self.interval
+            origin = first - datetime.timedelta(first.weekday())
+            offsets = [datetime.timedelta(d) 
+                       for d in self.get_weekdays(first)]
+        else:
+            period = self.interval
+            origin = first
+            offsets = [datetime.timedelta(0)]
+
+        # skip straight to the last period beginning by from_date
+        cursor = origin + datetime.timedelta(
+            (from_date - origin).days // period * period)
+        while cursor <= to_date:
+            for offset in offsets:
+                day = cursor + offset
+                if from_date <= day <= to_date and day not in skipped:
+                    yield day
+            cursor += datetime.timedelta(period)
+
+    def save(self, *args, **kwargs):
+        old = None
+        if self.pk is not None:
+            try:
+                old = Recurrence.objects.get(pk=self.pk)
+            except Recurrence.DoesNotExist:
+                pass
+        super(Recurrence, self).save(*args, **kwargs)
+        # their series_stop follows until, their counts the new rule
+        for reservation in self.reservation_set.all():
+            reservation._lyra_counted_recurrence = old
+            reservation.recurrence = self
+            reservation.save()
+
+    class Meta:
+        verbose_name = _(u"Recurrence")
+        verbose_name_plural = _(u"Recurrences")
 
 class Reservation(models.Model):
     namespace = models.CharField(max_length=64, choices=base.choices())
@@ -91,21 +785,65 @@ class Reservation(models.Model):
         max_length=32,
         choices=STYLE_CHOICES,
         default=STYLE_CHOICES[0][0])
+    modified = models.DateTimeField(auto_now=True, editable=False)
+    # start and stop are those of the first occurrence
+    recurrence = models.ForeignKey(Recurrence, null=True, blank=True)
+    # the stop of the last occurrence, for range queries
+    series_stop = models.DateTimeField(null=True, editable=False)
 
     objects = ReservationQuerySet.as_manager()
 
-    @models.permalink
+    # the series of an occurrence made by as_occurrence()
+    occurrence_of = None
+
+    def save(self, *args, **kwargs):
+        if self.occurrence_of is not None:
+            raise ValueError("Occurrences are saved through their series")
+        self.series_stop = self.get_series_stop()
+        super(Reservation, self).save(*args, **kwargs)
+
+    def get_series_stop(self):
+        if self.recurrence is None:
+            return None
+        until = self.recurrence.until
+        if until is None:
+            return SERIES_OPEN_END
+        return (datetime.datetime.combine(until, self.start.time()) 
+                + (self.stop - self.start))
+
+    def get_occurrence_ranges(self, start_date, stop_date):
+        """the (start, stop) of each occurrence overlapping the range"""
+        if self.recurrence is None:
+            occurrences = [(self.start, self.stop)]
+        else:
+            duration = self.stop - self.start
+            time = self.start.time()
+            # those beginning a duration earlier may still overlap
+            occurrences = [
+                (start, start + duration) for start in (
+                    datetime.datetime.combine(day, time)
+                    for day in self.recurrence.dates(
+                        self.start.date(), 
+                        (start_date - duration).date(),
+                        stop_date.date()))]
+        return [(start, stop) for start, stop in occurrences
+                if start < stop_date and stop > start_date]
+
+    def as_occurrence(self, start, stop):
+        """a copy of this recurring reservation at start-stop"""
+        occurrence = copy.copy(self)
+        occurrence.start, occurrence.stop = start, stop
+        occurrence.occurrence_of = self
+        return occurrence
+
     def get_absolute_url(self):
-        return ("%s:details" % self.namespace,
-                (),
-                {"pk": self.pk})
+        return base.reverse("%s:details" % self.namespace,
+                            {"pk": self.pk})
 
-    @models.permalink
     def get_week_link(self):
         year, week, weekday = self.start.isocalendar()
-        return ("%s:browse_week" % self.namespace, 
-                (), 
-                {"year": year, "week": week})
+        return base.reverse("%s:browse_week" % self.namespace, 
+                            {"year": year, "week": week})
 
     def get_creator_name(self):
         if self.person_behalf:
@@ -134,6 +872,253 @@ class Reservation(models.Model):
         verbose_name_plural = _(u"Reservations")
         ordering = ('start', 'id')
 
+class ReservationCountQuerySet(base.QuerySet):
+    YEAR_TOTAL = 0
+
+    def years(self, namespace):
+        """maps years to reservation counts"""
+        return dict(self.filter(namespace=namespace, 
+                                month=self.YEAR_TOTAL,
+                                count__gt=0)
+                    .values_list("year", "count"))
+
+    def months(self, namespace, year):
+        """reservation counts for each month of `year`"""
+        counts = [0] * 12
+        for month, count in (self.filter(namespace=namespace, 
+                                         year=year,
+                                         month__gt=self.YEAR_TOTAL)
+                             .values_list("month", "count")):
+            counts[month-1] = count
+        return counts
+
+    def add(self, namespace, start, stop, delta=1):
+        """adds `delta` to the counts of every month and year the
+        reservation overlaps"""
+        keys = []
+        for year, month in months_spanned(start, stop):
+            if (year, self.YEAR_TOTAL) not in keys:
+                keys.append((year, self.YEAR_TOTAL))
+            keys.append((year, month))
+
+        for year, month in keys:
+            self._add_to(namespace, year, month, delta)
+
+    def _add_to(self, namespace, year, month, delta):
+        counter = self.filter(namespace=namespace, year=year, month=month)
+        if counter.update(count=F("count") + delta) or delta < 0:
+            return
+
+        sid = transaction.savepoint()
+        try:
+            self.create(namespace=namespace, year=year, month=month, 
+                        count=delta)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # created concurrently
+            transaction.savepoint_rollback(sid)
+            counter.update(count=F("count") + delta)
+
+    def add_many(self, values):
+        """like add() for each (namespace, start, stop) of `values`,
+        with one update per month"""
+        for (namespace, year, month), count in sorted(
+            self._tally(values).items()):
+            self._add_to(namespace, year, month, count)
+
+    def replace(self, old_values, new_values):
+        """takes off the counts of `old_values` and adds those of
+        `new_values`, with one update per month whose count changes"""
+        counts = self._tally(new_values)
+        for key, count in self._tally(old_values).iteritems():
+            counts[key] = counts.get(key, 0) - count
+        for (namespace, year, month), delta in sorted(counts.items()):
+            if delta:
+                self._add_to(namespace, year, month, delta)
+
+    def _tally(self, values):
+        counts = {}
+        for namespace, start, stop in values:
+            years = set()
+            for year, month in months_spanned(start, stop):
+                years.add(year)
+                key = (namespace, year, month)
+                counts[key] = counts.get(key, 0) + 1
+            for year in years:
+                key = (namespace, year, self.YEAR_TOTAL)
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def rebuild(self, queryset, namespaces=None):
+        """recomputes the counts of the reservations in `queryset` from
+        scratch, replacing those of `namespaces` (default: all)"""
+        values = []
+        if queryset.has_series():
+            for r in (queryset.filter(recurrence__isnull=False)
+                      .select_related("recurrence")):
+                values.extend(_counted_values(_counted_state(r), 
+                                              r.recurrence))
+            queryset = queryset.filter(recurrence__isnull=True)
+        values.extend(queryset.values_list(
+                "namespace", "start", "stop").order_by())
+        counts = self._tally(values)
+
+        stale = self.all()
+        if namespaces is not None:
+            stale = stale.filter(namespace__in=namespaces)
+        stale.delete()
+        for (namespace, year, month), count in sorted(counts.items()):
+            self.create(namespace=namespace, year=year, month=month,
+                        count=count)
+
+class ReservationCount(models.Model):
+    """materialized reservation counts per namespace and month
+
+    month 0 holds the count for the whole year, since reservations
+    spanning several months would be counted twice in a sum"""
+    namespace = models.CharField(max_length=64)
+    year = models.IntegerField()
+    month = models.IntegerField()
+    count = models.IntegerField(default=0)
+
+    objects = ReservationCountQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (("namespace", "year", "month"),)
+
+class ReservationLockQuerySet(base.QuerySet):
+    def acquire(self, namespace, days):
+        """locks the rows of the distinct, sorted `days` of
+        `namespace` until the end of the transaction, creating the
+        missing ones"""
+        days = [day.toordinal() for day in days]
+        if max(days) - min(days) + 1 == len(days):
+            locks = self.filter(namespace=namespace, 
+                                day__gte=min(days), 
+                                day__lte=max(days))
+        else:
+            # the days of a series, with gaps
+            locks = self.filter(namespace=namespace, day__in=days)
+        # the update takes the row locks; its count tells which exist
+        if locks.update(version=F("version") + 1) == len(days):
+            return
+
+        existing = set(locks.values_list("day", flat=True))
+        for day in days:
+            if day in existing:
+                continue
+            sid = transaction.savepoint(using=self.db)
+            try:
+                self.create(namespace=namespace, day=day)
+                transaction.savepoint_commit(sid, using=self.db)
+            except IntegrityError:
+                # created concurrently
+                transaction.savepoint_rollback(sid, using=self.db)
+        locks.update(version=F("version") + 1)
+
+class ReservationLock(models.Model):
+    """one row per namespace and day, locked by exclusive bookings
+    touching the day"""
+    namespace = models.CharField(max_length=64)
+    # date.toordinal()
+    day = models.IntegerField()
+    version = models.IntegerField(default=0)
+
+    objects = ReservationLockQuerySet.as_manager()
+
+    class Meta:
+        unique_together = (("namespace", "day"),)
+
+def _counted_state(instance):
+    return (instance.namespace, instance.start, instance.stop,
+            getattr(instance, "recurrence_id", None))
+
+def _counted_values(state, recurrence):
+    """(namespace, start, stop) of each occurrence counted for the
+    reservation `state`; an open-ended series counts within
+    ReservationQuerySet.series_horizon of its first occurrence"""
+    namespace, start, stop, recurrence_id = state
+    if recurrence is None:
+        return [(namespace, start, stop)]
+
+    if recurrence.until is None:
+        last = (start + ReservationQuerySet.series_horizon).date()
+    else:
+        last = recurrence.until
+    duration = stop - start
+    return [(namespace, day_start, day_start + duration) 
+            for day_start in (datetime.datetime.combine(day, start.time())
+                              for day in recurrence.dates(
+                    start.date(), start.date(), last))]
+
+def _counted_recurrence(instance, state):
+    """the recurrence `state` was counted by"""
+    if state[3] is None:
+        return None
+    counted = getattr(instance, "_lyra_counted_recurrence", None)
+    if counted is not None:
+        return counted
+    try:
+        if state[3] == instance.recurrence_id:
+            return instance.recurrence
+        return Recurrence.objects.get(pk=state[3])
+    except Recurrence.DoesNotExist:
+        return None
+
+def _remember_counted(sender, instance, **kwargs):
+    instance._lyra_counted = instance.pk and _counted_state(instance)
+
+def _count_saved(sender, instance, created, **kwargs):
+    old = not created and instance._lyra_counted
+    old_recurrence = old and _counted_recurrence(instance, old)
+    new = _counted_state(instance)
+    new_recurrence = new[3] is not None and instance.recurrence or None
+
+    if old != new or old_recurrence is not new_recurrence:
+        ReservationCount.objects.replace(
+            old and _counted_values(old, old_recurrence) or [],
+            _counted_values(new, new_recurrence))
+    instance._lyra_counted = new
+    instance._lyra_counted_recurrence = None
+
+def _remember_deleted(sender, instance, **kwargs):
+    # a cascade from the recurrence deletes it before post_delete
+    if instance._lyra_counted:
+        instance._lyra_counted_recurrence = _counted_recurrence(
+            instance, instance._lyra_counted)
+
+def _count_deleted(sender, instance, **kwargs):
+    if instance._lyra_counted:
+        ReservationCount.objects.replace(
+            _counted_values(instance._lyra_counted, 
+                            _counted_recurrence(instance, 
+                                                instance._lyra_counted)),
+            [])
+
+def _count_bulk_inserted(sender, instances, **kwargs):
+    values = []
+    for instance in instances:
+        state = _counted_state(instance)
+        values.extend(_counted_values(
+                state, state[3] is not None and instance.recurrence or None))
+    ReservationCount.objects.add_many(values)
+
+def track_counts(model):
+    """keeps ReservationCount current for the reservation `model`"""
+    signals.post_init.connect(_remember_counted, sender=model,
+                              dispatch_uid="lyra_counts_init")
+    signals.post_save.connect(_count_saved, sender=model,
+                              dispatch_uid="lyra_counts_save")
+    signals.pre_delete.connect(_remember_deleted, sender=model,
+                               dispatch_uid="lyra_counts_predelete")
+    signals.post_delete.connect(_count_deleted, sender=model,
+                                dispatch_uid="lyra_counts_delete")
+    lyra_signals.bulk_inserted.connect(_count_bulk_inserted, sender=model,
+                                       dispatch_uid="lyra_counts_bulk")
+
+track_counts(Reservation)
+pagecache.track_generations(Reservation)
+
 base.clear_choices(Reservation)
 register_app = base.make_registerer(Reservation)
 ReservationQuerySet.register_app = staticmethod(register_app)
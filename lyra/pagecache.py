@@ -0,0 +1,105 @@
+"""Generation counted page cache keys, one generation per namespace.
+
+Saving or deleting a reservation bumps the generation of its namespace
+from the model signals. Inside a transaction those fire before the
+commit, and a page rendered in between would be cached with the old
+data under the new generation, so such namespaces are bumped again by
+bump_committed(): Lyra calls it after the transactions it commits
+itself and when a request finishes. Code writing reservations in its
+own transactions outside of requests should call it after committing.
+"""
+
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core import signals as core_signals
+from django.core.cache import get_cache
+from django.db import transaction
+from django.db.models import signals
+
+from lyra import signals as lyra_signals
+
+# long enough to outlive the pages, short enough for memcached to
+# read it as a duration
+GENERATION_TIMEOUT = 7 * 24 * 60 * 60
+
+def get_page_cache():
+    return get_cache(getattr(settings, "LYRA_PAGE_CACHE", "default"))
+
+def _generation_key(namespace):
+    return "lyra:generation:%s" % namespace
+
+def _initial_generation():
+    # a generation lost from the cache restarts above every earlier
+    # one, so pages cached for those are never served again
+    return int(time.time() * 1000)
+
+def get_generation(namespace):
+    cache = get_page_cache()
+    key = _generation_key(namespace)
+    generation = cache.get(key)
+    if generation is None:
+        cache.add(key, _initial_generation(), GENERATION_TIMEOUT)
+        generation = cache.get(key)
+    return generation
+
+def bump_generation(namespace):
+    """invalidates every cached page of `namespace`"""
+    cache = get_page_cache()
+    key = _generation_key(namespace)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, _initial_generation(), GENERATION_TIMEOUT)
+
+def page_key(namespace, parts, others=()):
+    """the cache key of a page of `namespace`, which also shows the
+    namespaces `others`"""
+    others = [(other, get_generation(other)) 
+              for other in sorted(set(others)) if other != namespace]
+    if others:
+        parts = (parts, others)
+    digest = hashlib.md5(repr(parts)).hexdigest()
+    return "lyra:page:%s:%s:%s" % (namespace, get_generation(namespace),
+                                   digest)
+
+# namespaces written inside transactions, per thread
+_pending = threading.local()
+
+def _pending_namespaces():
+    if not hasattr(_pending, "namespaces"):
+        _pending.namespaces = set()
+    return _pending.namespaces
+
+def _bump_written(namespace, using=None):
+    bump_generation(namespace)
+    if transaction.is_managed(using=using):
+        _pending_namespaces().add(namespace)
+
+def bump_committed(**kwargs):
+    """bumps again the namespaces written inside transactions since
+    the last call, to be called once they have committed"""
+    namespaces = _pending_namespaces()
+    while namespaces:
+        bump_generation(namespaces.pop())
+
+def _bump(sender, instance, using=None, **kwargs):
+    _bump_written(instance.namespace, using)
+
+def _bump_bulk(sender, instances, **kwargs):
+    for namespace in set(instance.namespace for instance in instances):
+        _bump_written(namespace)
+
+def track_generations(model):
+    """invalidates the cached pages of a namespace whenever a
+    reservation of `model` in it is saved or deleted"""
+    signals.post_save.connect(_bump, sender=model,
+                              dispatch_uid="lyra_pagecache_save")
+    signals.post_delete.connect(_bump, sender=model,
+                                dispatch_uid="lyra_pagecache_delete")
+    lyra_signals.bulk_inserted.connect(_bump_bulk, sender=model,
+                                       dispatch_uid="lyra_pagecache_bulk")
+    core_signals.request_finished.connect(
+        bump_committed, dispatch_uid="lyra_pagecache_committed")
@@ -0,0 +1,72 @@
+import inspect
+
+_takes_object = {}
+
+def takes_object(method):
+    """whether a user_can_* method takes the object after the request,
+    looked up once per function"""
+    func = getattr(method, "im_func", method)
+    try:
+        return _takes_object[func]
+    except KeyError:
+        args, varargs, varkw, defaults = inspect.getargspec(func)
+        if inspect.ismethod(method):
+            args = args[1:]
+        takes = _takes_object[func] = bool(varargs) or len(args) > 1
+        return takes
+
+class PermissionCache(object):
+    """evaluates an app's user_can_* permissions for one request,
+    remembering every answer
+
+    answers of permissions that do not look at the object are shared
+    by all objects"""
+
+    def __init__(self, app, request):
+        self.app = app
+        self.request = request
+        self.answers = {}
+
+    def get_method(self, perm):
+        method = getattr(self.app, "user_can_%s" % perm, None)
+        if method is None:
+            raise ValueError("unknown permission %s" % perm)
+        return method
+
+    def has(self, perm, obj=None):
+        method = self.get_method(perm)
+        with_object = takes_object(method)
+        if with_object:
+            key = (perm, obj is not None and obj.pk)
+        else:
+            key = (perm,)
+
+        try:
+            answer = self.answers[key]
+        except KeyError:
+            try:
+                if with_object:
+                    answer = bool(method(self.request, obj))
+                else:
+                    answer = bool(method(self.request))
+            except self.app.perm_error, exc:
+                answer = exc
+            self.answers[key] = answer
+
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    def allows(self, perm, obj=None):
+        """like has(), but refusals with a reason are just refusals"""
+        try:
+            return self.has(perm, obj)
+        except self.app.perm_error:
+            return False
+
+    def evaluate(self, perms, objs):
+        """maps the pk of each of `objs` to a dict of `perms` to
+        whether they are allowed"""
+        return dict((obj.pk, dict((perm, self.allows(perm, obj))
+                                  for perm in perms))
+                    for obj in objs)
@@ -0,0 +1,5 @@
+from django.dispatch import Signal
+
+# sent by ReservationQuerySet.bulk_insert with the model as sender, in
+# place of post_save for each of `instances`; their pks may be unset
+bulk_inserted = Signal(providing_args=["instances"])
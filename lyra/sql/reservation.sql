@@ -0,0 +1,5 @@
+-- range lookups filter on namespace and compare start and stop
+CREATE INDEX lyra_reservation_namespace_start ON lyra_reservation (namespace, start);
+CREATE INDEX lyra_reservation_namespace_stop ON lyra_reservation (namespace, stop);
+-- reservations of a person across namespaces, see person_overlaps
+CREATE INDEX lyra_reservation_person_start ON lyra_reservation (person_id, start);
@@ -6,6 +6,9 @@ Replace these with more appropriate tests for your application.
 """
 
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.client import RequestFactory
+from django.utils import unittest
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -21,3 +24,1386 @@ Another way to test that 1 + 1 is equal to 2.
 True
 """}
 
+
+import datetime
+import os
+import random
+import re
+import StringIO
+import tempfile
+
+from django.conf import settings
+from django.utils import simplejson
+from django.conf.urls import defaults as urlconf
+from django.contrib.auth.models import User
+from django.db import connection
+from django.core import management
+from django.core import urlresolvers
+
+import lyra
+from lyra import base
+from lyra import models
+from lyra import intervals
+from lyra import day
+from lyra import dayplanner
+from lyra import permissions
+from lyra import pagecache
+from lyra import ical
+from lyra import importer
+from lyra import forms
+from lyra import views
+from lyra.contrib import duty
+from lyra.contrib import food
+from lyra.contrib.duty import models as duty_models
+
+# a second calendar for the resource grid
+rooms = views.Lyra(namespace="rooms")
+oncall = duty.DutyApp(namespace="oncall")
+menu = food.Menu(namespace="menu")
+
+urlpatterns = urlconf.patterns('', *[
+        urlconf.url(r'^lyra/', urlconf.include(lyra.root.urls)),
+        urlconf.url(r'^rooms/', urlconf.include(rooms.urls)),
+        urlconf.url(r'^oncall/', urlconf.include(oncall.urls)),
+        urlconf.url(r'^menu/', urlconf.include(menu.urls)),
+        ])
+
+class ReservationTestCase(TestCase):
+    urls = "lyra.tests"
+
+    def setUp(self):
+        self.user = User.objects.create_user("tester", "tester@example.com", 
+                                             "secret")
+
+    def reserve(self, start, stop, namespace="lyra", **kwargs):
+        return models.Reservation.objects.create(
+            namespace=namespace,
+            person=kwargs.pop("person", self.user),
+            start=start,
+            stop=stop,
+            description=kwargs.pop("description", u"test"),
+            **kwargs)
+
+class ByDateTest(ReservationTestCase):
+    def test_multi_day_reservation_on_every_day(self):
+        multi = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                             datetime.datetime(2011, 3, 9, 11))
+        single = self.reserve(datetime.datetime(2011, 3, 8, 9),
+                              datetime.datetime(2011, 3, 8, 10))
+        days = [datetime.date(2011, 3, d) for d in range(6, 11)]
+
+        with self.assertNumQueries(1):
+            by_date = models.Reservation.objects.by_date(days)
+
+        self.assertEqual(by_date[days[0]], [])
+        self.assertEqual(by_date[days[1]], [multi])
+        self.assertEqual(by_date[days[2]], [multi, single])
+        self.assertEqual(by_date[days[3]], [multi])
+        self.assertEqual(by_date[days[4]], [])
+
+    def test_ending_at_midnight(self):
+        self.reserve(datetime.datetime(2011, 3, 7, 22),
+                     datetime.datetime(2011, 3, 8, 0))
+        days = [datetime.date(2011, 3, 7), datetime.date(2011, 3, 8)]
+
+        by_date = models.Reservation.objects.by_date(days)
+
+        self.assertEqual(len(by_date[days[0]]), 1)
+        self.assertEqual(by_date[days[1]], [])
+
+class WeekViewTest(ReservationTestCase):
+    def test_week_renders_multi_day_events(self):
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 9, 11),
+                     description=u"multi-day")
+
+        response = self.client.get("/lyra/date/2011/week10/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.count("multi-day"), 3)
+
+class MonthViewTest(ReservationTestCase):
+    def test_month_grid_single_query(self):
+        self.reserve(datetime.datetime(2011, 2, 28, 10),
+                     datetime.datetime(2011, 3, 2, 11),
+                     description=u"multi-day")
+        browse = lyra.root.browse
+
+        with self.assertNumQueries(1):
+            weeks = browse.get_month_weeks(2011, 3)
+
+        days = dict((d["date"], d) for w in weeks for d in w["days"])
+        self.assertEqual(len(days[datetime.date(2011, 2, 28)]["events"]), 1)
+        self.assertEqual(len(days[datetime.date(2011, 3, 2)]["events"]), 1)
+        self.assertEqual(days[datetime.date(2011, 3, 3)]["events"], [])
+
+    def test_month_renders(self):
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 11),
+                     description=u"planning")
+
+        response = self.client.get("/lyra/date/2011/3/")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue("planning" in response.content)
+
+class MonthCountsTest(ReservationTestCase):
+    def test_spanning_reservations(self):
+        self.reserve(datetime.datetime(2010, 12, 30, 10),
+                     datetime.datetime(2011, 2, 3, 11))
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 4, 1, 0))
+        self.reserve(datetime.datetime(2011, 12, 31, 10),
+                     datetime.datetime(2012, 1, 1, 10))
+
+        with self.assertNumQueries(1):
+            counts = models.Reservation.objects.month_counts(2011)
+
+        self.assertEqual(counts, [1, 1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 1])
+
+class ReservationCountTest(ReservationTestCase):
+    def test_counts_follow_saves_and_deletes(self):
+        counts = models.ReservationCount.objects
+        res = self.reserve(datetime.datetime(2010, 12, 30, 10),
+                           datetime.datetime(2011, 2, 3, 11))
+
+        self.assertEqual(counts.years("lyra"), {2010: 1, 2011: 1})
+        self.assertEqual(counts.months("lyra", 2011)[:3], [1, 1, 0])
+
+        res.start = datetime.datetime(2011, 1, 30, 10)
+        res.save()
+        self.assertEqual(counts.years("lyra"), {2011: 1})
+        self.assertEqual(counts.months("lyra", 2011)[:3], [1, 1, 0])
+
+        res.delete()
+        self.assertEqual(counts.years("lyra"), {})
+        self.assertEqual(counts.months("lyra", 2011), [0] * 12)
+
+    def test_rebuild(self):
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 11))
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 11),
+                     namespace="other")
+        models.ReservationCount.objects.all().delete()
+
+        from django.core import management
+        management.call_command("lyra_rebuild_counts", "lyra")
+
+        counts = models.ReservationCount.objects
+        self.assertEqual(counts.years("lyra"), {2011: 1})
+        self.assertEqual(counts.years("other"), {})
+
+    def test_index_and_year_views(self):
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 4, 7, 11))
+
+        # the conditional GET state, then the counts
+        with self.assertNumQueries(2):
+            response = self.client.get("/lyra/date/")
+        self.assertTrue("2011" in response.content)
+
+        with self.assertNumQueries(2):
+            response = self.client.get("/lyra/date/2011/")
+        self.assertEqual(response.context["months"][2]["reservation_count"], 1)
+        self.assertEqual(response.context["months"][3]["reservation_count"], 1)
+
+class RangeQueryTest(ReservationTestCase):
+    def test_overlap_is_half_open(self):
+        self.reserve(datetime.datetime(2011, 3, 6, 10),
+                     datetime.datetime(2011, 3, 20, 11),
+                     description=u"enclosing")
+        self.reserve(datetime.datetime(2011, 3, 7, 9),
+                     datetime.datetime(2011, 3, 7, 10),
+                     description=u"adjacent")
+        self.reserve(datetime.datetime(2011, 3, 7, 11),
+                     datetime.datetime(2011, 3, 7, 12),
+                     description=u"adjacent")
+        qs = models.Reservation.objects
+
+        conflicts = qs.date_range(datetime.datetime(2011, 3, 7, 10),
+                                  datetime.datetime(2011, 3, 7, 11))
+        self.assertEqual([r.description for r in conflicts], [u"enclosing"])
+        self.assertEqual(qs.get_for_date(datetime.date(2011, 3, 7)).count(), 3)
+        self.assertEqual(qs.month(2011, 3).count(), 3)
+        self.assertEqual(qs.year(2011).count(), 3)
+        self.assertEqual(qs.would_conflict(datetime.datetime(2011, 3, 5),
+                                           datetime.datetime(2011, 3, 6)), 0)
+
+class OverlapsTest(ReservationTestCase):
+    def test_one_query_for_all_intervals(self):
+        self.reserve(datetime.datetime(2011, 3, 7, 8),
+                     datetime.datetime(2011, 3, 7, 20))
+        self.reserve(datetime.datetime(2011, 3, 7, 9),
+                     datetime.datetime(2011, 3, 7, 10))
+        self.reserve(datetime.datetime(2011, 3, 9, 9),
+                     datetime.datetime(2011, 3, 9, 10))
+
+        intervals = [(datetime.datetime(2011, 3, d, 18),
+                      datetime.datetime(2011, 3, d, 21))
+                     for d in range(6, 11)]
+        with self.assertNumQueries(1):
+            found = models.Reservation.objects.in_namespace("lyra").overlaps(
+                intervals)
+        self.assertEqual(found, [False, True, False, False, False])
+        self.assertEqual(models.Reservation.objects.overlaps([]), [])
+
+class IndexUsageTest(TransactionTestCase):
+    # pysqlite commits before EXPLAIN, so no TestCase transactions here
+
+    @unittest.skipUnless(connection.vendor == "sqlite", 
+                         "EXPLAIN QUERY PLAN is SQLite specific")
+    def test_range_query_uses_index(self):
+        qs = (models.Reservation.objects.filter(namespace="lyra")
+              .date_range(datetime.datetime(2011, 3, 7),
+                          datetime.datetime(2011, 3, 14)))
+        sql, params = qs.query.get_compiler(connection=connection).as_sql()
+
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN QUERY PLAN %s" % sql, params)
+        plan = u" ".join(unicode(row) for row in cursor.fetchall())
+
+        self.assertTrue("lyra_reservation_namespace_" in plan, plan)
+
+class IntervalTreeTest(unittest.TestCase):
+    def test_matches_brute_force(self):
+        base = datetime.datetime(2011, 3, 7)
+        hour = datetime.timedelta(hours=1)
+        spans = {}
+        tree = intervals.IntervalTree()
+        for pk in range(200):
+            start = base + random.randint(0, 100) * hour
+            spans[pk] = (start, start + random.randint(0, 10) * hour)
+            tree.insert(pk, *spans[pk])
+        for pk in range(0, 200, 3):
+            tree.discard(pk)
+            del spans[pk]
+
+        for i in range(50):
+            start = base + random.randint(0, 110) * hour
+            stop = start + random.randint(1, 10) * hour
+            expected = set(pk for pk, (a, b) in spans.items()
+                           if a < stop and b > start)
+            self.assertEqual(set(tree.overlapping(start, stop)), expected)
+
+class IntervalIndexTest(ReservationTestCase):
+    def setUp(self):
+        super(IntervalIndexTest, self).setUp()
+        intervals.enable(models.Reservation, "indexed", 10)
+
+    def tearDown(self):
+        intervals.disable(models.Reservation, "indexed")
+
+    def test_conflicts_answered_from_index(self):
+        qs = models.Reservation.objects.in_namespace("indexed")
+        res = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                           datetime.datetime(2011, 3, 7, 11),
+                           namespace="indexed")
+        self.assertEqual(qs.would_conflict(res.start, res.stop), 1)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(qs.would_conflict(res.start, res.stop), 1)
+            self.assertEqual(qs.would_conflict(res.start, res.stop, 
+                                               exclude_pk=res.pk), 0)
+
+        res.stop = datetime.datetime(2011, 3, 7, 12)
+        res.save()
+        other = self.reserve(datetime.datetime(2011, 3, 7, 11),
+                             datetime.datetime(2011, 3, 7, 13),
+                             namespace="indexed")
+        with self.assertNumQueries(0):
+            self.assertEqual(qs.overlapping_pks(
+                    datetime.datetime(2011, 3, 7, 11, 30),
+                    datetime.datetime(2011, 3, 7, 14)), [res.pk, other.pk])
+
+        res.delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(qs.would_conflict(res.start, res.stop), 1)
+
+    def test_form_confirms_index_conflicts(self):
+        res = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                           datetime.datetime(2011, 3, 7, 11),
+                           namespace="indexed")
+        queryset = models.Reservation.objects.in_namespace("indexed")
+        self.assertEqual(queryset.would_conflict(res.start, res.stop), 1)
+        # gone without the signals, as if rolled back
+        models.Reservation.objects.filter(pk=res.pk).update(
+            namespace="elsewhere")
+
+        form = forms.ReservationExclusiveEnable(
+            {"start": "2011-03-07 10:00", "stop": "2011-03-07 11:00",
+             "description": u"free", "style": "yellow", "exclusive": "on"},
+            person=self.user, namespace="indexed", queryset=queryset)
+        self.assertTrue(form.is_valid())
+
+        intervals.forget(models.Reservation, "indexed")
+        self.assertEqual(queryset.would_conflict(res.start, res.stop), 0)
+
+    def test_filtered_querysets_use_database(self):
+        qs = models.Reservation.objects.in_namespace("indexed")
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 11),
+                     namespace="indexed")
+        other = User.objects.create_user("other", "other@example.com", "x")
+
+        self.assertEqual(qs.filter(person=other).would_conflict(
+                datetime.datetime(2011, 3, 7), 
+                datetime.datetime(2011, 3, 8)), 0)
+
+class LayoutTest(unittest.TestCase):
+    def event(self, start, stop):
+        day = datetime.date(2011, 3, 7)
+        return {"start": datetime.datetime.combine(day, start),
+                "stop": datetime.datetime.combine(day, stop)}
+
+    def test_columns_spans_and_vacancies(self):
+        t = datetime.time
+        long = self.event(t(8), t(12))
+        first = self.event(t(9), t(10))
+        same = self.event(t(9), t(10))
+        late = self.event(t(10), t(11))
+
+        columns = dayplanner.layout_events([late, same, long, first], 
+                                           32, 52, 15)
+
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(long["column"], 0)
+        self.assertEqual(set([first["column"], same["column"]]), set([1, 2]))
+        self.assertEqual(late["column"], 1)
+        self.assertEqual(late["span"], 2)
+        self.assertEqual(long["span"], 1)
+        self.assertFalse("width" in late)
+
+        dayplanner.layout_events([late, same, long, first], 32, 52, 15, 100)
+        self.assertEqual((late["width"], long["width"]), (200, 100))
+
+        self.assertEqual([b["is_vacant"] for b in columns[0]], 
+                         [False, True])
+        self.assertEqual(columns[0][1]["start_quart"], 48)
+        self.assertEqual(columns[0][1]["height"], 4 * 15)
+        self.assertEqual(columns[0][0]["top"], 0)
+        self.assertEqual(columns[1][0]["start_quart"], 32)
+        self.assertEqual(columns[1][0]["stop_quart"], 36)
+
+    def test_empty_day_has_one_vacant_column(self):
+        columns = dayplanner.layout_events([], 32, 40, 15)
+
+        self.assertEqual(len(columns), 1)
+        self.assertEqual(columns[0][0]["height"], 8 * 15)
+
+class ReverseTest(ReservationTestCase):
+    def test_matches_django_reverse(self):
+        routes = [("browse_index", {}),
+                  ("browse_week", {"year": 2011, "week": 10}),
+                  ("browse_day", {"year": 2011, "month": 3, "day": 7}),
+                  ("reserve", {}),
+                  ("reserve", {"pk": 5}),
+                  ("remove", {"pk": 5})]
+
+        for view_name, kwargs in routes * 2:
+            self.assertEqual(
+                lyra.root.reverse(view_name, kwargs),
+                urlresolvers.reverse("lyra:%s" % view_name, kwargs=kwargs))
+
+    def test_reservation_links(self):
+        res = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                           datetime.datetime(2011, 3, 7, 11))
+
+        self.assertEqual(res.get_absolute_url(), 
+                         "/lyra/reservation/%s/" % res.pk)
+        self.assertEqual(res.get_week_link(), "/lyra/date/2011/week10/")
+
+    def test_unmatched_arguments(self):
+        self.assertRaises(urlresolvers.NoReverseMatch,
+                          base.reverse, "lyra:browse_week", {"year": "x"})
+        self.assertRaises(urlresolvers.NoReverseMatch,
+                          base.reverse, "lyra:browse_week", {})
+
+class TemplateCacheTest(ReservationTestCase):
+    def setUp(self):
+        super(TemplateCacheTest, self).setUp()
+        self.old_setting = getattr(settings, "LYRA_CACHE_TEMPLATES", None)
+
+    def tearDown(self):
+        if self.old_setting is None:
+            del settings.LYRA_CACHE_TEMPLATES
+        else:
+            settings.LYRA_CACHE_TEMPLATES = self.old_setting
+        lyra.root._template_cache.clear()
+
+    def test_cached_when_enabled(self):
+        settings.LYRA_CACHE_TEMPLATES = True
+        app = lyra.root
+
+        self.assertTrue(app.select_template(["browse_week"]) 
+                        is app.select_template(["browse_week"]))
+        self.assertFalse(app.select_template(["browse_week"]) 
+                         is app.select_template(["ajax_base", "browse_week"]))
+
+        self.client.login(username="tester", password="secret")
+        self.assertEqual(self.client.get("/lyra/reservation/").status_code,
+                         200)
+        self.assertEqual(self.client.get("/lyra/date/2011/3/").status_code,
+                         200)
+
+    def test_not_cached_when_disabled(self):
+        settings.LYRA_CACHE_TEMPLATES = False
+        app = lyra.root
+
+        self.assertFalse(app.select_template(["browse_week"]) 
+                         is app.select_template(["browse_week"]))
+
+    def test_views_select_through_template_names(self):
+        settings.LYRA_CACHE_TEMPLATES = True
+
+        class Remove(base.AppAwareTemplate):
+            app = lyra.root
+            def get_template_names(self):
+                return ["lyra/remove.html"]
+
+        view = Remove()
+        view.request = RequestFactory().get("/")
+        response = view.render_to_response({})
+        self.assertEqual(response.template_name.name, "lyra/remove.html")
+        self.assertTrue(view.render_to_response({}).template_name
+                        is response.template_name)
+
+class PermissionCacheTest(ReservationTestCase):
+    class App(object):
+        from lyra.views import PermissionError as perm_error
+
+        def __init__(self):
+            self.calls = []
+
+        def user_can_create(self, request):
+            self.calls.append("create")
+            return True
+
+        def user_can_edit(self, request, obj):
+            self.calls.append(("edit", obj.pk))
+            return obj.pk == 1
+
+        def user_can_delete(self, request, obj):
+            self.calls.append(("delete", obj.pk))
+            raise self.perm_error(reason="locked")
+
+    class Obj(object):
+        def __init__(self, pk):
+            self.pk = pk
+
+    def test_batch_evaluation_is_memoized(self):
+        app = self.App()
+        cache = permissions.PermissionCache(app, None)
+        objs = [self.Obj(1), self.Obj(2), self.Obj(1)]
+
+        answers = cache.evaluate(["create", "edit", "delete"], objs)
+        cache.evaluate(["create", "edit"], objs)
+
+        self.assertEqual(answers, {
+                1: {"create": True, "edit": True, "delete": False},
+                2: {"create": True, "edit": False, "delete": False}})
+        self.assertEqual(app.calls, ["create", ("edit", 1), ("delete", 1),
+                                     ("edit", 2), ("delete", 2)])
+        self.assertRaises(app.perm_error, cache.has, "delete", objs[0])
+        self.assertRaises(ValueError, cache.has, "fly")
+
+    def test_week_links_follow_permissions(self):
+        res = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                           datetime.datetime(2011, 3, 8, 11))
+        remove_link = lyra.root.reverse("remove", {"pk": res.pk})
+
+        response = self.client.get("/lyra/date/2011/week10/")
+        self.assertFalse(response.context["reserve_link"])
+        self.assertFalse(remove_link in response.content)
+
+        self.client.login(username="tester", password="secret")
+        response = self.client.get("/lyra/date/2011/week10/")
+        self.assertTrue(response.context["reserve_link"])
+        self.assertEqual(response.content.count(remove_link), 2)
+
+class CreatorQueriesTest(ReservationTestCase):
+    def setUp(self):
+        super(CreatorQueriesTest, self).setUp()
+        for i in range(5):
+            person = User.objects.create_user("person%s" % i, 
+                                              "person%s@example.com" % i,
+                                              "x")
+            self.reserve(datetime.datetime(2011, 3, 7 + i, 10),
+                         datetime.datetime(2011, 3, 7 + i, 11),
+                         person=person)
+
+    def test_week_page_does_not_query_per_creator(self):
+        response = self.client.get("/lyra/date/2011/week10/")
+        self.assertEqual(response.status_code, 200)
+
+        # landing week is different, so count the planner page only:
+        # the conditional GET state, then the reservations
+        with self.assertNumQueries(2):
+            self.client.get("/lyra/date/2011/week10/")
+
+    def test_month_page_does_not_query_per_creator(self):
+        with self.assertNumQueries(2):
+            response = self.client.get("/lyra/date/2011/3/")
+        self.assertEqual(response.status_code, 200)
+
+    def test_detail_page(self):
+        res = models.Reservation.objects.all()[0]
+        with self.assertNumQueries(1):
+            response = self.client.get(res.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+
+class EventViewTest(ReservationTestCase):
+    def test_reads_through_and_clips(self):
+        res = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                           datetime.datetime(2011, 3, 9, 11),
+                           description=u"multi-day")
+        planner = dayplanner.DayPlanner(app=lyra.root)
+        events = planner.process_day_events(datetime.date(2011, 3, 8), [res])
+        event = events[0]
+
+        self.assertTrue(isinstance(event, day.EventView))
+        self.assertEqual(event["start"], datetime.datetime(2011, 3, 8, 0))
+        self.assertEqual(event["stop"], 
+                         datetime.datetime(2011, 3, 8, 23, 59, 59))
+        self.assertEqual(event["description"], u"multi-day")
+        self.assertEqual(event.get("long_description"), u"")
+        self.assertEqual(event.get("nonexistent", 1), 1)
+        self.assertFalse(event["one_day"])
+        self.assertEqual(event["link"], res.get_absolute_url())
+        self.assertRaises(KeyError, lambda: event["top"])
+
+        event.update({"top": 15})
+        self.assertEqual(event["top"], 15)
+        self.assertRaises(AttributeError, setattr, event, "extra", 1)
+
+class PageCacheTest(ReservationTestCase):
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+        lyra.root.page_cache_timeout = 60
+
+    def tearDown(self):
+        del lyra.root.page_cache_timeout
+
+    def test_pages_cached_until_namespace_changes(self):
+        res = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                           datetime.datetime(2011, 3, 7, 11),
+                           description=u"planning")
+        # as if committed
+        pagecache.bump_committed()
+        url = "/lyra/date/2011/week10/"
+        self.assertTrue("planning" in self.client.get(url).content)
+
+        # bypasses the signals, so the cached page is served
+        models.Reservation.objects.filter(pk=res.pk).update(
+            description=u"review")
+        self.assertTrue("planning" in self.client.get(url).content)
+
+        res = models.Reservation.objects.get(pk=res.pk)
+        res.save()
+        self.assertTrue("review" in self.client.get(url).content)
+
+    def test_other_namespace_keeps_cache(self):
+        generation = pagecache.get_generation("lyra")
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 11),
+                     namespace="other")
+        self.assertEqual(pagecache.get_generation("lyra"), generation)
+
+    def test_bumped_again_after_commit(self):
+        pagecache.bump_committed()
+        generation = pagecache.get_generation("lyra")
+        # written inside the test case's transaction
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 11))
+        bumped = pagecache.get_generation("lyra")
+        self.assertTrue(bumped > generation)
+
+        pagecache.bump_committed()
+        self.assertTrue(pagecache.get_generation("lyra") > bumped)
+        bumped = pagecache.get_generation("lyra")
+        pagecache.bump_committed()
+        self.assertEqual(pagecache.get_generation("lyra"), bumped)
+
+class ConditionalGetTest(ReservationTestCase):
+    url = "/lyra/date/2011/week10/"
+
+    def test_not_modified_until_changed(self):
+        res = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                           datetime.datetime(2011, 3, 7, 11))
+        response = self.client.get(self.url)
+        etag = response["ETag"]
+        self.assertTrue(response.has_header("Last-Modified"))
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, "")
+
+        # changes outside of the week do not matter
+        self.reserve(datetime.datetime(2011, 4, 7, 10),
+                     datetime.datetime(2011, 4, 7, 11))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        res.delete()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_not_modified_skips_layout(self):
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 11))
+        etag = self.client.get(self.url)["ETag"]
+
+        planner = dayplanner.DayPlanner
+        render_page = planner.render_page
+        planner.render_page = None
+        try:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        finally:
+            planner.render_page = render_page
+        self.assertEqual(response.status_code, 304)
+
+class JsonViewTest(ReservationTestCase):
+    def setUp(self):
+        super(JsonViewTest, self).setUp()
+        self.res = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                                datetime.datetime(2011, 3, 7, 11),
+                                description=u"planning")
+
+    def get_json(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/json")
+        return simplejson.loads(response.content)
+
+    def test_week(self):
+        data = self.get_json("/lyra/date/2011/week10/json/")
+
+        self.assertEqual(len(data["days"]), 7)
+        monday = data["days"][0]
+        self.assertEqual(monday["date"], "2011-03-07")
+        event = [b for b in monday["columns"][0] 
+                 if not b.get("is_vacant")][0]
+        self.assertEqual(event["description"], u"planning")
+        self.assertEqual(event["link"], self.res.get_absolute_url())
+        self.assertEqual(event["height"],
+                         4 * dayplanner.DayPlanner.QUARTER_HEIGHT)
+        self.assertFalse("update_link" in event)
+        self.assertEqual(data["week"], 10)
+        self.assertEqual(data["days"][1]["columns"][0][0]["is_vacant"], True)
+
+    def test_week_with_plain_events(self):
+        # the menu adds breakfast to the days as a plain dict
+        self.reserve(datetime.datetime(2011, 3, 7, 11),
+                     datetime.datetime(2011, 3, 7, 12, 45),
+                     namespace="menu", description=u"lunch")
+        self.client.login(username="tester", password="secret")
+        data = self.get_json("/menu/date/2011/week10/json/")
+
+        events = [b for b in data["days"][0]["columns"][0]
+                  if not b.get("is_vacant")]
+        self.assertEqual([(e["description"], e["pk"]) for e in events],
+                         [(u"Kaurapuuro", None), (u"lunch", events[1]["pk"])])
+        self.assertTrue(events[1]["pk"])
+        self.assertFalse("remove_link" in events[0])
+
+    def test_day(self):
+        data = self.get_json("/lyra/date/2011/3/7/json/")
+        self.assertEqual(len(data["days"]), 1)
+        self.assertEqual(data["date"], "2011-03-07")
+
+    def test_month(self):
+        data = self.get_json("/lyra/date/2011/3/json/")
+        days = dict((d["date"], d) for w in data["weeks"] for d in w["days"])
+        self.assertEqual(days["2011-03-07"]["events"][0]["pk"], self.res.pk)
+        self.assertEqual(days["2011-03-08"]["events"], [])
+
+class ICalTest(ReservationTestCase):
+    def test_fold_keeps_characters_whole(self):
+        folded = ical.fold(u"SUMMARY:" + u"\xe4" * 100)
+        lines = folded.split("\r\n")
+        self.assertEqual(lines[-1], "")
+        for line in lines[:-1]:
+            self.assertTrue(len(line) <= ical.LINE_LENGTH)
+            line.decode("utf-8")
+        self.assertEqual(
+            "".join(l[1:] if i else l for i, l in enumerate(lines)),
+            (u"SUMMARY:" + u"\xe4" * 100).encode("utf-8"))
+
+    def test_export(self):
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 11),
+                     description=u"planning, review; retro")
+        self.reserve(datetime.datetime(2011, 5, 7, 10),
+                     datetime.datetime(2011, 5, 7, 11),
+                     description=u"outside")
+
+        response = self.client.get(
+            "/lyra/calendar.ics?start=2011-03-01&stop=2011-04-01")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/calendar"))
+        content = response.content
+        self.assertTrue(content.startswith("BEGIN:VCALENDAR\r\n"))
+        self.assertTrue(content.endswith("END:VCALENDAR\r\n"))
+        self.assertEqual(content.count("BEGIN:VEVENT"), 1)
+        self.assertTrue("DTSTART:20110307T100000\r\n" in content)
+        self.assertTrue("SUMMARY:planning\\, review\\; retro\r\n" in content)
+        if views.Lyra.streaming_response_class is None:
+            # written out before the request ended
+            self.assertEqual(response.content, content)
+
+    def test_stamps_in_utc(self):
+        res = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                           datetime.datetime(2011, 3, 7, 11))
+        res.modified = datetime.datetime(2011, 3, 1, 12)
+        modified = ical.format_utc(res.modified)
+        self.assertEqual(len(modified), 16)
+        self.assertTrue(modified.endswith("Z"))
+
+        content = "".join(ical.calendar([res], u"test", lambda r: "uid"))
+        self.assertTrue("LAST-MODIFIED:%s\r\n" % modified in content)
+        self.assertTrue(re.search("DTSTAMP:\\d{8}T\\d{6}Z\r\n", content))
+
+    def test_bad_range(self):
+        response = self.client.get("/lyra/calendar.ics?start=yesterday")
+        self.assertEqual(response.status_code, 400)
+
+class ImportTest(ReservationTestCase):
+    def run_import(self, reader, text, **kwargs):
+        run = importer.Importer(models.Reservation, "lyra", 
+                                person=self.user, **kwargs)
+        return run.run(reader(StringIO.StringIO(text)))
+
+    def test_csv(self):
+        run = self.run_import(importer.read_csv, 
+            "start,stop,description,person\n"
+            "2011-03-07 10:00,2011-03-07 11:00,planning,\n"
+            "2011-03-08 10:00,2011-03-08 11:00,review,tester\n"
+            "2011-03-09 10:00,2011-03-09 09:00,backwards,\n"
+            "2011-03-10 10:00,2011-03-10 11:00,stranger,nobody\n"
+            "tomorrow,2011-03-10 11:00,vague,\n")
+
+        self.assertEqual(run.imported, 2)
+        self.assertEqual([line for line, message in run.errors], [4, 5, 6])
+        self.assertEqual(
+            sorted(models.Reservation.objects.values_list("description", 
+                                                          flat=True)),
+            [u"planning", u"review"])
+        self.assertEqual(
+            models.ReservationCount.objects.months("lyra", 2011)[2], 2)
+
+    def test_ical(self):
+        run = self.run_import(importer.read_ical, 
+            "BEGIN:VCALENDAR\r\n"
+            "BEGIN:VEVENT\r\n"
+            "DTSTART:20110307T100000\r\n"
+            "DTEND:20110307T110000\r\n"
+            "SUMMARY:planning\\, the long\r\n"
+            "  way\r\n"
+            "END:VEVENT\r\n"
+            "BEGIN:VEVENT\r\n"
+            "DTSTART;VALUE=DATE:20110308\r\n"
+            "DTEND;VALUE=DATE:20110309\r\n"
+            "SUMMARY:all day\r\n"
+            "END:VEVENT\r\n"
+            "END:VCALENDAR\r\n")
+
+        self.assertEqual(run.errors, [])
+        planning, all_day = models.Reservation.objects.order_by("start")
+        self.assertEqual(planning.description, u"planning, the long way")
+        self.assertEqual(all_day.stop, datetime.datetime(2011, 3, 9))
+
+    def test_exclusive_batches(self):
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 12))
+        rows = [(1, {"start": datetime.datetime(2011, 3, 7, 11),
+                     "stop": datetime.datetime(2011, 3, 7, 13)}),
+                (2, {"start": datetime.datetime(2011, 3, 7, 12),
+                     "stop": datetime.datetime(2011, 3, 7, 14)}),
+                (3, {"start": datetime.datetime(2011, 3, 7, 13),
+                     "stop": datetime.datetime(2011, 3, 7, 15)}),
+                (4, {"start": datetime.datetime(2011, 3, 7, 14),
+                     "stop": datetime.datetime(2011, 3, 7, 15)})]
+        for line, row in rows:
+            row["description"] = u"row %s" % line
+
+        run = importer.Importer(models.Reservation, "lyra", 
+                                person=self.user, exclusive=True,
+                                batch_size=3)
+        # per batch: the range query, the insert and the updates of
+        # the year's and the month's counts
+        with self.assertNumQueries(8):
+            run.run(rows)
+
+        self.assertEqual(run.imported, 2)
+        self.assertEqual(sorted(line for line, message in run.errors), 
+                         [1, 3])
+
+    def test_bulk_insert_invalidates_pages(self):
+        generation = pagecache.get_generation("lyra")
+        models.Reservation.objects.bulk_insert([models.Reservation(
+                    namespace="lyra", person=self.user, description=u"x",
+                    start=datetime.datetime(2011, 3, 7, 10),
+                    stop=datetime.datetime(2011, 3, 7, 11))])
+        self.assertNotEqual(pagecache.get_generation("lyra"), generation)
+        self.assertEqual(models.ReservationCount.objects.years("lyra"),
+                         {2011: 1})
+
+    def test_command(self):
+        path = tempfile.mktemp(suffix=".csv")
+        with open(path, "w") as f:
+            f.write("start,stop,description\n"
+                    "2011-03-07 10:00,2011-03-07 11:00,planning\n")
+        try:
+            management.call_command("lyra_import", "lyra", path, 
+                                    user="tester", 
+                                    stdout=StringIO.StringIO())
+        finally:
+            os.remove(path)
+        self.assertEqual(models.Reservation.objects.get().person, self.user)
+
+class ExclusiveBookingTest(ReservationTestCase):
+    def new(self, start, stop):
+        return models.Reservation(namespace="lyra", person=self.user,
+                                  description=u"test", start=start, 
+                                  stop=stop)
+
+    def test_reserve_exclusive(self):
+        existing = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                                datetime.datetime(2011, 3, 7, 12))
+        queryset = models.Reservation.objects.in_namespace("lyra")
+
+        try:
+            queryset.reserve_exclusive(
+                self.new(datetime.datetime(2011, 3, 6, 20),
+                         datetime.datetime(2011, 3, 7, 11)))
+        except models.ReservationConflict, exc:
+            self.assertEqual(exc.conflicts, [existing])
+        else:
+            self.fail("booked over an existing reservation")
+
+        res = queryset.reserve_exclusive(
+            self.new(datetime.datetime(2011, 3, 7, 12),
+                     datetime.datetime(2011, 3, 8, 0)))
+        self.assertTrue(res.pk)
+        self.assertEqual(
+            sorted(models.ReservationLock.objects.values_list("day", 
+                                                              flat=True)),
+            [datetime.date(2011, 3, 6).toordinal(),
+             datetime.date(2011, 3, 7).toordinal()])
+
+        # moving a reservation does not conflict with itself
+        res.stop = datetime.datetime(2011, 3, 7, 23)
+        queryset.reserve_exclusive(res)
+
+    def test_form_reports_conflict(self):
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 12))
+        self.client.login(username="tester", password="secret")
+        data = {"start": "2011-03-07 11:00", "stop": "2011-03-07 13:00",
+                "description": u"overlap", "style": "yellow",
+                "exclusive": "on"}
+
+        response = self.client.post("/lyra/reservation/", data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue("conflict with 1" in response.content)
+
+        del data["exclusive"]
+        response = self.client.post("/lyra/reservation/", data)
+        self.assertEqual(response.status_code, 302)
+
+    def test_form_checks_series_without_index(self):
+        queryset = models.Reservation.objects.in_namespace("lyra")
+        data = {"start": "2011-03-07 10:00", "stop": "2011-03-07 11:00",
+                "description": u"weekly", "style": "yellow",
+                "exclusive": "on", "repeat": "weekly", 
+                "repeat_interval": "1"}
+        def form():
+            return forms.ReservationExclusiveEnable(
+                data, person=self.user, namespace="lyra", queryset=queryset)
+
+        self.reserve(datetime.datetime(2011, 3, 14, 10, 30),
+                     datetime.datetime(2011, 3, 14, 12))
+        self.assertFalse(form().is_valid())
+
+        data["start"] = "2011-03-07 12:00"
+        data["stop"] = "2011-03-07 13:00"
+        valid = form()
+        self.assertTrue(valid.is_valid())
+        # booked in the meantime
+        self.reserve(datetime.datetime(2011, 3, 21, 12),
+                     datetime.datetime(2011, 3, 21, 13))
+        self.assertRaises(models.ReservationConflict, valid.save)
+        self.assertTrue("conflict with 1" in unicode(valid.errors["start"]))
+        self.assertEqual(models.Recurrence.objects.count(), 0)
+
+        self.assertFalse(form().is_valid())
+        data["start"] = "2011-03-07 13:00"
+        data["stop"] = "2011-03-07 14:00"
+        valid = form()
+        self.assertTrue(valid.is_valid())
+        valid.save()
+        self.assertEqual(models.Recurrence.objects.count(), 1)
+        self.assertEqual(queryset.get(description=u"weekly").series_stop,
+                         models.SERIES_OPEN_END)
+
+class FreeSlotsTest(ReservationTestCase):
+    def setUp(self):
+        super(FreeSlotsTest, self).setUp()
+        self.reserve(datetime.datetime(2011, 3, 7, 9),
+                     datetime.datetime(2011, 3, 7, 11))
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 12))
+        self.reserve(datetime.datetime(2011, 3, 7, 13),
+                     datetime.datetime(2011, 3, 7, 16))
+        self.queryset = models.Reservation.objects.in_namespace("lyra")
+
+    def test_gaps(self):
+        with self.assertNumQueries(1):
+            slots = self.queryset.free_slots(
+                datetime.datetime(2011, 3, 7, 8),
+                datetime.datetime(2011, 3, 7, 18),
+                datetime.timedelta(hours=1))
+        self.assertEqual(slots, [
+                (datetime.datetime(2011, 3, 7, 8),
+                 datetime.datetime(2011, 3, 7, 9)),
+                (datetime.datetime(2011, 3, 7, 12),
+                 datetime.datetime(2011, 3, 7, 13)),
+                (datetime.datetime(2011, 3, 7, 16),
+                 datetime.datetime(2011, 3, 7, 18))])
+
+    def test_within_hours(self):
+        slots = self.queryset.free_slots(
+            datetime.datetime(2011, 3, 7, 12),
+            datetime.datetime(2011, 3, 9),
+            datetime.timedelta(hours=2), limit=2,
+            within_hours=range(8, 17))
+        # the gaps left on the 7th are too short
+        self.assertEqual(slots, [
+                (datetime.datetime(2011, 3, 8, 8),
+                 datetime.datetime(2011, 3, 8, 17))])
+
+    def test_json_view(self):
+        response = self.client.get("/lyra/date/free/json/", {
+                "start": "2011-03-07", "hours": "2", "limit": "1",
+                "within": "8-17"})
+        self.assertEqual(response.status_code, 200)
+        slots = simplejson.loads(response.content)["slots"]
+        self.assertEqual(len(slots), 1)
+
+        response = self.client.get("/lyra/date/free/", {"hours": "x"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get("/lyra/date/free/").status_code, 
+                         200)
+
+    def test_bad_queries(self):
+        for query in ({"hours": "inf"}, {"hours": "nan"}, {"hours": "0"},
+                      {"start": "9999-12-30"}, {"within": "0-30"},
+                      {"within": "5-5"}, {"within": "-1-5"}):
+            response = self.client.get("/lyra/date/free/", query)
+            self.assertEqual(response.status_code, 400, query)
+
+class RecurrenceTest(ReservationTestCase):
+    def series(self, start, stop, **kwargs):
+        recurrence = models.Recurrence.objects.create(**kwargs)
+        return self.reserve(start, stop, recurrence=recurrence)
+
+    def test_dates(self):
+        weekly = models.Recurrence(frequency=models.Recurrence.WEEKLY,
+                                   interval=2, weekdays=u"0,2",
+                                   until=datetime.date(2011, 4, 30),
+                                   exceptions=u"2011-03-23\n")
+        # a Wednesday
+        first = datetime.date(2011, 3, 9)
+        self.assertEqual(
+            list(weekly.dates(first, datetime.date(2011, 3, 1),
+                              datetime.date(2011, 12, 31))),
+            [datetime.date(2011, 3, d) for d in (9, 21)]
+            + [datetime.date(2011, 4, d) for d in (4, 6, 18, 20)])
+
+        daily = models.Recurrence(frequency=models.Recurrence.DAILY,
+                                  interval=3)
+        self.assertEqual(
+            list(daily.dates(first, datetime.date(2012, 1, 1),
+                             datetime.date(2012, 1, 6))),
+            [datetime.date(2012, 1, 3), datetime.date(2012, 1, 6)])
+
+    def test_first_occurrence_off_weekdays(self):
+        # a Wednesday, repeating on Mondays
+        weekly = models.Recurrence(frequency=models.Recurrence.WEEKLY,
+                                   weekdays=u"0")
+        first = datetime.date(2011, 3, 9)
+        self.assertEqual(
+            list(weekly.dates(first, first, datetime.date(2011, 3, 21))),
+            [datetime.date(2011, 3, d) for d in (9, 14, 21)])
+        self.assertEqual(
+            list(weekly.dates(first, datetime.date(2011, 3, 10), 
+                              datetime.date(2011, 3, 21))),
+            [datetime.date(2011, 3, d) for d in (14, 21)])
+
+        weekly.exceptions = u"2011-03-09"
+        self.assertEqual(
+            list(weekly.dates(first, first, datetime.date(2011, 3, 14))),
+            [datetime.date(2011, 3, 14)])
+
+    def test_counts_and_ranges_see_occurrences(self):
+        self.series(datetime.datetime(2011, 3, 1, 8),
+                    datetime.datetime(2011, 3, 1, 16),
+                    frequency=models.Recurrence.DAILY,
+                    until=datetime.date(2011, 5, 31))
+        self.reserve(datetime.datetime(2011, 4, 5, 9),
+                     datetime.datetime(2011, 4, 5, 10))
+        qs = models.Reservation.objects
+
+        self.assertEqual(models.ReservationCount.objects.years("lyra"), 
+                         {2011: 93})
+        self.assertEqual(models.ReservationCount.objects.months("lyra", 2011),
+                         [0, 0, 31, 31, 31] + [0] * 7)
+        self.assertEqual(qs.series_counts(None, datetime.datetime(2013, 1, 1)),
+                         {(2011, 0): 92, (2011, 3): 31, (2011, 4): 30,
+                          (2011, 5): 31})
+        self.assertEqual(qs.month_counts(2011)[2:6], [31, 31, 31, 0])
+        self.assertEqual(
+            len(qs.occurrences_for_date(datetime.date(2011, 4, 5))), 2)
+        self.assertEqual(len(qs.occurrences_in_month(2011, 5)), 31)
+        self.assertEqual(len(qs.occurrences_in_year(2011)), 93)
+        # the series as one row, also past its first month
+        self.assertEqual(qs.get_for_date(datetime.date(2011, 4, 5)).count(), 2)
+        self.assertEqual(qs.month(2011, 5).count(), 1)
+        self.assertEqual(qs.year(2011).count(), 2)
+
+        response = self.client.get("/lyra/date/")
+        self.assertEqual([y["reservation_count"] 
+                          for y in response.context["years"]
+                          if y["year"].year == 2011], [93])
+        response = self.client.get("/lyra/date/2011/")
+        self.assertEqual([m["reservation_count"] 
+                          for m in response.context["months"]][2:6],
+                         [31, 31, 31, 0])
+
+    def test_counts_follow_series(self):
+        counts = models.ReservationCount.objects
+        series = self.series(datetime.datetime(2011, 3, 30, 8),
+                             datetime.datetime(2011, 3, 30, 16),
+                             frequency=models.Recurrence.DAILY,
+                             until=datetime.date(2011, 4, 2))
+        self.assertEqual(counts.months("lyra", 2011)[2:4], [2, 2])
+
+        series.recurrence.leave_out(datetime.date(2011, 4, 1))
+        self.assertEqual(counts.months("lyra", 2011)[2:4], [2, 1])
+
+        series = models.Reservation.objects.get(pk=series.pk)
+        series.start += datetime.timedelta(1)
+        series.stop += datetime.timedelta(1)
+        series.save()
+        self.assertEqual(counts.months("lyra", 2011)[2:4], [1, 1])
+
+        series.recurrence.until = None
+        series.recurrence.save()
+        # open-ended, counted within the horizon
+        self.assertEqual(counts.years("lyra"), {2011: 275, 2012: 91})
+
+        series.recurrence.delete()
+        self.assertEqual(counts.years("lyra"), {})
+
+        management.call_command("lyra_rebuild_counts")
+        self.assertEqual(counts.years("lyra"), {})
+        self.series(datetime.datetime(2011, 3, 30, 8),
+                    datetime.datetime(2011, 3, 30, 16),
+                    frequency=models.Recurrence.WEEKLY,
+                    until=datetime.date(2011, 4, 30))
+        management.call_command("lyra_rebuild_counts")
+        self.assertEqual(counts.years("lyra"), {2011: 5})
+
+    def test_by_date_expands_within_window(self):
+        series = self.series(datetime.datetime(2011, 1, 3, 10),
+                             datetime.datetime(2011, 1, 3, 11),
+                             frequency=models.Recurrence.WEEKLY,
+                             until=datetime.date(2011, 3, 14))
+        self.assertEqual(series.series_stop, 
+                         datetime.datetime(2011, 3, 14, 11))
+        single = self.reserve(datetime.datetime(2011, 3, 8, 9),
+                              datetime.datetime(2011, 3, 8, 10))
+        days = [datetime.date(2011, 3, d) for d in range(7, 22)]
+
+        with self.assertNumQueries(1):
+            by_date = models.Reservation.objects.for_listing().by_date(days)
+
+        monday = by_date[days[0]][0]
+        self.assertEqual(monday.pk, series.pk)
+        self.assertEqual(monday.occurrence_of, series)
+        self.assertEqual((monday.start, monday.stop),
+                         (datetime.datetime(2011, 3, 7, 10),
+                          datetime.datetime(2011, 3, 7, 11)))
+        self.assertEqual(by_date[days[1]], [single])
+        self.assertEqual(by_date[days[7]][0].start, 
+                         datetime.datetime(2011, 3, 14, 10))
+        # past until
+        self.assertEqual(by_date[days[14]], [])
+        self.assertEqual(sum(len(v) for v in by_date.values()), 3)
+        self.assertRaises(ValueError, monday.save)
+
+    def test_exclusive_booking_sees_occurrences(self):
+        queryset = models.Reservation.objects.in_namespace("lyra")
+        series = self.series(datetime.datetime(2011, 3, 7, 10),
+                             datetime.datetime(2011, 3, 7, 11),
+                             frequency=models.Recurrence.DAILY)
+
+        self.assertEqual(queryset.overlaps([
+                    (datetime.datetime(2012, 6, 1, 10, 30),
+                     datetime.datetime(2012, 6, 1, 12)),
+                    (datetime.datetime(2012, 6, 1, 11),
+                     datetime.datetime(2012, 6, 1, 12))]),
+                         [True, False])
+        self.assertEqual(
+            queryset.would_conflict(datetime.datetime(2011, 3, 1),
+                                    datetime.datetime(2011, 3, 10)), 1)
+
+        weekly = models.Recurrence.objects.create(
+            frequency=models.Recurrence.WEEKLY)
+        new = models.Reservation(namespace="lyra", person=self.user,
+                                 description=u"test", recurrence=weekly,
+                                 start=datetime.datetime(2011, 3, 1, 9),
+                                 stop=datetime.datetime(2011, 3, 1, 11))
+        try:
+            queryset.reserve_exclusive(new)
+        except models.ReservationConflict, exc:
+            self.assertEqual(exc.conflicts, [series])
+        else:
+            self.fail("booked over a recurring reservation")
+
+        new.start = datetime.datetime(2011, 3, 1, 11)
+        new.stop = datetime.datetime(2011, 3, 1, 12)
+        queryset.reserve_exclusive(new)
+        self.assertEqual(new.series_stop, models.SERIES_OPEN_END)
+        # the Tuesdays of the horizon
+        self.assertEqual(models.ReservationLock.objects.count(), 53)
+
+    def test_form_and_feed(self):
+        self.client.login(username="tester", password="secret")
+        response = self.client.post("/lyra/reservation/", {
+                "start": "2011-03-07 10:00", "stop": "2011-03-07 11:00",
+                "description": u"weekly", "style": "yellow",
+                "repeat": "weekly", "repeat_interval": "1",
+                "repeat_weekdays": ["0", "3"], 
+                "repeat_until": "2011-06-30"})
+        self.assertEqual(response.status_code, 302)
+        recurrence = models.Reservation.objects.get().recurrence
+        self.assertEqual(recurrence.weekdays, u"0,3")
+        recurrence.exceptions = u"2011-03-10"
+        recurrence.save()
+
+        response = self.client.get(
+            "/lyra/calendar.ics?start=2011-04-01&stop=2011-05-01")
+        content = response.content
+        self.assertTrue("RRULE:FREQ=WEEKLY;INTERVAL=1;BYDAY=MO,TH;"
+                        "UNTIL=20110630T235959\r\n" in content)
+        self.assertTrue("EXDATE:20110310T100000\r\n" in content)
+
+class ResourceGridTest(ReservationTestCase):
+    def setUp(self):
+        super(ResourceGridTest, self).setUp()
+        self.reserve(datetime.datetime(2011, 3, 7, 10),
+                     datetime.datetime(2011, 3, 7, 11),
+                     description=u"planning")
+        self.reserve(datetime.datetime(2011, 3, 8, 14),
+                     datetime.datetime(2011, 3, 8, 16),
+                     namespace="rooms", description=u"workshop")
+
+    def test_week(self):
+        # the page state and the reservations of both calendars
+        with self.assertNumQueries(2):
+            response = self.client.get("/lyra/date/grid/2011/week10/")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue("planning" in response.content)
+        self.assertTrue("workshop" in response.content)
+        self.assertTrue("/rooms/date/2011/week10/" in response.content)
+
+    def test_json_and_selection(self):
+        response = self.client.get("/lyra/date/grid/2011/week10/json/")
+        data = simplejson.loads(response.content)
+        resources = dict((r["namespace"], r) for r in data["resources"])
+        self.assertEqual(sorted(resources), ["lyra", "rooms"])
+        tuesday = resources["rooms"]["days"][1]
+        event = [b for b in tuesday["columns"][0] 
+                 if not b.get("is_vacant")][0]
+        self.assertEqual(event["description"], u"workshop")
+        self.assertTrue(event["link"].startswith("/rooms/"))
+        # shared hours, so the rows line up
+        self.assertEqual(data["business_hours"], range(10, 18))
+
+        response = self.client.get("/lyra/date/grid/2011/3/8/",
+                                   {"resource": ["rooms", "unknown"]})
+        self.assertTrue("workshop" in response.content)
+        self.assertFalse("planning" in response.content)
+        self.assertTrue("/lyra/date/grid/2011/3/9/?resource=rooms"
+                        in response.content)
+
+    def test_by_namespace_and_date(self):
+        days = [datetime.date(2011, 3, 7), datetime.date(2011, 3, 8)]
+        with self.assertNumQueries(1):
+            found = models.Reservation.objects.by_namespace_and_date(
+                ["lyra", "rooms", "empty"], days)
+        self.assertEqual(len(found["lyra"][days[0]]), 1)
+        self.assertEqual(found["rooms"][days[0]], [])
+        self.assertEqual(len(found["rooms"][days[1]]), 1)
+        self.assertEqual(found["empty"], {days[0]: [], days[1]: []})
+        self.assertEqual(base.App.get_by_namespace("rooms"), rooms)
+
+class DoubleBookingTest(ReservationTestCase):
+    def setUp(self):
+        super(DoubleBookingTest, self).setUp()
+        self.other = User.objects.create_user("other", "o@example.com", "x")
+        self.booked = self.reserve(datetime.datetime(2011, 3, 7, 10),
+                                   datetime.datetime(2011, 3, 7, 12))
+        # same namespace, or someone else: not double bookings
+        self.reserve(datetime.datetime(2011, 3, 7, 11),
+                     datetime.datetime(2011, 3, 7, 12))
+        self.reserve(datetime.datetime(2011, 3, 7, 11),
+                     datetime.datetime(2011, 3, 7, 12),
+                     namespace="rooms", person=self.other)
+        self.double = self.reserve(datetime.datetime(2011, 3, 7, 11),
+                                   datetime.datetime(2011, 3, 7, 13),
+                                   namespace="rooms")
+        weekly = models.Recurrence.objects.create(
+            frequency=models.Recurrence.WEEKLY)
+        self.series = self.reserve(datetime.datetime(2011, 2, 28, 12, 30),
+                                   datetime.datetime(2011, 2, 28, 14),
+                                   namespace="duty", recurrence=weekly)
+
+    def test_sweep(self):
+        # the values swept, the series and the reservations found
+        with self.assertNumQueries(3):
+            pairs = models.Reservation.objects.double_bookings(
+                datetime.datetime(2011, 3, 1), datetime.datetime(2011, 3, 8))
+        self.assertEqual(
+            [(a.namespace, b.namespace) for a, b in pairs],
+            [("lyra", "rooms"), ("lyra", "rooms"), ("rooms", "duty")])
+        self.assertEqual(pairs[-1][1].start, 
+                         datetime.datetime(2011, 3, 7, 12, 30))
+
+    def test_form(self):
+        class Form(forms.ReservationExclusiveEnable):
+            check_double_booking = True
+
+        data = {"start": "2011-03-14 13:00", "stop": "2011-03-14 15:00",
+                "description": u"meeting", "style": "yellow"}
+        form = Form(data, person=self.user, namespace="lyra",
+                    queryset=models.Reservation.objects.in_namespace("lyra"))
+        self.assertFalse(form.is_valid())
+        self.assertTrue("duty" in form.errors["start"][0])
+
+        form = Form(data, person=self.other, namespace="lyra",
+                    queryset=models.Reservation.objects.in_namespace("lyra"))
+        self.assertTrue(form.is_valid())
+
+    def test_form_series(self):
+        class Form(forms.ReservationExclusiveEnable):
+            check_double_booking = True
+
+        # free on the first tuesday, the monday after is on duty
+        data = {"start": "2011-03-15 13:00", "stop": "2011-03-15 15:00",
+                "description": u"meeting", "style": "yellow",
+                "repeat": models.Recurrence.DAILY, "repeat_interval": "1",
+                "repeat_until": "2011-03-20"}
+        form = Form(data, person=self.user, namespace="lyra",
+                    queryset=models.Reservation.objects.in_namespace("lyra"))
+        self.assertTrue(form.is_valid())
+
+        data["repeat_until"] = "2011-03-21"
+        form = Form(data, person=self.user, namespace="lyra",
+                    queryset=models.Reservation.objects.in_namespace("lyra"))
+        self.assertFalse(form.is_valid())
+        self.assertTrue("duty" in form.errors["start"][0])
+
+    def test_command(self):
+        out = StringIO.StringIO()
+        management.call_command("lyra_audit_double_bookings", 
+                                "2011-03-01", "2011-03-08", 
+                                namespace=["rooms", "duty"], stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[-1], "1 double bookings")
+        self.assertTrue(lines[0].startswith("tester: rooms 2011-03-07 11:00"))
+
+class DutyPeriodTest(ReservationTestCase):
+    def setUp(self):
+        super(DutyPeriodTest, self).setUp()
+        self.person = duty_models.DutyPerson.objects.create(user=self.user,
+                                                            phone="123")
+
+    def period_form(self, **data):
+        data = dict({"period_start_date": "2011-03-01",
+                     "period_stop_date": "2011-03-31",
+                     "period_time_start": "08:00",
+                     "period_time_stop": "16:00",
+                     "person": self.person.pk}, **data)
+        return duty.DutyReservation(data, person=self.user, 
+                                    namespace="oncall", instance=None,
+                                    queryset=oncall.queryset)
+
+    def test_book_period(self):
+        form = self.period_form()
+        self.assertTrue(form.is_valid())
+        week = form.save()
+        self.assertEqual((week.year, week.week), (2011, 9))
+
+        days = oncall.queryset.by_date(
+            datetime.date(2011, 3, d) for d in (1, 15, 31))
+        self.assertEqual([[(r.start, r.stop) for r in rs] 
+                          for d, rs in sorted(days.items())],
+                         [[(datetime.datetime(2011, 3, d, 8),
+                            datetime.datetime(2011, 3, d, 16))]
+                          for d in (1, 15, 31)])
+        self.assertEqual(
+            oncall.queryset.by_date([datetime.date(2011, 4, 1)]).values(),
+            [[]])
+
+    def test_exclusive_period_conflict(self):
+        self.reserve(datetime.datetime(2011, 3, 10, 9),
+                     datetime.datetime(2011, 3, 10, 10),
+                     namespace="oncall")
+
+        form = self.period_form(exclusive="on")
+        self.assertFalse(form.is_valid())
+        self.assertTrue("10.03.2011" in form.errors["period_start_date"][0])
+
+        form = self.period_form(exclusive="on", period_start_date="2011-03-11")
+        self.assertTrue(form.is_valid())
+
+    def test_remove_period(self):
+        self.period_form().save()
+        res = oncall.queryset.get()
+        self.client.login(username="tester", password="secret")
+        User.objects.filter(pk=self.user.pk).update(is_superuser=True)
+
+        response = self.client.post(oncall.reverse("remove", {"pk": res.pk}),
+                                    {"confirm": "on"})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(oncall.queryset.exists())
+        self.assertFalse(oncall.queryset.expanded(
+                datetime.datetime(2011, 3, 1), 
+                datetime.datetime(2011, 4, 1)))
+
+    def test_remove_one_day(self):
+        self.period_form().save()
+        res = oncall.queryset.get()
+        self.client.login(username="tester", password="secret")
+        User.objects.filter(pk=self.user.pk).update(is_superuser=True)
+        remove_link = (oncall.reverse("remove", {"pk": res.pk})
+                       + "?occurrence=2011-03-08")
+
+        response = self.client.get(
+            oncall.reverse("browse_week", {"year": 2011, "week": 10}))
+        self.assertTrue(remove_link in response.content)
+
+        response = self.client.get(remove_link)
+        self.assertEqual(response.context["occurrence"], 
+                         datetime.date(2011, 3, 8))
+
+        response = self.client.post(remove_link, {"confirm": "on"})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response["Location"].endswith(
+                oncall.reverse("browse_week", {"year": 2011, "week": 10})))
+        days = oncall.queryset.by_date(
+            datetime.date(2011, 3, d) for d in (7, 8, 9))
+        self.assertEqual([len(days[d]) for d in sorted(days)], [1, 0, 1])
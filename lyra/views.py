@@ -10,6 +10,7 @@ from django.utils.decorators import method_decorator
 from django.views.generic import base as views_base
 
 from lyra import base
+from lyra import intervals
 
 login_required_m = method_decorator(auth_decorators.login_required)
 
@@ -28,13 +29,23 @@ class Lyra(base.App):
     from django.conf.urls import defaults as urlconf
     from django.core import urlresolvers
     from django.db.models import Q
+    from django.db.models import Count, Max
 
     from lyra import models
     from lyra import forms
     from lyra import browse as browse_mod
     from lyra import crud as crud_mod
+    from lyra import permissions as permissions_mod
+    from lyra import ical
 
     model = models.Reservation
+    # materialized counts maintained for `model`, None to count on the fly
+    count_model = models.ReservationCount
+    # keep an in-process interval index of at most this many
+    # reservations for conflict checks, see lyra.intervals
+    interval_index_size = None
+    # auto_now field of `model` for conditional GETs, None to disable
+    modified_field = "modified"
     app_name="lyra"
 
     # subapplications
@@ -44,6 +55,18 @@ class Lyra(base.App):
     # errors
     perm_error = PermissionError
 
+    # sends the iCalendar feed as it is written where available;
+    # without it the feed is written out in the view, before the
+    # request ends and closes the database connection
+    streaming_response_class = getattr(http, "StreamingHttpResponse", None)
+
+    permission_cache_class = permissions_mod.PermissionCache
+
+    # days before and after today exported to calendar clients when
+    # the request does not say
+    ical_days_back = 365
+    ical_days_ahead = 365
+
     def get_app_desc(self):
         return _(u"Calendar")
 
@@ -54,19 +77,38 @@ class Lyra(base.App):
             self.app_name)
 
         self._queryset = None
+        if self.interval_index_size:
+            intervals.enable(self.model, self.namespace, 
+                             self.interval_index_size)
 
         self.browse = self.browse_class(app=self)
         self.crud = self.crud_class(app=self)
 
     @property
     def queryset(self):
-        if self._queryset:
+        if self._queryset is not None:
             return self._queryset
 
-        qs = self._queryset = self.model.objects.filter(
-            namespace=self.namespace)
+        qs = self._queryset = self.model.objects.in_namespace(
+            self.namespace)
         return qs
-    
+
+    def get_page_state(self, span, namespaces=None):
+        if self.modified_field is None:
+            return None
+
+        if namespaces is None:
+            qs = self.queryset
+        else:
+            qs = self.model.objects.filter(namespace__in=namespaces)
+        if span is not None:
+            qs = qs.in_window(*span)
+        state = qs.aggregate(last_modified=self.Max(self.modified_field),
+                             count=self.Count("pk"))
+        # the count catches deletions that leave the latest change be
+        return (state["last_modified"],
+                (state["last_modified"], state["count"]))
+
     def _get_urls(self):
         patterns = self.urlconf.patterns('', *[
                 self.urlconf.url('^$', self.landing, name="landing"),
@@ -74,7 +116,10 @@ class Lyra(base.App):
                     self.urlconf.include(self.browse.urls)),
                 self.urlconf.url(
                     '^%s/' % _(u"reservation"),
-                    self.urlconf.include(self.crud.urls))
+                    self.urlconf.include(self.crud.urls)),
+                self.urlconf.url(
+                    '^%s\.ics$' % _(u"calendar"), 
+                    self.export_ical, name="ical"),
                 ])
 
         return patterns
@@ -89,6 +134,50 @@ class Lyra(base.App):
             week, 
             template_name="landing")
 
+    def export_ical(self, request):
+        """the reservations between the `start` and `stop` dates in
+        the query string as an iCalendar feed, read with a database
+        iterator, recurring ones as recurrence rules"""
+        is_forbidden = self.check_forbidden(request, ["view"])
+        if is_forbidden:
+            return is_forbidden
+
+        today = self.datetime.date.today()
+        try:
+            start, stop = [
+                self.datetime.datetime.strptime(
+                    request.GET[key], "%Y-%m-%d").date()
+                if key in request.GET else default
+                for key, default in (
+                    ("start", today - self.datetime.timedelta(
+                            self.ical_days_back)),
+                    ("stop", today + self.datetime.timedelta(
+                            self.ical_days_ahead)))]
+        except ValueError:
+            return self.http.HttpResponseBadRequest()
+
+        host = request.get_host()
+        reservations = (self.queryset
+                        .for_listing()
+                        .in_window(start, stop)
+                        .order_by("start")
+                        .iterator())
+
+        chunks = self.ical.calendar(
+            reservations,
+            self.get_app_desc(),
+            lambda res: "%s-%s@%s" % (self.namespace, res.pk, host),
+            lambda res: request.build_absolute_uri(res.get_absolute_url()))
+        if self.streaming_response_class is None:
+            response = self.http.HttpResponse(
+                "".join(chunks), content_type="text/calendar; charset=utf-8")
+        else:
+            response = self.streaming_response_class(
+                chunks, content_type="text/calendar; charset=utf-8")
+        response["Content-Disposition"] = (
+            'inline; filename="%s.ics"' % self.namespace)
+        return response
+
     def user_can_create(self, request):
         return request.user.is_authenticated()
 
@@ -105,25 +194,26 @@ class Lyra(base.App):
     def user_can_view(self, request, obj=None): 
         return True
     
+    def permissions(self, request):
+        """the PermissionCache of this app for `request`"""
+        try:
+            caches = request._lyra_permissions
+        except AttributeError:
+            caches = request._lyra_permissions = {}
+
+        try:
+            return caches[self.namespace]
+        except KeyError:
+            cache = caches[self.namespace] = self.permission_cache_class(
+                self, request)
+            return cache
+
     def check_forbidden(self, request, perm_list, obj=None):
-        def try_meth(m):
-            try:
-                return m(request, obj)
-            except TypeError:
-                try:
-                    return m(request)
-                except TypeError:
-                    pass
-                raise
-        
-        for perm in perm_list:
-            perm_method = getattr(self, "user_can_%s" % perm)
-            if not perm_method:
-                raise ValueError("unknown permission %s" % perm)
+        permissions = self.permissions(request)
 
+        for perm in perm_list:
             try:
-                allowed = try_meth(perm_method)
-                if not allowed:
+                if not permissions.has(perm, obj):
                     return self.forbidden(request)
             except self.perm_error, exc:
                 return self.forbidden(request, exc.reason)
@@ -7,6 +7,8 @@ setup(name='lyra',
       author_email='leo.o.honkanen@gmail.com',
       url='https://github.com/hylje/lyra',
       packages=['lyra', 
+                'lyra.management',
+                'lyra.management.commands',
                 'lyra.contrib',
                 'lyra.contrib.duty',
                 'lyra.contrib.food',